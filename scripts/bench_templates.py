@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Measure the rendering of instance and guest network configurations.
+
+    scripts/bench_templates.py [--count 10000] [--template-dir DIR]
+
+Renders COUNT Xen configurations and COUNT network configurations with
+each renderer for two interfaces, as a batch deploy of COUNT instances
+would, and prints the time per configuration.
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from vmlight.templates import (  # noqa: E402
+    NETWORK_RENDERERS,
+    GuestInterface,
+    render_template,
+)
+
+
+def bench(label, count, render):
+    start = time.perf_counter()
+    for i in range(count):
+        render(i)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<12} {elapsed * 1000:>9.1f}ms {elapsed / count * 1e6:>8.2f}us")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--count", type=int, default=10000)
+    parser.add_argument("--template-dir", default="/nonexistent")
+    args = parser.parse_args()
+    config = {"general": {"template_dir": args.template_dir}}
+
+    print(f"{'TEMPLATE':<12} {'TOTAL':>11} {'EACH':>10}")
+    bench(
+        "xen.cfg",
+        args.count,
+        lambda i: render_template(
+            config,
+            "xen.cfg",
+            vm_id=i,
+            name=f"web{i}",
+            memory=512,
+            vcpus=1,
+            ip=f"10.10.{i // 256}.{i % 256}",
+            disks=f"'/var/lib/vmlight/instances/{i}-web{i}/root.qcow2,qcow2,xvda,rw'",
+            pvgrub_path="/usr/lib/xen/bin/pvgrub",
+        ),
+    )
+    for name, renderer in NETWORK_RENDERERS.items():
+        bench(
+            name,
+            args.count,
+            lambda i: renderer.render(
+                config,
+                [
+                    GuestInterface(
+                        f"eth{n}", f"10.{n}.{i // 256}.{i % 256}", f"10.{n}.0.1"
+                    )
+                    for n in range(2)
+                ],
+            ),
+        )
+
+
+if __name__ == "__main__":
+    main()
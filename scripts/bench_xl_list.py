@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Measure Xen domain lookups with and without the shared 'xl list' snapshot.
+
+    scripts/bench_xl_list.py [--domains 10 100 1000]
+
+For each number of domains, a fake xl listing that many domains is looked
+up once per domain, as 'vm --list' does: first running 'xl list' for every
+lookup, as before the snapshot, then sharing one snapshot. Prints the
+total time and the number of 'xl list' calls of each.
+"""
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from vmlight.xen import get_domain_snapshot, invalidate_domain_snapshot  # noqa: E402
+
+FAKE_XL = """#!/bin/sh
+echo x >> {calls_file}
+cat {listing_file}
+"""
+
+
+def create_fake_xl(tmp_dir: Path, domains: int):
+    listing_file = tmp_dir / "listing"
+    calls_file = tmp_dir / "calls"
+    lines = ["Name                ID   Mem VCPUs      State   Time(s)"]
+    for i in range(domains):
+        lines.append(f"{i}-vm{i:<14} {i + 1:>4}   512     1     -b----      12.3")
+    listing_file.write_text("\n".join(lines) + "\n")
+    xl_path = tmp_dir / "xl"
+    xl_path.write_text(FAKE_XL.format(calls_file=calls_file, listing_file=listing_file))
+    xl_path.chmod(0o755)
+    return xl_path, calls_file
+
+
+def bench(label, xl_path, calls_file, domains, refresh):
+    invalidate_domain_snapshot(xl_path)
+    calls_file.write_text("")
+    start = time.perf_counter()
+    for i in range(domains):
+        domain = get_domain_snapshot(xl_path, refresh=refresh).get(i)
+        assert domain is not None and domain.is_running()
+    elapsed = time.perf_counter() - start
+    calls = len(calls_file.read_text().splitlines())
+    print(f"{domains:>7} {label:<10} {elapsed * 1000:>9.1f}ms {calls:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--domains", type=int, nargs="+", default=[10, 100, 1000], help="Domains"
+    )
+    args = parser.parse_args()
+
+    print(f"{'DOMAINS':>7} {'MODE':<10} {'TIME':>11} {'XL CALLS':>8}")
+    for domains in args.domains:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            xl_path, calls_file = create_fake_xl(Path(tmp_dir), domains)
+            bench("per-lookup", xl_path, calls_file, domains, refresh=True)
+            bench("snapshot", xl_path, calls_file, domains, refresh=False)
+
+
+if __name__ == "__main__":
+    main()
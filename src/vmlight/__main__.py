@@ -5,12 +5,18 @@ import shutil
 from pathlib import Path
 
 from .args import parse_args
-from .xen import XenDeployManager
+from .batch import BatchDeployManager
+from .client import DaemonClient
+from .exporter import MetricsExporter
 from .ssh import SshKeyManager
 from .image import ImageManager
+from .migrate import MigrationManager, receive
 from .utils import require_root
-from .utils import ApplicationError
-from .vm import VmManager
+from .utils import ApplicationError, cancel_commands
+from .operations import VmOperations
+from .pool import InstancePool
+from .trace import COMMAND, tracer
+from .vm import VmManager, get_deploy_manager_class
 
 
 def get_config():
@@ -22,6 +28,12 @@ def get_config():
         "general": {
             "image_dir": "/var/lib/vmlight/images",
             "instances_dir": "/var/lib/vmlight/instances",
+            "inventory_file": "/var/lib/vmlight/inventory.db",
+            "allocator_state_file": "/var/lib/vmlight/allocator.json",
+            "pool_dir": "/var/lib/vmlight/pool",
+            "trace_file": "",
+            "socket_path": "/run/vmlight/vmlightd.sock",
+            "template_dir": "/etc/vmlight/templates",
         },
         "deploy": {
             "memory": "512",
@@ -30,11 +42,38 @@ def get_config():
             "type": "xen",
             "ssh_key_list_file": "/etc/vmlight/ssh_key_store",
             "default_gateway": "10.10.10.2",
+            "subnet": "",
+            "linked_clone": "no",
+            "guest_editor": "auto",
+            "network_config": "networkd",
+            "jobs": "4",
         },
         "xen": {
             "conf_dir": "/etc/xen",
             "xl_path": "/usr/sbin/xl",
             "pvgrub_path": "/usr/lib/xen/bin/pvgrub",
+            "xenstore_watch_path": "/usr/bin/xenstore-watch",
+        },
+        "kvm": {
+            "qemu_path": "/usr/bin/qemu-system-x86_64",
+            "aio": "io_uring",
+            "net_queues": "",
+        },
+        "migrate": {
+            "ssh_command": "ssh -o BatchMode=yes",
+            "rsync_path": "rsync",
+            "remote_vmlight": "vmlight",
+            "bwlimit": "0",
+        },
+        "exporter": {
+            "listen": "127.0.0.1:9477",
+            "interval": "15",
+        },
+        "nspawn": {
+            "machines_dir": "/var/lib/machines",
+            "conf_dir": "/etc/systemd/nspawn",
+            "unit_dir": "/etc/systemd/system",
+            "bridge": "",
         },
     }
 
@@ -58,27 +97,30 @@ def get_config():
     return config_dict
 
 
+def check_deploy_args(args, subparser):
+    if args.manifest:
+        if args.interactive:
+            subparser.error("--manifest cannot be used in interactive mode")
+    elif not args.interactive:
+        if not (args.name and args.image):
+            subparser.error(
+                "The following arguments are required for non-interactive mode: --name, --image"
+            )
+
+
 def deploy(args, config, subparser):
     """
     Run the 'deploy' command.
     """
-    if not args.interactive:
-        if not (args.name and args.image and args.ip):
-            subparser.error(
-                "The following arguments are required for non-interactive mode: --name, --image, --ip"
-            )
     require_root()
-    if args.type == "xen":
-        agent = XenDeployManager(args, config)
-    elif args.type == "kvm":
-        raise ApplicationError("Deploying a KVM instance is not supported yet.")
-    elif args.type == "systemd-nspawn":
-        raise ApplicationError(
-            "Deploying a systemd-nspawn instance is not supported yet."
-        )
-    else:
-        raise ApplicationError(f"Unsupported instance type: {args.type}")
+    VmManager(config)  # Creates the inventory and allocator state on first use
+    deploy_manager_class = get_deploy_manager_class(args.type)
+
+    if args.manifest:
+        BatchDeployManager(args, config, deploy_manager_class).deploy()
+        return
 
+    agent = deploy_manager_class(args, config)
     if args.interactive:
         agent.interactive_deploy()
     else:
@@ -94,10 +136,20 @@ def manage_images(args, config, subparser):
         image_manager.list()
     elif args.add:
         require_root()
-        image_manager.add(Path(args.add))
+        image_manager.add(args.add, args.name, args.network_config)
+    elif args.network_config and args.name:
+        require_root()
+        image_manager.set_network_config(args.name, args.network_config)
     elif args.remove:
         require_root()
         image_manager.remove(args.remove)
+    elif args.verify:
+        if not image_manager.verify(args.verify):
+            raise ApplicationError(f"Image {args.verify} does not match its digest.")
+        print(f"Image {args.verify} is intact.")
+    elif args.migrate_store:
+        require_root()
+        image_manager.migrate()
     else:
         subparser.error("No valid argument provided.")
 
@@ -116,6 +168,14 @@ def manage_ssh_keys(args, config, subparser):
     elif args.remove:
         require_root()
         manager.remove_key(args.remove)
+    elif args.add_group:
+        if len(args.add_group) < 2:
+            subparser.error("--add-group requires a group name and at least one key")
+        require_root()
+        manager.add_group(args.add_group[0], args.add_group[1:])
+    elif args.remove_group:
+        require_root()
+        manager.remove_group(args.remove_group)
     elif args.list:
         manager.list_keys()
     else:
@@ -127,51 +187,154 @@ def manage_vms(args, config, subparser):
     Run the 'vm' command.
     """
     vm_manager = VmManager(config)
+    operation = next(
+        (op for op in ["start", "stop", "restart"] if getattr(args, op) is not None),
+        None,
+    )
     if args.list:
         vm_manager.list_instances()
-    elif args.start:
-        require_root()
-        vm_manager.start_instance(args.start)
-    elif args.stop:
+    elif operation:
         require_root()
-        vm_manager.stop_instance(args.stop)
-    elif args.restart:
-        require_root()
-        vm_manager.restart_instance(args.restart)
+        operations = VmOperations(
+            vm_manager,
+            jobs=args.jobs,
+            wait=args.wait or args.force,
+            timeout=args.timeout,
+            force=args.force,
+        )
+        vms = operations.select(
+            getattr(args, operation), args.all, args.image, args.name_glob
+        )
+        operations.run(operation, vms)
     elif args.delete:
         require_root()
         vm_manager.delete_instance(args.delete)
+    elif args.flatten:
+        require_root()
+        vm_manager.flatten_instance(args.flatten)
+    elif args.migrate is not None:
+        require_root()
+        if not args.to:
+            subparser.error("--migrate requires --to HOST.")
+        vms = VmOperations(vm_manager).select(
+            args.migrate, args.all, args.image, args.name_glob
+        )
+        MigrationManager(vm_manager, args.to, args.jobs, args.bwlimit).run(vms)
+    elif args.receive_check or args.receive_commit:
+        require_root()
+        if args.receive_check:
+            receive(vm_manager, "check", args.receive_check)
+        else:
+            receive(vm_manager, "commit", args.receive_commit)
+    else:
+        subparser.error("No valid argument provided.")
+
+
+def manage_pool(args, config, subparser):
+    """
+    Run the 'pool' command.
+    """
+    pool = InstancePool(config)
+    if args.status:
+        pool.status()
+    elif args.refill:
+        require_root()
+        pool.refill()
+    elif args.image and args.size is not None:
+        require_root()
+        pool.set_size(args.image, args.disk_size, args.size)
+        pool.start_refill()
+        print(
+            f"Keeping {args.size} disks of {args.image} ({args.disk_size}), "
+            "refilling in the background."
+        )
+    else:
+        subparser.error("Either --status, --refill or --image with --size is required.")
+
+
+def run_exporter(args, config, subparser):
+    """
+    Run the 'exporter' command.
+    """
+    address, _, port = args.listen.rpartition(":")
+    if not address or not port.isdigit():
+        subparser.error(f"Invalid listen address: {args.listen}")
+    MetricsExporter(config, args.interval).serve(address.strip("[]"), int(port))
+
+
+def manage_inventory(args, config, subparser):
+    """
+    Run the 'inventory' command.
+    """
+    if args.rebuild:
+        require_root()
+        count = VmManager(config).rebuild_inventory()
+        print(f"Inventory rebuilt with {count} instances.")
     else:
         subparser.error("No valid argument provided.")
 
 
 def check_environment():
-    required_binaries = ["guestmount"]
+    required_binaries = ["qemu-img"]
     for binary in required_binaries:
         if not shutil.which(binary):
             print(f"Required binary '{binary}' is not installed, aborting.")
             sys.exit(1)
 
 
+def run_command(args, config, parser, subparsers):
+    if args.command == "deploy":
+        check_deploy_args(args, subparsers["deploy"])
+    client = None if args.no_daemon else DaemonClient.connect(config)
+    if client is not None and client.run_command(args):
+        return
+    if args.command == "deploy":
+        deploy(args, config, subparsers["deploy"])
+    elif args.command == "image":
+        manage_images(args, config, subparsers["image"])
+    elif args.command == "ssh-keys":
+        manage_ssh_keys(args, config, subparsers["ssh-keys"])
+    elif args.command == "vm":
+        manage_vms(args, config, subparsers["vm"])
+    elif args.command == "pool":
+        manage_pool(args, config, subparsers["pool"])
+    elif args.command == "exporter":
+        run_exporter(args, config, subparsers["exporter"])
+    elif args.command == "inventory":
+        manage_inventory(args, config, subparsers["inventory"])
+    else:
+        parser.print_help()
+
+
+def finish_trace(args):
+    """
+    Print the timing summary and write the trace file, if requested.
+    """
+    if getattr(args, "timings", False):
+        tracer.print_summary()
+    if args.trace_file:
+        try:
+            tracer.write(Path(args.trace_file))
+        except OSError as e:
+            print(f"Could not write trace file {args.trace_file}: {e}")
+
+
 def main():
     check_environment()
     config = get_config()
     args, parser, subparsers = parse_args(config)
     try:
-        if args.command == "deploy":
-            deploy(args, config, subparsers["deploy"])
-        elif args.command == "image":
-            manage_images(args, config, subparsers["image"])
-        elif args.command == "ssh-keys":
-            manage_ssh_keys(args, config, subparsers["ssh-keys"])
-        elif args.command == "vm":
-            manage_vms(args, config, subparsers["vm"])
-        else:
-            parser.print_help()
-
+        with tracer.span(f"vmlight {args.command}", COMMAND):
+            run_command(args, config, parser, subparsers)
     except ApplicationError as e:
         print(f"{parser.prog}: error: {e.message}")
         sys.exit(1)
+    except KeyboardInterrupt:
+        cancel_commands()  # Do not wait for commands run by other threads
+        print(f"{parser.prog}: interrupted")
+        sys.exit(130)
+    finally:
+        finish_trace(args)
 
 
 if __name__ == "__main__":
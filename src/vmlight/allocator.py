@@ -0,0 +1,220 @@
+import ipaddress
+import json
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
+from .utils import ApplicationError
+from .utils import file_lock
+
+
+class _Pool:
+    """
+    A pool of values handed out from a counter, with a free-list of released
+    values that are reused before the counter grows. Values in use are kept
+    in a dict keyed by their string form. All operations are amortized O(1).
+    """
+
+    def __init__(self, state, first, last, to_value=int):
+        self.state = state
+        self.state.setdefault("next", first)
+        self.state.setdefault("free", [])
+        self.state.setdefault("used", {})
+        self.last = last
+        self.to_value = to_value
+
+    def is_used(self, value):
+        return str(value) in self.state["used"]
+
+    def get_owner(self, value):
+        return self.state["used"].get(str(value))
+
+    def take(self, value, owner):
+        self.state["used"][str(value)] = owner
+
+    def allocate(self, owner):
+        free = self.state["free"]
+        while free:
+            value = self.to_value(free.pop())
+            if not self.is_used(value):  # May have been taken explicitly since
+                self.take(value, owner)
+                return value
+        while self.state["next"] <= self.last:
+            value = self.to_value(self.state["next"])
+            self.state["next"] += 1
+            if not self.is_used(value):
+                self.take(value, owner)
+                return value
+        return None
+
+    def release(self, value, reuse=True):
+        if str(value) in self.state["used"]:
+            del self.state["used"][str(value)]
+            if reuse:
+                self.state["free"].append(self.state_value(value))
+
+    def state_value(self, value):
+        return value
+
+
+class _IpPool(_Pool):
+    """
+    A pool of the host addresses of a subnet. The counter and free-list hold
+    offsets into the subnet, so that they stay JSON serializable.
+    """
+
+    def __init__(self, state, subnet):
+        self.subnet = subnet
+        if subnet.num_addresses <= 2:
+            first, last = 0, subnet.num_addresses - 1
+        else:
+            # Leave out the network and broadcast addresses
+            first, last = 1, subnet.num_addresses - 2
+        super().__init__(state, first, last, self._to_ip)
+
+    def _to_ip(self, offset):
+        return self.subnet.network_address + offset
+
+    def state_value(self, value):
+        return int(value) - int(self.subnet.network_address)
+
+    def release(self, value, reuse=True):
+        super().release(value, reuse=reuse and value in self.subnet)
+
+
+class Allocator:
+    """
+    Hands out VM IDs and IP addresses from the subnet behind the default
+    gateway. The pools are kept in a JSON state file, and every operation
+    holds an flock on it, so concurrent deploys never get the same ID or IP.
+    """
+
+    def __init__(self, config):
+        self.state_file = Path(config["general"]["allocator_state_file"]).absolute()
+        self.lock_file = self.state_file.with_name(f".{self.state_file.name}.lock")
+        self.gateway = ipaddress.ip_address(config["deploy"]["default_gateway"])
+        subnet = config["deploy"]["subnet"] or f"{self.gateway}/24"
+        try:
+            self.subnet = ipaddress.ip_network(subnet, strict=False)
+        except ValueError as e:
+            raise ApplicationError(f"Invalid subnet: {subnet}") from e
+
+    @contextmanager
+    def _state(self):
+        with file_lock(self.lock_file):
+            if self.state_file.exists():
+                state = json.loads(self.state_file.read_text())
+            else:
+                state = {}
+            if state.get("subnet") != str(self.subnet):
+                # The subnet changed, so start the counter over but keep
+                # the addresses in use
+                used = state.get("ips", {}).get("used", {})
+                state["subnet"] = str(self.subnet)
+                state["ips"] = {"used": used}
+            yield state
+            tmp_file = self.state_file.with_name(f".{self.state_file.name}.tmp")
+            tmp_file.write_text(json.dumps(state))
+            os.replace(tmp_file, self.state_file)
+
+    def exists(self):
+        return self.state_file.exists()
+
+    def _get_vm_id_pool(self, state):
+        return _Pool(state.setdefault("vm_ids", {}), 1, float("inf"))
+
+    def _get_ip_pool(self, state):
+        ip_pool = _IpPool(state.setdefault("ips", {}), self.subnet)
+        # Never hand out the gateway
+        ip_pool.take(self.gateway, None)
+        return ip_pool
+
+    def _parse_ip(self, ip):
+        try:
+            return ipaddress.ip_address(ip)
+        except ValueError as e:
+            raise ApplicationError(f"Invalid IP address: {ip}") from e
+
+    def allocate(self, ip=None):
+        """
+        Allocate a VM ID and an IP address for it. If an IP address is given,
+        reserve that one instead. Returns the VM ID and the IP address.
+        """
+        with self._state() as state:
+            vm_id_pool = self._get_vm_id_pool(state)
+            ip_pool = self._get_ip_pool(state)
+            if ip:
+                ip = self._parse_ip(ip)
+                if ip not in self.subnet:
+                    raise ApplicationError(f"IP address {ip} is not in {self.subnet}.")
+                if ip == self.gateway:
+                    raise ApplicationError(f"IP address {ip} is the default gateway.")
+                if ip_pool.is_used(ip):
+                    raise ApplicationError(
+                        f"IP address {ip} is already used by VM {ip_pool.get_owner(ip)}."
+                    )
+            vm_id = vm_id_pool.allocate(None)
+            if ip:
+                ip_pool.take(ip, vm_id)
+            else:
+                ip = ip_pool.allocate(vm_id)
+                if ip is None:
+                    raise ApplicationError(f"No free IP addresses left in {self.subnet}.")
+            vm_id_pool.take(vm_id, str(ip))
+            return vm_id, str(ip)
+
+    def _get_conflicts(self, state, vm_id, ip):
+        conflicts = []
+        if self._get_vm_id_pool(state).is_used(int(vm_id)):
+            conflicts.append(f"VM ID {vm_id} is already used.")
+        ip = self._parse_ip(ip)
+        if ip not in self.subnet:
+            conflicts.append(f"IP address {ip} is not in {self.subnet}.")
+        elif ip == self.gateway:
+            conflicts.append(f"IP address {ip} is the default gateway.")
+        elif self._get_ip_pool(state).is_used(ip):
+            owner = self._get_ip_pool(state).get_owner(ip)
+            conflicts.append(f"IP address {ip} is already used by VM {owner}.")
+        return conflicts
+
+    def check_free(self, vm_id, ip):
+        """
+        Get the reasons a VM ID and IP address cannot be reserved, if any.
+        """
+        with self._state() as state:
+            return self._get_conflicts(state, vm_id, ip)
+
+    def reserve(self, vm_id, ip):
+        """
+        Reserve a given VM ID and IP address, as those of an instance moved
+        here from another host.
+        """
+        with self._state() as state:
+            conflicts = self._get_conflicts(state, vm_id, ip)
+            if conflicts:
+                raise ApplicationError(" ".join(conflicts))
+            self._get_vm_id_pool(state).take(int(vm_id), ip)
+            self._get_ip_pool(state).take(self._parse_ip(ip), int(vm_id))
+
+    def release(self, vm_id, ip=None):
+        """
+        Release a VM ID and its IP address.
+        """
+        with self._state() as state:
+            self._get_vm_id_pool(state).release(int(vm_id))
+            if ip:
+                self._get_ip_pool(state).release(self._parse_ip(ip))
+
+    def rebuild(self, instances):
+        """
+        Reset the pools to exactly the given (VM ID, IP address) pairs.
+        """
+        with self._state() as state:
+            state.clear()
+            state["subnet"] = str(self.subnet)
+            vm_id_pool = self._get_vm_id_pool(state)
+            ip_pool = self._get_ip_pool(state)
+            for vm_id, ip in instances:
+                vm_id_pool.take(int(vm_id), ip)
+                if ip:
+                    ip_pool.take(self._parse_ip(ip), int(vm_id))
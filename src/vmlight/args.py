@@ -1,5 +1,16 @@
 from .utils import ApplicationError
-from argparse import ArgumentParser
+from .templates import NETWORK_RENDERERS
+from argparse import SUPPRESS, ArgumentParser, ArgumentTypeError
+
+
+def positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise ArgumentTypeError(f"must be a positive integer: {value!r}")
+    return number
 
 
 def add_deploy_args(subparser: ArgumentParser, config):
@@ -8,7 +19,9 @@ def add_deploy_args(subparser: ArgumentParser, config):
     )
     subparser.add_argument("--name", help="Name of the instance")
     subparser.add_argument("--image", help="Name of the image")
-    subparser.add_argument("--ip", help="IP address of the instance")
+    subparser.add_argument(
+        "--ip", help="IP address of the instance (allocated if not given)"
+    )
     subparser.add_argument(
         "--disk-size",
         default=config["deploy"]["disk_size"],
@@ -25,7 +38,31 @@ def add_deploy_args(subparser: ArgumentParser, config):
         help="Number of CPUs assigned to the instance",
     )
     subparser.add_argument(
-        "--ssh-key", action="append", help="SSH key for the instance"
+        "--ssh-key",
+        action="append",
+        help="SSH key, group or fingerprint for the instance, as KEY or KEY:USER "
+        "to deploy it to a user other than root",
+    )
+    subparser.add_argument(
+        "--linked-clone",
+        action="store_true",
+        default=config["deploy"]["linked_clone"].lower() in ["yes", "true", "1"],
+        help="Create the disk as a qcow2 overlay on top of the image",
+    )
+    subparser.add_argument(
+        "--manifest", metavar="FILE", help="Deploy all instances in a manifest file"
+    )
+    subparser.add_argument(
+        "--jobs",
+        type=positive_int,
+        default=config["deploy"]["jobs"],
+        help="Number of instances deployed in parallel from a manifest",
+    )
+    subparser.add_argument(
+        "--timings",
+        action="store_true",
+        default=SUPPRESS,
+        help="Print the time spent per stage and per command",
     )
 
 
@@ -34,21 +71,125 @@ def add_ssh_key_args(subparser: ArgumentParser, config):
     subparser.add_argument("--add-file", metavar="FILE")
     subparser.add_argument("--remove", metavar="KEYNAME")
     subparser.add_argument("--list", action="store_true")
+    subparser.add_argument(
+        "--add-group",
+        nargs="+",
+        metavar="NAME",
+        help="Create or replace a group: --add-group GROUP KEYNAME...",
+    )
+    subparser.add_argument("--remove-group", metavar="GROUP")
 
 
 def add_image_args(subparser, config):
-    subparser.add_argument("--add", metavar="IMAGE_FILE")
+    subparser.add_argument(
+        "--add",
+        metavar="IMAGE_FILE_OR_URL",
+        help="Add an image from a file or http(s) URL, optionally .xz or .zst compressed",
+    )
+    subparser.add_argument("--name", help="Name of the added image")
+    subparser.add_argument(
+        "--network-config",
+        choices=list(NETWORK_RENDERERS),
+        help="Network configuration used by the image's guests, set with --add "
+        "or for the image given by --name",
+    )
     subparser.add_argument("--remove", metavar="IMAGE_NAME")
     subparser.add_argument("--list", action="store_true")
+    subparser.add_argument(
+        "--verify", metavar="IMAGE_NAME", help="Check an image against its digest"
+    )
+    subparser.add_argument(
+        "--migrate-store",
+        action="store_true",
+        help="Move image files left in the image directory by older versions "
+        "into the image store",
+    )
 
 
 def add_vm_args(subparser, config):
     mtx_group = subparser.add_mutually_exclusive_group()
     mtx_group.add_argument("--list", action="store_true")
-    mtx_group.add_argument("--start", metavar="VM_ID")
-    mtx_group.add_argument("--stop", metavar="VM_ID")
-    mtx_group.add_argument("--restart", metavar="VM_ID")
+    mtx_group.add_argument("--start", metavar="VM_ID", nargs="*")
+    mtx_group.add_argument("--stop", metavar="VM_ID", nargs="*")
+    mtx_group.add_argument("--restart", metavar="VM_ID", nargs="*")
     mtx_group.add_argument("--delete", metavar="VM_ID")
+    mtx_group.add_argument("--flatten", metavar="VM_ID")
+    mtx_group.add_argument(
+        "--migrate", metavar="VM_ID", nargs="*", help="Move Xen VMs to the host --to"
+    )
+    # Run over ssh by the sending host of a migration
+    mtx_group.add_argument("--receive-check", metavar="SPEC", help=SUPPRESS)
+    mtx_group.add_argument("--receive-commit", metavar="SPEC", help=SUPPRESS)
+    subparser.add_argument(
+        "--all", action="store_true", help="Select all VMs for start/stop/restart"
+    )
+    subparser.add_argument("--image", help="Select the VMs deployed from an image")
+    subparser.add_argument(
+        "--name-glob", metavar="GLOB", help="Select the VMs whose name matches GLOB"
+    )
+    subparser.add_argument(
+        "--wait", action="store_true", help="Wait for the VMs to reach their state"
+    )
+    subparser.add_argument(
+        "--timeout",
+        type=float,
+        default=300,
+        help="Seconds to wait for each VM (default: 300)",
+    )
+    subparser.add_argument(
+        "--force",
+        action="store_true",
+        help="Destroy VMs that do not stop before the timeout",
+    )
+    subparser.add_argument(
+        "--jobs", type=positive_int, default=8, help="Number of VMs operated on at once"
+    )
+    subparser.add_argument("--to", metavar="HOST", help="Host to migrate VMs to")
+    subparser.add_argument(
+        "--bwlimit",
+        type=int,
+        metavar="KIBPS",
+        default=config["migrate"]["bwlimit"],
+        help="Bandwidth limit in KiB/s shared by the disk copies of migrations "
+        "(0 for none)",
+    )
+
+
+def add_pool_args(subparser, config):
+    subparser.add_argument("--image", help="Image to keep disks of")
+    subparser.add_argument(
+        "--disk-size",
+        default=config["deploy"]["disk_size"],
+        help="Disk size of the pooled disks",
+    )
+    subparser.add_argument(
+        "--size", type=int, metavar="N", help="Number of disks to keep ready"
+    )
+    subparser.add_argument(
+        "--status", action="store_true", help="Show the pools and their hit rates"
+    )
+    subparser.add_argument(
+        "--refill", action="store_true", help="Refill all pools in the foreground"
+    )
+
+
+def add_exporter_args(subparser, config):
+    subparser.add_argument(
+        "--listen",
+        metavar="ADDRESS:PORT",
+        default=config["exporter"]["listen"],
+        help="Address to serve /metrics on",
+    )
+    subparser.add_argument(
+        "--interval",
+        type=float,
+        default=config["exporter"]["interval"],
+        help="Seconds between metric refreshes",
+    )
+
+
+def add_inventory_args(subparser, config):
+    subparser.add_argument("--rebuild", action="store_true")
 
 
 def parse_args(config):
@@ -66,6 +207,25 @@ def parse_args(config):
     parser.add_argument(
         "-t", "--type", default=config["deploy"]["type"], help="Type of the instance"
     )
+    # Also accepted after the deploy command, so the default must not
+    # override a value set there
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        default=SUPPRESS,
+        help="Print the time spent per stage and per command",
+    )
+    parser.add_argument(
+        "--trace-file",
+        metavar="FILE",
+        default=config["general"]["trace_file"],
+        help="Append a trace of the command to FILE as OpenTelemetry JSON",
+    )
+    parser.add_argument(
+        "--no-daemon",
+        action="store_true",
+        help="Run the command in this process even if vmlightd is running",
+    )
     subparsers = parser.add_subparsers(dest="command", required=True, help="Commands")
     subparser_dict = {}
 
@@ -90,4 +250,22 @@ def parse_args(config):
     add_vm_args(vm_parser, config)
     subparser_dict["vm"] = vm_parser
 
+    pool_parser = subparsers.add_parser(
+        "pool", help="Manage pools of copied and resized instance disks"
+    )
+    add_pool_args(pool_parser, config)
+    subparser_dict["pool"] = pool_parser
+
+    exporter_parser = subparsers.add_parser(
+        "exporter", help="Serve host and instance metrics for Prometheus"
+    )
+    add_exporter_args(exporter_parser, config)
+    subparser_dict["exporter"] = exporter_parser
+
+    inventory_parser = subparsers.add_parser(
+        "inventory", help="Manage the instance inventory"
+    )
+    add_inventory_args(inventory_parser, config)
+    subparser_dict["inventory"] = inventory_parser
+
     return (parser.parse_args()), parser, subparser_dict
@@ -0,0 +1,159 @@
+import configparser
+import contextvars
+import time
+from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .utils import ApplicationError
+
+MANIFEST_KEYS = [
+    "image",
+    "ip",
+    "disk_size",
+    "memory",
+    "vcpus",
+    "ssh_key",
+    "linked_clone",
+]
+
+
+class BatchDeployResult:
+    def __init__(self, name):
+        self.name = name
+        self.vm_id = None
+        self.error = None
+        self.duration = 0.0
+        self.timings = {}
+
+
+class BatchDeployManager:
+    """
+    Deploys many instances described in a manifest file through a pool of
+    worker threads. Each instance is deployed by its own deploy manager, so a
+    failure only cleans up the instance it happened in.
+
+    The manifest is an INI file with one section per instance, named after the
+    instance. Values in [DEFAULT] apply to all instances, and any value not
+    given falls back to the command line arguments. Instances without an ip
+    get one from the allocator:
+
+        [DEFAULT]
+        image = debian12
+        ssh_key = alice, bob
+
+        [web1]
+        ip = 10.10.10.11
+    """
+
+    def __init__(self, args, config, deploy_manager_class):
+        self.args = args
+        self.config = config
+        self.deploy_manager_class = deploy_manager_class
+        self.jobs = int(args.jobs)
+        if self.jobs < 1:
+            raise ApplicationError(f"Invalid number of jobs: {args.jobs}")
+        self.instances = self._read_manifest(Path(args.manifest))
+
+    def _read_manifest(self, manifest_file: Path):
+        if not manifest_file.exists():
+            raise ApplicationError(f"Manifest file {manifest_file} does not exist.")
+        parser = configparser.ConfigParser()
+        parser.read(manifest_file)
+        instances = []
+        for name in parser.sections():
+            section = parser[name]
+            unknown = set(section) - set(MANIFEST_KEYS)
+            if unknown:
+                raise ApplicationError(
+                    f"Unknown keys for instance {name}: {', '.join(sorted(unknown))}"
+                )
+            instance_args = vars(self.args).copy()
+            instance_args["name"] = name
+            for key in MANIFEST_KEYS:
+                if key not in section:
+                    continue
+                if key == "ssh_key":
+                    instance_args[key] = section[key].replace(",", " ").split()
+                elif key == "linked_clone":
+                    try:
+                        instance_args[key] = section.getboolean(key)
+                    except ValueError:
+                        raise ApplicationError(
+                            f"Invalid linked_clone for instance {name}: "
+                            f"{section[key]} (use yes or no)"
+                        ) from None
+                else:
+                    instance_args[key] = section[key]
+            if not instance_args.get("image"):
+                raise ApplicationError(f"Instance {name} has no image.")
+            instances.append(Namespace(**instance_args))
+        if not instances:
+            raise ApplicationError(f"Manifest file {manifest_file} has no instances.")
+        return instances
+
+    def _deploy_instance(self, instance_args):
+        result = BatchDeployResult(instance_args.name)
+        start = time.monotonic()
+        agent = None
+        try:
+            agent = self.deploy_manager_class(instance_args, self.config)
+            agent.log_prefix = f"[{instance_args.name}] "
+            agent.deploy()
+        except Exception as e:
+            result.error = e.message if isinstance(e, ApplicationError) else repr(e)
+        finally:
+            result.duration = time.monotonic() - start
+            if agent is not None:
+                result.vm_id = agent.vm_id
+                result.timings = agent.timings
+        return result
+
+    def deploy(self):
+        """
+        Deploy all instances of the manifest and print a summary.
+        """
+        print(f"Deploying {len(self.instances)} instances with {self.jobs} workers")
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            # Run each deploy in a copy of our context, so that its trace
+            # spans nest under the current one
+            futures = [
+                executor.submit(
+                    contextvars.copy_context().run, self._deploy_instance, instance
+                )
+                for instance in self.instances
+            ]
+            results = [future.result() for future in futures]
+        self.print_summary(results)
+        failed = [r for r in results if r.error]
+        if failed:
+            raise ApplicationError(
+                f"{len(failed)} of {len(results)} deployments failed."
+            )
+
+    def print_summary(self, results):
+        """
+        Print per-instance and per-phase timings of a batch deploy.
+        """
+        print()
+        print(f"{'NAME':<30} {'ID':<6} {'STATUS':<8} {'TIME':>8}")
+        for r in results:
+            status = "failed" if r.error else "ok"
+            vm_id = r.vm_id if r.vm_id is not None else "-"
+            print(f"{r.name:<30} {vm_id:<6} {status:<8} {r.duration:>7.1f}s")
+            if r.error:
+                print(f"    {r.error}")
+
+        phases = {}
+        for r in results:
+            for phase, seconds in r.timings.items():
+                phases.setdefault(phase, []).append(seconds)
+        if not phases:
+            return
+        print()
+        print(f"{'PHASE':<30} {'MIN':>8} {'AVG':>8} {'MAX':>8}")
+        for phase, values in phases.items():
+            avg = sum(values) / len(values)
+            print(
+                f"{phase:<30} {min(values):>7.1f}s {avg:>7.1f}s {max(values):>7.1f}s"
+            )
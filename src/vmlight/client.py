@@ -0,0 +1,114 @@
+import json
+import socket
+import time
+from pathlib import Path
+
+from .image import print_catalog
+from .operations import OPERATIONS
+from .ssh import print_keys
+from .utils import ApplicationError
+from .vm import print_instances
+
+# Seconds between polls of a running job
+JOB_POLL_INTERVAL = 0.5
+# Arguments of the CLI itself, which are not deploy arguments
+CLI_ARGS = ["command", "timings", "trace_file", "no_daemon"]
+
+
+class DaemonClient:
+    """
+    Calls the JSON API of vmlightd on its Unix socket.
+    """
+
+    def __init__(self, socket_path: Path, timeout=30.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    @classmethod
+    def connect(cls, config):
+        """
+        Get a client if vmlightd is running and we may talk to it, or None.
+        """
+        client = cls(Path(config["general"]["socket_path"]))
+        try:
+            client.call("ping")
+        except (OSError, ApplicationError):
+            return None
+        return client
+
+    def call(self, method: str, **params):
+        """
+        Call a method and return its result. Errors returned by the daemon are
+        raised as ApplicationError; connection errors as OSError.
+        """
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(str(self.socket_path))
+            request = {"method": method, "params": params}
+            sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            with sock.makefile("rb") as f:
+                line = f.readline()
+        if not line:
+            raise ApplicationError("vmlightd closed the connection.")
+        response = json.loads(line)
+        if not response["ok"]:
+            raise ApplicationError(response["error"])
+        return response["result"]
+
+    def wait_for_job(self, job):
+        """
+        Print the output of a job as it runs, and raise if it fails.
+        """
+        offset = 0
+        try:
+            while True:
+                job = self.call("job.get", id=job["id"], offset=offset)
+                print(job["output"], end="", flush=True)
+                offset = job["offset"]
+                if job["state"] not in ["queued", "running"]:
+                    break
+                time.sleep(JOB_POLL_INTERVAL)
+        except KeyboardInterrupt:
+            print(f"Job {job['id']} keeps running in vmlightd.")
+            raise
+        if job["error"]:
+            raise ApplicationError(job["error"])
+
+    def run_command(self, args):
+        """
+        Run a command through the daemon. Returns False for commands the
+        daemon does not handle, which run locally instead.
+        """
+        if args.command == "vm":
+            operation = next(
+                (op for op in OPERATIONS if getattr(args, op) is not None), None
+            )
+            if args.list:
+                print_instances(self.call("vm.list"))
+            elif operation:
+                job = self.call(
+                    f"vm.{operation}",
+                    ids=getattr(args, operation),
+                    all=args.all,
+                    image=args.image,
+                    name_glob=args.name_glob,
+                    wait=args.wait,
+                    timeout=args.timeout,
+                    force=args.force,
+                    jobs=args.jobs,
+                )
+                self.wait_for_job(job)
+            else:
+                return False
+        elif args.command == "image" and args.list:
+            print_catalog(self.call("image.list"))
+        elif args.command == "ssh-keys" and args.list:
+            print_keys(**self.call("ssh-keys.list"))
+        elif args.command == "deploy" and not args.interactive:
+            deploy_args = {k: v for k, v in vars(args).items() if k not in CLI_ARGS}
+            if deploy_args["manifest"]:
+                deploy_args["manifest"] = str(Path(deploy_args["manifest"]).absolute())
+            self.wait_for_job(self.call("deploy", args=deploy_args))
+        else:
+            return False
+        return True
@@ -0,0 +1,135 @@
+import errno
+import fcntl
+import os
+import time
+from pathlib import Path
+
+from .utils import ApplicationError
+
+# ioctl number of FICLONE from linux/fs.h
+FICLONE = 0x40049409
+BUFFER_SIZE = 8 * 1024 * 1024
+
+# Errors meaning a strategy is not available for these files, so the next
+# one should be tried
+UNSUPPORTED_ERRORS = {
+    errno.EOPNOTSUPP,
+    errno.ENOTTY,
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.EBADF,
+}
+
+
+class CloneResult:
+    def __init__(self, strategy, size, bytes_copied, duration):
+        self.strategy = strategy
+        self.size = size
+        self.bytes_copied = bytes_copied
+        self.duration = duration
+
+    def __str__(self):
+        return (
+            f"{self.strategy}, {self.bytes_copied / 2**20:.0f}M of "
+            f"{self.size / 2**20:.0f}M copied in {self.duration:.2f}s"
+        )
+
+
+def _data_segments(fd, size):
+    """
+    Yield the (start, end) ranges of a file that hold data, skipping holes.
+    The whole file is one range if the filesystem cannot report holes.
+    """
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+            end = os.lseek(fd, start, os.SEEK_HOLE)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                return  # Only a hole is left
+            if e.errno in UNSUPPORTED_ERRORS and offset == 0:
+                yield 0, size
+                return
+            raise
+        yield start, min(end, size)
+        offset = end
+
+
+def _clone_reflink(src_fd, dst_fd, size):
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    return 0  # Blocks are shared, nothing is copied
+
+
+def _clone_copy_range(src_fd, dst_fd, size):
+    copied = 0
+    for start, end in _data_segments(src_fd, size):
+        offset = start
+        while offset < end:
+            count = os.copy_file_range(
+                src_fd, dst_fd, end - offset, offset_src=offset, offset_dst=offset
+            )
+            if count == 0:
+                break
+            offset += count
+            copied += count
+    os.ftruncate(dst_fd, size)
+    return copied
+
+
+def _clone_buffer(src_fd, dst_fd, size):
+    copied = 0
+    for start, end in _data_segments(src_fd, size):
+        offset = start
+        while offset < end:
+            chunk = os.pread(src_fd, min(BUFFER_SIZE, end - offset), offset)
+            if not chunk:
+                break
+            if chunk.count(0) != len(chunk):  # Keep zeroed blocks sparse
+                os.pwrite(dst_fd, chunk, offset)
+                copied += len(chunk)
+            offset += len(chunk)
+    os.ftruncate(dst_fd, size)
+    return copied
+
+
+STRATEGIES = {
+    "reflink": _clone_reflink,
+    "copy_file_range": _clone_copy_range,
+    "buffer": _clone_buffer,
+}
+
+
+def clone_file(src: Path, dst: Path, strategies=None) -> CloneResult:
+    """
+    Copy a file as cheaply as the filesystem allows, trying in order a
+    reflink (FICLONE), copy_file_range over the data ranges of the file, and
+    a buffered copy that skips holes and zeroed blocks. The destination is
+    sparse wherever the source is.
+    """
+    strategies = strategies or list(STRATEGIES)
+    start = time.monotonic()
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        size = os.fstat(src_fd).st_size
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            for strategy in strategies:
+                if strategy == "copy_file_range" and not hasattr(os, strategy):
+                    continue  # Python built without it
+                try:
+                    copied = STRATEGIES[strategy](src_fd, dst_fd, size)
+                except OSError as e:
+                    if e.errno not in UNSUPPORTED_ERRORS:
+                        raise ApplicationError(
+                            f"Error copying {src} to {dst}: {e}"
+                        ) from e
+                    os.ftruncate(dst_fd, 0)
+                    continue
+                return CloneResult(strategy, size, copied, time.monotonic() - start)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    raise ApplicationError(f"No copy strategy worked for {src}")
@@ -0,0 +1,439 @@
+import argparse
+import contextvars
+import inspect
+import io
+import itertools
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+import traceback
+from argparse import Namespace
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .batch import BatchDeployManager
+from .image import ImageManager
+from .operations import OPERATIONS, VmOperations
+from .ssh import SshKeyManager
+from .trace import tracer
+from .utils import ApplicationError, cancel_commands, require_root
+from .vm import VM_BACKEND_HELPERS, VmManager, get_deploy_manager_class
+
+# Seconds the running state of instances is reused before the backends are
+# queried again
+STATE_TTL = 2.0
+# Number of finished jobs kept for status queries
+MAX_FINISHED_JOBS = 100
+
+# Job states
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+_current_job = contextvars.ContextVar("vmlight_current_job", default=None)
+
+
+class _OutputRouter(io.TextIOBase):
+    """
+    Replaces sys.stdout and sys.stderr in the daemon, sending what a job
+    prints to the output of that job and everything else to the stream.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        job = _current_job.get()
+        if job is None:
+            return self.stream.write(text)
+        job.append_output(text)
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def isatty(self):
+        return False
+
+
+class FileCache:
+    """
+    Keeps a value loaded from a file until the file changes.
+    """
+
+    def __init__(self, path: Path, load):
+        self.path = path
+        self.load = load
+        self.key = None
+        self.value = None
+        self._lock = threading.Lock()
+
+    def _get_key(self):
+        try:
+            st = self.path.stat()
+        except FileNotFoundError:
+            return "missing"
+        return (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def get(self):
+        with self._lock:
+            key = self._get_key()  # Before loading, so a change while loading reloads
+            if self.key is None or key != self.key:
+                self.value = self.load()
+                self.key = key
+            return self.value
+
+
+class Job:
+    """
+    A long operation run by the daemon, with the output it printed.
+    """
+
+    def __init__(self, job_id: str, kind: str, description: str):
+        self.id = job_id
+        self.kind = kind
+        self.description = description
+        self.state = QUEUED
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self._output = []
+        self._lock = threading.Lock()
+
+    def append_output(self, text: str):
+        with self._lock:
+            self._output.append(text)
+
+    def get_output(self, offset=0):
+        with self._lock:
+            return "".join(self._output)[offset:]
+
+    def to_dict(self, offset=0):
+        output = self.get_output(offset)
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "description": self.description,
+            "state": self.state,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "output": output,
+            "offset": offset + len(output),
+        }
+
+
+class VmlightDaemon:
+    """
+    Serves the VM, image, SSH key and deploy operations over a JSON API on a
+    Unix socket. The config is read once, the inventory, image index and SSH
+    key store are kept in memory until their files change, and the running
+    state of instances is kept up to date from backend events where the
+    backend supports it, and reused for STATE_TTL seconds otherwise, so that
+    repeated queries cost no process start, directory scan or backend query.
+
+    Requests and responses are single lines of JSON:
+
+        {"method": "vm.list", "params": {}}
+        {"ok": true, "result": [...]}
+        {"ok": false, "error": "VM with ID 7 not found"}
+
+    Long operations (deploy, vm.start/stop/restart, image.add) return a job,
+    whose state and output are polled with job.get.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.vm_manager = VmManager(config)
+        image_dir = Path(config["general"]["image_dir"]).absolute()
+        self.instances = FileCache(
+            self.vm_manager.inventory.db_file, lambda: self.vm_manager.instances
+        )
+        self.images = FileCache(image_dir / "index.json", lambda: ImageManager(config))
+        self.ssh_keys = FileCache(
+            Path(config["deploy"]["ssh_key_list_file"]), lambda: SshKeyManager(config)
+        )
+        self.jobs = OrderedDict()
+        self._job_ids = itertools.count(1)
+        self._jobs_lock = threading.Lock()
+        jobs = config["deploy"]["jobs"]
+        if not jobs.isdigit() or int(jobs) < 1:
+            raise ApplicationError(f"Invalid number of deploy jobs: {jobs}")
+        self._executor = ThreadPoolExecutor(
+            max_workers=int(jobs), thread_name_prefix="job"
+        )
+        self._state_time = 0.0
+        self._state_lock = threading.Lock()
+        for helper_class in set(VM_BACKEND_HELPERS.values()):
+            if helper_class.start_state_tracking(config):
+                print(f"Tracking state with {helper_class.__name__} events")
+        self.methods = {
+            "ping": self.ping,
+            "vm.list": self.list_vms,
+            "vm.start": self.operate_vms,
+            "vm.stop": self.operate_vms,
+            "vm.restart": self.operate_vms,
+            "image.list": self.list_images,
+            "image.add": self.add_image,
+            "image.remove": self.remove_image,
+            "ssh-keys.list": self.list_ssh_keys,
+            "ssh-keys.add": self.add_ssh_key,
+            "ssh-keys.remove": self.remove_ssh_key,
+            "deploy": self.deploy,
+            "job.get": self.get_job,
+            "job.list": self.list_jobs,
+        }
+
+    def handle(self, request):
+        """
+        Run the method of a request and get the response.
+        """
+        if not isinstance(request, dict):
+            return {"ok": False, "error": "Invalid request"}
+        if not isinstance(request.get("params", {}), dict):
+            return {"ok": False, "error": "Invalid request parameters"}
+        method = self.methods.get(request.get("method"))
+        if method is None:
+            return {"ok": False, "error": f"Unknown method: {request.get('method')}"}
+        params = dict(request.get("params", {}))
+        if method == self.operate_vms:
+            params["operation"] = request["method"].split(".", 1)[1]
+        try:
+            inspect.signature(method).bind(**params)
+        except TypeError as e:
+            return {"ok": False, "error": f"Invalid parameters: {e}"}
+        try:
+            return {"ok": True, "result": method(**params)}
+        except ApplicationError as e:
+            return {"ok": False, "error": e.message}
+        except Exception as e:
+            traceback.print_exc()
+            return {"ok": False, "error": f"Internal error: {e!r}"}
+
+    def _refresh_state(self, force=False):
+        """
+        Make the backends query the running state again if it is older than
+        STATE_TTL.
+        """
+        with self._state_lock:
+            if force or time.monotonic() - self._state_time > STATE_TTL:
+                for helper_class in set(VM_BACKEND_HELPERS.values()):
+                    helper_class.refresh_state(self.config)
+                self._state_time = time.monotonic()
+
+    def _submit(self, kind: str, description: str, run, refresh_state=False):
+        """
+        Queue a job and return its status.
+        """
+        with self._jobs_lock:
+            job = Job(str(next(self._job_ids)), kind, description)
+            self.jobs[job.id] = job
+            finished = [j for j in self.jobs.values() if j.finished]
+            for old in finished[: max(0, len(finished) - MAX_FINISHED_JOBS)]:
+                del self.jobs[old.id]
+
+        def run_job():
+            _current_job.set(job)
+            job.state = RUNNING
+            job.started = time.time()
+            print(f"Job {job.id}: {description}", file=sys.__stdout__, flush=True)
+            try:
+                run()
+                job.state = SUCCEEDED
+            except ApplicationError as e:
+                job.error = e.message
+                job.state = FAILED
+            except Exception as e:
+                traceback.print_exc(file=sys.__stderr__)
+                job.error = f"Internal error: {e!r}"
+                job.state = FAILED
+            finally:
+                job.finished = time.time()
+                if refresh_state:
+                    self._refresh_state(force=True)
+            print(f"Job {job.id} {job.state}", file=sys.__stdout__, flush=True)
+
+        # Each job runs in a context of its own, so its output goes to it
+        self._executor.submit(contextvars.Context().run, run_job)
+        return job.to_dict()
+
+    def ping(self):
+        return {"pid": os.getpid(), "jobs": len(self.jobs)}
+
+    def list_vms(self):
+        self._refresh_state()
+        return self.vm_manager.get_instance_states(self.instances.get())
+
+    def operate_vms(
+        self,
+        operation,
+        ids=(),
+        all=False,
+        image=None,
+        name_glob=None,
+        wait=False,
+        timeout=300,
+        force=False,
+        jobs=8,
+    ):
+        if operation not in OPERATIONS:
+            raise ApplicationError(f"Unknown operation: {operation}")
+        operations = VmOperations(
+            self.vm_manager, jobs=jobs, wait=wait or force, timeout=timeout, force=force
+        )
+        vms = operations.select(ids, all, image, name_glob)
+        description = f"{operation} {', '.join(vm.id for vm in vms)}"
+        return self._submit(
+            f"vm.{operation}",
+            description,
+            lambda: operations.run(operation, vms),
+            refresh_state=True,
+        )
+
+    def list_images(self):
+        return self.images.get().get_catalog()
+
+    def add_image(self, source, name=None, network_config=None):
+        image_manager = ImageManager(self.config)
+        return self._submit(
+            "image.add",
+            f"add image {source}",
+            lambda: image_manager.add(source, name, network_config),
+        )
+
+    def remove_image(self, name):
+        ImageManager(self.config).remove(name)
+
+    def list_ssh_keys(self):
+        key_manager = self.ssh_keys.get()
+        return {"keys": key_manager.get_keys(), "groups": key_manager.get_groups()}
+
+    def add_ssh_key(self, key):
+        SshKeyManager(self.config).add_key(key)
+
+    def remove_ssh_key(self, name):
+        SshKeyManager(self.config).remove_key(name)
+
+    def deploy(self, args):
+        args = Namespace(**args)
+        if getattr(args, "interactive", False):
+            raise ApplicationError("Interactive deploys cannot run in vmlightd.")
+        deploy_manager_class = get_deploy_manager_class(args.type)
+        if args.manifest:
+            description = f"deploy {args.manifest}"
+            manager = BatchDeployManager(args, self.config, deploy_manager_class)
+        else:
+            description = f"deploy {args.name} from {args.image}"
+            manager = deploy_manager_class(args, self.config)
+        return self._submit("deploy", description, manager.deploy, refresh_state=True)
+
+    def get_job(self, id, offset=0):
+        job = self.jobs.get(str(id))
+        if job is None:
+            raise ApplicationError(f"Job {id} not found")
+        return job.to_dict(int(offset))
+
+    def list_jobs(self):
+        return [
+            {k: v for k, v in job.to_dict().items() if k != "output"}
+            for job in list(self.jobs.values())
+        ]
+
+    def serve(self, socket_path: Path):
+        """
+        Serve requests on a Unix socket until terminated.
+        """
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        request = json.loads(line)
+                    except ValueError:
+                        response = {"ok": False, "error": "Invalid JSON"}
+                    else:
+                        response = daemon.handle(request)
+                    self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+        _remove_stale_socket(socket_path)
+        socket_path.parent.mkdir(parents=True, exist_ok=True)
+        umask = os.umask(0o177)  # Only root may connect
+        try:
+            server = socketserver.ThreadingUnixStreamServer(str(socket_path), Handler)
+        finally:
+            os.umask(umask)
+        server.daemon_threads = True
+        print(f"Listening on {socket_path}", flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            socket_path.unlink(missing_ok=True)
+            running = [j for j in self.jobs.values() if j.state == RUNNING]
+            if running:
+                print(f"Waiting for {len(running)} running jobs...", flush=True)
+            self._executor.shutdown(wait=True)
+
+
+def _remove_stale_socket(socket_path: Path):
+    """
+    Remove the socket of a daemon that is gone, refusing to start if another
+    daemon still listens on it.
+    """
+    if not socket_path.exists():
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(socket_path))
+    except (ConnectionRefusedError, FileNotFoundError):
+        socket_path.unlink(missing_ok=True)
+    else:
+        raise ApplicationError(f"vmlightd is already running on {socket_path}")
+    finally:
+        sock.close()
+
+
+def main():
+    from .__main__ import get_config
+
+    config = get_config()
+    parser = argparse.ArgumentParser(
+        prog="vmlightd", description="Serve vmlight operations on a Unix socket."
+    )
+    parser.add_argument(
+        "--socket",
+        metavar="PATH",
+        default=config["general"]["socket_path"],
+        help="Path of the socket to listen on",
+    )
+    args = parser.parse_args()
+    require_root()
+    tracer.recording = False  # Nothing reads the spans of a daemon
+
+    def terminate(signum, frame):
+        cancel_commands()
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, terminate)
+    sys.stdout = _OutputRouter(sys.stdout)
+    sys.stderr = _OutputRouter(sys.stderr)
+    try:
+        VmlightDaemon(config).serve(Path(args.socket))
+    except ApplicationError as e:
+        print(f"{parser.prog}: error: {e.message}", file=sys.__stderr__)
+        sys.exit(1)
@@ -1,8 +1,17 @@
+import time
 from .utils import ApplicationError
 from pathlib import Path
 
-from .image import ImageManager
-from .ssh import SshKeyManager
+from .guest import GuestManifest, NoCloudEditor, get_guest_editor
+from .image import BACKING_IMAGE_FILE, ImageManager, get_image_format
+from .allocator import Allocator
+from .inventory import DEPLOYED, Inventory
+from .ssh import AuthorizedKeys, SshKeyManager, parse_key_target
+from .clone import clone_file
+from .pipeline import Pipeline, Stage
+from .pool import InstancePool
+from .trace import tracer
+from .templates import GuestInterface, get_network_renderer
 from .utils import sh
 
 
@@ -13,6 +22,11 @@ class DeployManager:
     that inherits from this class.
     """
 
+    # Instance type recorded in the inventory
+    vm_type = None
+    # Name of the network interface inside the guest
+    guest_interface = None
+
     def __init__(self, args, config):
         """
         Initialize the deploy manager.
@@ -23,28 +37,23 @@ class DeployManager:
         self.instances_dir.mkdir(parents=True, exist_ok=True)
         self.image_dir = Path(self.config["general"]["image_dir"]).absolute()
         self.image_dir.mkdir(parents=True, exist_ok=True)
+        self.image_manager = ImageManager(config)
+        self.inventory = Inventory(config)
+        self.allocator = Allocator(config)
+        self.guest_manifest = GuestManifest()
+        self.timings = {}
+        self.log_prefix = ""
+        self._allocated = False
+        self._reserved = False
+        self._instance_dir_created = False
+        self._disk_from_pool = False
+        self.vm_id = None  # Allocated when the instance directory is created
         self._setup_instance_paths()
 
     def _setup_instance_paths(self):
         self.instance_name = self.args["name"]
-        self.vm_id = self.get_available_vm_id()
         self.instance_dir = self.instances_dir / f"{self.vm_id}-{self.instance_name}"
         self.disk_file = self.instance_dir / self._get_disk_file_name()
-        self.mount_point = self.instance_dir / "mnt"
-
-    def get_available_vm_id(self):
-        """
-        Get the next available VM ID.
-        """
-        vm_ids = [int(p.name.split("-")[0]) for p in self.instances_dir.glob("*")]
-        if not vm_ids:
-            return 1
-        # Sort the vm_ids and find the first missing number
-        vm_ids.sort()
-        for i in range(1, len(vm_ids) + 1):
-            if i != vm_ids[i - 1]:
-                return i
-        return len(vm_ids) + 1
 
     def interactive_deploy(self):
         """
@@ -57,17 +66,18 @@ class DeployManager:
 
         # Handle image selection from available images
         if not self.args.get("image"):
-            image_manager = ImageManager(self.config)
-            if not image_manager.images:
+            if not self.image_manager.images:
                 raise ApplicationError("No images available.")
             print("Available images:")
-            image_manager.list()
+            self.image_manager.list()
             image_choice = int(input("Please select an image by number: ")) - 1
-            self.args["image"] = image_manager.images[image_choice].stem
+            self.args["image"] = self.image_manager.images[image_choice].stem
 
         # Handle IP address
         if not self.args.get("ip"):
-            self.args["ip"] = input("Please give the instance an IP address: ")
+            self.args["ip"] = input(
+                "Please give the instance an IP address (or press Enter to allocate one): "
+            )
 
         # Handle SSH key selection from available keys
         if not self.args.get("ssh_key"):
@@ -82,7 +92,7 @@ class DeployManager:
                     )
                     if key_choice:
                         key_choice = int(key_choice) - 1
-                        self.args["ssh_key"].append(ssh_key_manager.keys[key_choice][2])
+                        self.args["ssh_key"].append(ssh_key_manager.keys[key_choice].name)
                     else:
                         break
             else:
@@ -114,101 +124,243 @@ class DeployManager:
 
         self.deploy()
 
+    def log(self, message: str):
+        """
+        Print a progress message for this deployment.
+        """
+        print(f"{self.log_prefix}{message}")
+
+    def get_deploy_stages(self):
+        """
+        Get the stages of a deployment and their dependencies.
+        Stages that do not depend on each other run concurrently.
+        """
+        # A NoCloud seed is written next to the disk, so it need not wait for it
+        disk_stage = "create_instance_dir" if self.uses_seed() else "resize_disk"
+        return [
+            Stage(
+                "create_instance_dir",
+                "Creating instance directory",
+                self.create_instance_dir,
+                rollback=self.cleanup,
+            ),
+            Stage("copy_image", "Copying image", self.copy_image, ["create_instance_dir"]),
+            Stage("resize_disk", "Resizing disk", self.resize_disk, ["copy_image"]),
+            Stage(
+                "create_instance_config",
+                "Creating instance configuration",
+                self.create_instance_config,
+                ["create_instance_dir"],
+                rollback=self.remove_instance_config,
+            ),
+            Stage(
+                "enable_instance_autostart",
+                "Enabling instance autostart",
+                self.enable_instance_autostart,
+                ["create_instance_config"],
+                rollback=self.disable_instance_autostart,
+            ),
+            Stage(
+                "deploy_network_config",
+                "Preparing network configuration",
+                self.deploy_network_config,
+                ["create_instance_dir"],  # The IP address is allocated there
+            ),
+            Stage("deploy_ssh_keys", "Preparing SSH keys", self.deploy_ssh_keys),
+            Stage(
+                "set_instance_hostname",
+                "Preparing instance hostname",
+                self.set_instance_hostname,
+            ),
+            Stage(
+                "apply_guest_manifest",
+                "Writing guest files",
+                self.apply_guest_manifest,
+                [
+                    disk_stage,
+                    "deploy_network_config",
+                    "deploy_ssh_keys",
+                    "set_instance_hostname",
+                ],
+            ),
+        ]
+
     def deploy(self):
         """
         Deploy the instance.
         """
+        pipeline = Pipeline(self.get_deploy_stages(), log=self.log)
+        start = time.monotonic()
+        ok = False
         try:
-            print(f"Deploying instance as '{self.vm_id}-{self.instance_name}'")
-            print("Creating instance directory...")
-            self.create_instance_dir()
-            print("Copying image...")
-            self.copy_image()
-            print("Resizing disk...")
-            self.resize_disk()
-            print("Creating instance configuration...")
-            self.create_instance_config()
-            print("Enabling instance autostart...")
-            self.enable_instance_autostart()
-            print("Mounting disk...")
-            self.mount_disk()
-            print("Deploying network configuration...")
-            self.deploy_network_config()
-            print("Deploying SSH keys...")
-            self.deploy_ssh_keys()
-            print("Setting instance hostname...")
-            self.set_instance_hostname()
-            print("Umounting disk...")
-            self.umount_disk()
-            print("Deployment complete!")
-        except Exception as e:
-            print("An error occurred during deployment, cleaning up...")
-            self.umount_disk()
-            self.cleanup_backend_specific()
-            self.cleanup()
-            raise e
+            with tracer.span("deploy", instance=self.instance_name):
+                pipeline.run()
+            self.inventory.update(self.vm_id, state=DEPLOYED)
+            ok = True
+            self.log(f"Deployed instance as '{self.vm_id}-{self.instance_name}'")
+            self.log("Deployment complete!")
+        except Exception:
+            self.log("An error occurred during deployment, rolled back.")
+            raise
+        finally:
+            self.timings = {n: t.duration for n, t in pipeline.timings.items()}
+            try:
+                self.inventory.record_deploy(self.vm_type, time.monotonic() - start, ok)
+            except ApplicationError as e:
+                self.log(f"Could not record the deploy duration: {e.message}")
 
     def create_instance_dir(self):
         """
-        Create the instance directory.
+        Allocate a VM ID and IP address and create the instance directory.
+        The VM ID and IP address are reserved with the allocator, so that
+        concurrent deploys do not pick the same ones.
         """
-        self.instance_dir.mkdir(parents=True, exist_ok=True)
+        self.vm_id, self.args["ip"] = self.allocator.allocate(self.args.get("ip"))
+        self._allocated = True
+        self._setup_instance_paths()
+        self.inventory.add(
+            self.vm_id,
+            name=self.instance_name,
+            type=self.vm_type,
+            image=self.args["image"],
+            linked_clone=int(bool(self.args.get("linked_clone"))),
+            ip=self.args["ip"],
+            memory=self.args["memory"],
+            vcpus=self.args["vcpus"],
+            disk_size=self.args["disk_size"],
+            disk_file=str(self.disk_file),
+        )
+        self._reserved = True
+        self.instance_dir.mkdir(parents=True)
+        self._instance_dir_created = True
 
     def copy_image(self):
         """
         Copy the image to the instance directory, converting to qcow2 if necessary.
         """
-        image_manager = ImageManager(self.config)
-        src_file = image_manager.get_path_by_name(self.args["image"])
+        src_file = self.image_manager.get_path_by_name(self.args["image"])
         dst_file = self.disk_file
 
-        if src_file.suffix == ".img" and dst_file.suffix != ".qcow2":
-            sh(f"qemu-img convert -O qcow2 {src_file} {dst_file}")
+        if self.claim_pool_disk():
+            return
+        if self.args.get("linked_clone"):
+            self.create_overlay(src_file)
+        elif src_file.suffix == ".img" and dst_file.suffix != ".qcow2":
+            sh(["qemu-img", "convert", "-O", "qcow2", src_file, dst_file])
         elif src_file.suffix == ".qcow2" and dst_file.suffix == ".img":
-            sh(f"qemu-img convert -O raw {src_file} {dst_file}")
+            sh(["qemu-img", "convert", "-O", "raw", src_file, dst_file])
         elif src_file.suffix == dst_file.suffix:
-            sh(f"cp {src_file} {dst_file}")
+            result = clone_file(src_file, dst_file)
+            self.log(f"  Cloned image: {result}")
         else:
             raise ApplicationError(f"Unsupported image format: {src_file.suffix}")
 
+    def claim_pool_disk(self):
+        """
+        Take a copied and resized disk from the instance pool, if there is a
+        pool for the image and disk size. Returns True on a pool hit.
+        """
+        if self.args.get("linked_clone") or self.disk_file.suffix != ".qcow2":
+            return False
+        start = time.monotonic()
+        pool = InstancePool(self.config, self.image_manager)
+        self._disk_from_pool = pool.claim(
+            self.args["image"], self.args["disk_size"], self.disk_file
+        )
+        if self._disk_from_pool:
+            self.log(f"  Claimed disk from pool in {time.monotonic() - start:.2f}s")
+        return self._disk_from_pool
+
+    def create_overlay(self, src_file: Path):
+        """
+        Create the disk as a qcow2 overlay backed by an image in the image store.
+        """
+        if self.disk_file.suffix != ".qcow2":
+            raise ApplicationError(
+                f"Linked clones require a qcow2 disk, not {self.disk_file.suffix}"
+            )
+        sh(
+            [
+                "qemu-img", "create", "-f", "qcow2",
+                "-b", src_file, "-F", get_image_format(src_file), self.disk_file,
+            ]
+        )
+        (self.instance_dir / BACKING_IMAGE_FILE).write_text(f"{self.args['image']}\n")
+
     def resize_disk(self):
         """
         Resize the disk to the specified size.
         """
-        sh(f"qemu-img resize {self.disk_file} {self.args['disk_size']}")
+        if self._disk_from_pool:
+            return  # Pool disks are resized when they are prepared
+        sh(["qemu-img", "resize", self.disk_file, self.args["disk_size"]])
+
+    def get_guest_editor_name(self):
+        """
+        Get the name of the guest editor get_guest_editor() returns.
+        """
+        return self.config["deploy"]["guest_editor"]
+
+    def uses_seed(self):
+        """
+        Whether guest files go into a NoCloud seed rather than the disk.
+        """
+        return self.get_guest_editor_name() == NoCloudEditor.name
 
-    def mount_disk(self):
+    def get_seed_file(self):
         """
-        Mount the disk to the mount point.
+        Get the NoCloud seed image to attach to the instance, or None.
         """
-        self.mount_point.mkdir(parents=True, exist_ok=True)
-        sh(f"guestmount -a {self.disk_file} -m /dev/sda1 {self.mount_point}")
+        if not self.uses_seed():
+            return None
+        return self.instance_dir / NoCloudEditor.seed_file_name
+
+    def get_guest_editor(self):
+        """
+        Get the editor that writes guest file changes to the instance disk.
+        """
+        return get_guest_editor(
+            self.get_guest_editor_name(), self.disk_file, self.instance_dir
+        )
 
-    def umount_disk(self):
+    def apply_guest_manifest(self):
         """
-        Umount the disk from the mount point.
+        Write all collected guest file changes to the disk in one pass.
         """
-        sh(f"umount {self.mount_point}", error_ok=True)
-        if self.mount_point.exists():
-            self.mount_point.rmdir()
+        editor = self.get_guest_editor()
+        editor.apply(self.guest_manifest)
+        for phase, seconds in editor.timings.items():
+            self.log(f"  {editor.name} {phase}: {seconds:.2f}s")
 
     def cleanup(self):
         """
-        Cleanup the instance directory.
+        Cleanup the instance directory, its inventory entry and its VM ID
+        and IP address.
         """
-        sh(f"rm -rf {self.instance_dir}")
+        if self._instance_dir_created:
+            sh(["rm", "-rf", self.instance_dir])
+        if self._reserved:
+            self.inventory.remove(self.vm_id)
+        if self._allocated:
+            self.allocator.release(self.vm_id, self.args["ip"])
 
     def deploy_ssh_keys(self):
         """
-        Deploy the SSH keys to the instance.
+        Deploy the SSH keys to the instance. Keys given as KEY:USER go to
+        that user, and the others to root. Each user's authorized_keys is
+        written once, keeping the keys already in the image.
         """
-        guest_key_file = self.mount_point / "root/.ssh/authorized_keys"
-        guest_key_file.parent.mkdir(parents=True, exist_ok=True)
-        guest_key_file.touch(exist_ok=True)
+        references_by_user = {}
+        for text in self.args.get("ssh_key") or []:
+            reference, user = parse_key_target(text)
+            references_by_user.setdefault(user, []).append(reference)
+        if not references_by_user:
+            return
         key_manager = SshKeyManager(self.config)
-        for key_name in self.args["ssh_key"]:
-            key = key_manager.get_key_by_name(key_name, as_text=True)
-            guest_key_file.write_text(key)
+        authorized_keys = AuthorizedKeys()
+        for user, references in references_by_user.items():
+            authorized_keys.add(user, key_manager.resolve(references))
+        self.guest_manifest.add_deferred(authorized_keys)
 
     def _get_disk_file_name(self):
         """
@@ -221,14 +373,32 @@ class DeployManager:
         Set the instance hostname.
         """
         hostname = self.args["name"]
-        with open(self.mount_point / "etc/hostname", "w") as f:
-            f.write(hostname)
+        self.guest_manifest.add_file("/etc/hostname", f"{hostname}\n")
+
+    def get_guest_interfaces(self):
+        """
+        Get the network interfaces of the instance.
+        """
+        return [
+            GuestInterface(
+                self.guest_interface,
+                self.args["ip"],
+                self.config["deploy"]["default_gateway"],
+            )
+        ]
 
     def deploy_network_config(self):
         """
-        Deploy the network configuration to the instance.
+        Deploy the network configuration to the instance, in the format of
+        its image or the configured default.
         """
-        raise NotImplementedError("deploy_network_config")
+        renderer = get_network_renderer(
+            self.image_manager.get_network_config(self.args["image"])
+            or self.config["deploy"]["network_config"]
+        )
+        self.guest_manifest.add_entries(
+            renderer.render(self.config, self.get_guest_interfaces())
+        )
 
     def create_instance_config(self):
         """
@@ -236,14 +406,20 @@ class DeployManager:
         """
         raise NotImplementedError("create_instance_config")
 
+    def remove_instance_config(self):
+        """
+        Remove the instance configuration file.
+        """
+        raise NotImplementedError("remove_instance_config")
+
     def enable_instance_autostart(self):
         """
         Enable the instance autostart.
         """
         raise NotImplementedError("enable_instance_autostart")
 
-    def cleanup_backend_specific(self):
+    def disable_instance_autostart(self):
         """
-        Do backend specific cleanup.
+        Disable the instance autostart.
         """
-        raise NotImplementedError("cleanup_backend_specific")
+        raise NotImplementedError("disable_instance_autostart")
@@ -0,0 +1,251 @@
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from .image import ImageManager
+from .inventory import DEPLOY_DURATION_BUCKETS, DEPLOYING, Inventory
+from .trace import tracer
+from .utils import ApplicationError
+from .vm import VM_BACKEND_HELPERS, Vm
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Per-instance metrics: name, type, key in get_resource_usage(), help text
+INSTANCE_METRICS = [
+    (
+        "vmlight_instance_memory_bytes",
+        "gauge",
+        "memory_bytes",
+        "Memory used by a running instance.",
+    ),
+    ("vmlight_instance_vcpus", "gauge", "vcpus", "vCPUs of a running instance."),
+    (
+        "vmlight_instance_cpu_seconds_total",
+        "counter",
+        "cpu_seconds",
+        "CPU time used by a running instance.",
+    ),
+]
+
+# Per-pool metrics: name, type, key in the pool state, help text
+POOL_METRICS = [
+    ("vmlight_pool_size", "gauge", "size", "Target number of disks in a pool."),
+    ("vmlight_pool_hits_total", "counter", "hits", "Deploys served from a pool."),
+    ("vmlight_pool_misses_total", "counter", "misses", "Deploys that found a pool empty."),
+]
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class MetricsWriter:
+    """
+    Builds a page in the Prometheus text exposition format.
+    """
+
+    def __init__(self):
+        self.lines = []
+
+    def metric(self, name, metric_type, help_text, samples):
+        """
+        Add a metric with its samples, a list of (labels, value) tuples.
+        """
+        self.lines.append(f"# HELP {name} {help_text}")
+        self.lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in samples:
+            self.sample(name, labels, value)
+
+    def sample(self, name, labels, value):
+        if labels:
+            label_text = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+            self.lines.append(f"{name}{{{label_text}}} {value}")
+        else:
+            self.lines.append(f"{name} {value}")
+
+    def text(self):
+        return "\n".join(self.lines) + "\n"
+
+
+class MetricsExporter:
+    """
+    Serves host and instance metrics over HTTP. The metrics are collected
+    by one thread every interval into a single cached page, which is all
+    that requests read. The cost of a refresh is one inventory query and
+    one state query per backend (plus a read of /proc per running KVM
+    instance), and memory is bounded by the size of the latest page.
+    Backends that track their state from events are read from memory, and
+    resync once per interval for the usage counters.
+    """
+
+    def __init__(self, config, interval=15.0):
+        self.config = config
+        self.interval = float(interval)
+        if self.interval <= 0:
+            raise ApplicationError(f"Invalid refresh interval: {interval}")
+        self.inventory = Inventory(config)
+        self.pool_state_file = Path(config["general"]["pool_dir"]) / "pool.json"
+        self.page = ""
+        self._stop = threading.Event()
+
+    def refresh(self):
+        start = time.monotonic()
+        writer = MetricsWriter()
+        try:
+            self._collect_instances(writer)
+            self._collect_images(writer)
+            self._collect_pools(writer)
+            self._collect_deploys(writer)
+            up = 1
+        except Exception as e:  # Keep serving, and tell the scraper
+            print(f"Refreshing metrics failed: {e!r}")
+            up = 0
+        writer.metric(
+            "vmlight_up", "gauge", "Whether the last refresh succeeded.", [({}, up)]
+        )
+        writer.metric(
+            "vmlight_refresh_duration_seconds",
+            "gauge",
+            "Time taken by the last refresh.",
+            [({}, f"{time.monotonic() - start:.6f}")],
+        )
+        writer.metric(
+            "vmlight_refresh_timestamp_seconds",
+            "gauge",
+            "Time of the last refresh.",
+            [({}, f"{time.time():.3f}")],
+        )
+        self.page = writer.text()
+
+    def _collect_instances(self, writer):
+        vms = [Vm.from_inventory(row) for row in self.inventory.list()]
+        for helper_class in set(VM_BACKEND_HELPERS.values()):
+            helper_class.refresh_state(self.config)
+        counts = {}
+        usage = []
+        for vm in vms:
+            if vm.state == DEPLOYING:
+                state = "deploying"
+            else:
+                helper = VM_BACKEND_HELPERS[vm.type](vm, self.config)
+                running = helper.is_running()
+                state = "running" if running else "stopped"
+                resources = helper.get_resource_usage() if running else None
+                if resources:
+                    usage.append((vm, resources))
+            key = (vm.type.value, state)
+            counts[key] = counts.get(key, 0) + 1
+
+        writer.metric(
+            "vmlight_instances",
+            "gauge",
+            "Number of instances by type and state.",
+            [({"type": t, "state": s}, n) for (t, s), n in sorted(counts.items())],
+        )
+        for name, metric_type, key, help_text in INSTANCE_METRICS:
+            writer.metric(
+                name,
+                metric_type,
+                help_text,
+                [
+                    ({"id": vm.id, "name": vm.name, "type": vm.type.value}, r[key])
+                    for vm, r in usage
+                ],
+            )
+
+    def _collect_images(self, writer):
+        image_manager = ImageManager(self.config)
+        store_bytes = 0
+        if image_manager.blob_dir.exists():
+            with os.scandir(image_manager.blob_dir) as entries:
+                for entry in entries:
+                    if entry.is_file(follow_symlinks=False):
+                        store_bytes += entry.stat(follow_symlinks=False).st_blocks * 512
+        writer.metric(
+            "vmlight_images",
+            "gauge",
+            "Number of images.",
+            [({}, len(image_manager.index))],
+        )
+        writer.metric(
+            "vmlight_image_store_bytes",
+            "gauge",
+            "Disk space used by the image store.",
+            [({}, store_bytes)],
+        )
+
+    def _collect_pools(self, writer):
+        state = {}
+        if self.pool_state_file.exists():
+            state = json.loads(self.pool_state_file.read_text())
+        for name, metric_type, key, help_text in POOL_METRICS:
+            writer.metric(
+                name,
+                metric_type,
+                help_text,
+                [
+                    ({"image": e["image"], "disk_size": e["disk_size"]}, e[key])
+                    for e in state.values()
+                ],
+            )
+
+    def _collect_deploys(self, writer):
+        name = "vmlight_deploy_duration_seconds"
+        writer.metric(name, "histogram", "Duration of deploys.", [])
+        for histogram in self.inventory.get_deploy_durations():
+            labels = {"type": histogram["type"], "result": histogram["result"]}
+            cumulative = 0
+            for bound, count in zip(DEPLOY_DURATION_BUCKETS, histogram["buckets"]):
+                cumulative += count
+                writer.sample(f"{name}_bucket", {**labels, "le": bound}, cumulative)
+            writer.sample(f"{name}_bucket", {**labels, "le": "+Inf"}, histogram["count"])
+            writer.sample(f"{name}_sum", labels, f"{histogram['sum']:.3f}")
+            writer.sample(f"{name}_count", labels, histogram["count"])
+
+    def _refresh_loop(self):
+        while not self._stop.wait(self.interval):
+            self.refresh()
+
+    def serve(self, address: str, port: int):
+        """
+        Serve /metrics until interrupted.
+        """
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = exporter.page.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        # Every refresh runs commands, whose spans would pile up unread
+        tracer.recording = False
+        for helper_class in set(VM_BACKEND_HELPERS.values()):
+            helper_class.start_state_tracking(self.config, self.interval)
+        self.refresh()
+        thread = threading.Thread(target=self._refresh_loop, daemon=True)
+        thread.start()
+        try:
+            server = ThreadingHTTPServer((address, port), Handler)
+        except OSError as e:
+            raise ApplicationError(f"Cannot listen on {address}:{port}: {e}") from e
+        print(f"Serving metrics on http://{address}:{port}/metrics")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._stop.set()
+            server.server_close()
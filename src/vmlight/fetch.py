@@ -0,0 +1,181 @@
+import hashlib
+import json
+import lzma
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from pathlib import Path
+
+from .utils import ApplicationError
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CHUNK_SIZE = 4 * 1024 * 1024
+COMPRESSION_SUFFIXES = [".xz", ".zst"]
+
+
+def is_url(source: str):
+    return urllib.parse.urlparse(source).scheme in ["http", "https"]
+
+
+def _get_source_path(source: str):
+    """
+    Get the path of a local file or URL, leaving out the query of a URL.
+    """
+    if is_url(source):
+        return Path(urllib.parse.unquote(urllib.parse.urlparse(source).path))
+    return Path(source)
+
+
+def get_compression_suffix(source: str):
+    """
+    Get the compression suffix of a local path or URL, or "" if it has none.
+    """
+    suffix = _get_source_path(source).suffix
+    return suffix if suffix in COMPRESSION_SUFFIXES else ""
+
+
+def get_source_file_name(source: str):
+    """
+    Get the file name of a local path or URL, without compression suffix.
+    """
+    path = Path(_get_source_path(source).name)
+    if path.suffix in COMPRESSION_SUFFIXES:
+        path = path.with_suffix("")
+    return path.name
+
+
+def _get_decompressor(suffix: str):
+    """
+    Get a function that decompresses the next chunk of a stream, or None for
+    uncompressed files.
+    """
+    if suffix == ".xz":
+        return lzma.LZMADecompressor().decompress
+    if suffix == ".zst":
+        if zstandard is None:
+            raise ApplicationError(
+                "Decompressing .zst images requires the zstandard Python module."
+            )
+        return zstandard.ZstdDecompressor().decompressobj().decompress
+    return None
+
+
+class Progress:
+    """
+    Prints the progress of a transfer on one line, at most once per second,
+    when the output is a terminal.
+    """
+
+    def __init__(self, label: str, total=None, done=0):
+        self.label = label
+        self.total = total
+        self.done = done
+        self.start = time.monotonic()
+        self.start_done = done
+        self.last = 0.0
+        self.enabled = sys.stdout.isatty()
+
+    def update(self, size: int):
+        self.done += size
+        now = time.monotonic()
+        if self.enabled and now - self.last >= 1.0:
+            self.last = now
+            self._print(now)
+
+    def finish(self):
+        if self.enabled:
+            self._print(time.monotonic())
+            print()
+
+    def _print(self, now):
+        rate = (self.done - self.start_done) / max(now - self.start, 1e-6)
+        done = f"{self.done / 2**20:.0f}M"
+        if self.total:
+            done += f" / {self.total / 2**20:.0f}M ({self.done * 100 // self.total}%)"
+        print(f"\r{self.label}: {done} at {rate / 2**20:.1f}M/s", end="", flush=True)
+
+
+def download(url: str, part_file: Path):
+    """
+    Download a URL to part_file, resuming a previous partial download of the
+    same resource. The ETag or Last-Modified header of the resource is kept
+    next to the partial file, and sent with If-Range so that a changed
+    resource is downloaded from the start again.
+    """
+    meta_file = part_file.with_name(f"{part_file.name}.json")
+    meta = {}
+    if part_file.exists() and meta_file.exists():
+        meta = json.loads(meta_file.read_text())
+        if meta.get("url") != url:
+            meta = {}
+    offset = part_file.stat().st_size if meta else 0
+    request = urllib.request.Request(url)
+    if offset and meta.get("validator"):
+        request.add_header("Range", f"bytes={offset}-")
+        request.add_header("If-Range", meta["validator"])
+    else:
+        offset = 0
+    try:
+        response = urllib.request.urlopen(request, timeout=60)
+    except urllib.error.HTTPError as e:
+        if e.code == 416 and offset:
+            return  # The partial file is already complete
+        raise ApplicationError(f"Error downloading {url}: {e}") from e
+    except urllib.error.URLError as e:
+        raise ApplicationError(f"Error downloading {url}: {e.reason}") from e
+    with response:
+        if response.status != 206:
+            offset = 0  # Resource changed or ranges not supported, start over
+        validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+        meta_file.write_text(json.dumps({"url": url, "validator": validator}))
+        length = response.headers.get("Content-Length")
+        total = offset + int(length) if length else None
+        progress = Progress(f"Downloading {get_source_file_name(url)}", total, offset)
+        if offset:
+            print(f"Resuming download of {url} at {offset / 2**20:.0f}M")
+        with open(part_file, "ab" if offset else "wb") as f:
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+                progress.update(len(chunk))
+        progress.finish()
+        if total is not None and part_file.stat().st_size != total:
+            raise ApplicationError(f"Download of {url} ended early, run again to resume.")
+
+
+def unpack(src_file: Path, dst_file: Path, suffix: str):
+    """
+    Copy src_file to dst_file, decompressing it according to suffix, and
+    hashing the output in the same pass. Returns the sha256 digest of
+    dst_file.
+    """
+    decompress = _get_decompressor(suffix)
+    digest = hashlib.sha256()
+    progress = Progress(f"Unpacking {dst_file.name}", src_file.stat().st_size)
+    try:
+        with open(src_file, "rb") as src, open(dst_file, "wb") as dst:
+            while True:
+                chunk = src.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                progress.update(len(chunk))
+                if decompress:
+                    chunk = decompress(chunk)
+                digest.update(chunk)
+                dst.write(chunk)
+    except (lzma.LZMAError, OSError) as e:
+        raise ApplicationError(f"Error unpacking {src_file}: {e}") from e
+    except Exception as e:
+        if zstandard is not None and isinstance(e, zstandard.ZstdError):
+            raise ApplicationError(f"Error unpacking {src_file}: {e}") from e
+        raise
+    progress.finish()
+    return digest.hexdigest()
@@ -0,0 +1,501 @@
+import base64
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from .image import get_image_format
+from .iso import write_iso
+from .trace import tracer
+from .utils import ApplicationError
+from .utils import CONTROL_TIMEOUT, Command, file_lock, sh
+
+
+class GuestFile:
+    """
+    A file or directory to be created in the guest filesystem.
+    A content of None means the entry is a directory.
+    """
+
+    def __init__(self, path: str, content=None, mode=0o644, owner=(0, 0)):
+        self.path = "/" + path.lstrip("/")
+        self.content = content
+        self.mode = mode
+        self.owner = owner
+
+    def is_dir(self):
+        return self.content is None
+
+
+class GuestManifest:
+    """
+    The set of changes to make to the guest filesystem, collected in memory
+    so that they can be applied in one go.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.deferred = []
+
+    def add_file(self, path: str, content: str, mode=0o644, owner=(0, 0)):
+        """
+        Add a file to the manifest, replacing any earlier entry for the path.
+        """
+        entry = GuestFile(path, content, mode, owner)
+        self.entries[entry.path] = entry
+
+    def add_dir(self, path: str, mode=0o755, owner=(0, 0)):
+        """
+        Add a directory to the manifest.
+        """
+        entry = GuestFile(path, None, mode, owner)
+        self.entries[entry.path] = entry
+
+    def add_entries(self, entries):
+        """
+        Add GuestFile entries to the manifest.
+        """
+        for entry in entries:
+            self.entries[entry.path] = entry
+
+    def add_deferred(self, render):
+        """
+        Add entries that depend on the guest filesystem. When the manifest
+        is applied, render(editor) is called with the guest editor, whose
+        read_files() it can use, and returns a list of GuestFile entries.
+        """
+        self.deferred.append(render)
+
+    def render(self, editor):
+        """
+        Add the entries of all deferred renderers.
+        """
+        for render in self.deferred:
+            self.add_entries(render(editor))
+        self.deferred = []
+
+    def __iter__(self):
+        # Directories first, so files can be created inside them
+        return iter(sorted(self.entries.values(), key=lambda e: not e.is_dir()))
+
+    def __len__(self):
+        return len(self.entries) + len(self.deferred)
+
+
+class GuestEditor:
+    """
+    Applies a GuestManifest to an instance disk without booting it.
+    Should not be instantiated directly, but through get_guest_editor().
+    """
+
+    name = ""
+    required_binaries = []
+
+    def __init__(self, disk_file: Path, work_dir: Path):
+        self.disk_file = disk_file
+        self.work_dir = work_dir
+        self.timings = {}
+        self._read_cache = {}
+        for binary in self.required_binaries:
+            if not shutil.which(binary):
+                raise ApplicationError(
+                    f"Guest editor '{self.name}' requires '{binary}', which is not installed."
+                )
+
+    @contextmanager
+    def _phase(self, name: str):
+        start = time.monotonic()
+        try:
+            with tracer.span(f"{self.name}.{name}"):
+                yield
+        finally:
+            self.timings[name] = time.monotonic() - start
+
+    def apply(self, manifest: GuestManifest):
+        """
+        Apply all entries of the manifest to the guest filesystem.
+        """
+        raise NotImplementedError("apply")
+
+    def read_files(self, paths):
+        """
+        Get the content of files in the guest, as a dict of path to text,
+        or None for files that do not exist. Files are read once per editor,
+        and all paths not read yet are read in one go.
+        """
+        paths = list(paths)
+        missing = [p for p in dict.fromkeys(paths) if p not in self._read_cache]
+        if missing:
+            with self._phase("read"):
+                self._read_cache.update(self._read_files(missing))
+        return {path: self._read_cache.get(path) for path in paths}
+
+    def _read_files(self, paths):
+        raise NotImplementedError("_read_files")
+
+
+def write_manifest(root: Path, manifest: GuestManifest):
+    """
+    Write the manifest into a guest filesystem mounted or unpacked at root.
+    Symlinks in the guest are never followed out of root.
+    """
+    root = root.resolve()
+    for entry in manifest:
+        target = root / entry.path.lstrip("/")
+        directory = (target if entry.is_dir() else target.parent).resolve()
+        if directory != root and root not in directory.parents:
+            raise ApplicationError(f"Guest path {entry.path} points outside the guest.")
+        directory.mkdir(parents=True, exist_ok=True)
+        if entry.is_dir():
+            target = directory
+        else:
+            target = directory / target.name
+            if target.is_symlink():
+                target.unlink()
+            target.write_text(entry.content)
+        os.chmod(target, entry.mode)
+        os.chown(target, entry.owner[0], entry.owner[1])
+
+
+def read_guest_files(root: Path, paths):
+    """
+    Read files from a guest filesystem mounted or unpacked at root. Files
+    that do not exist, or whose symlinks lead out of root, read as None.
+    """
+    root = root.resolve()
+    contents = {}
+    for path in paths:
+        target = (root / path.lstrip("/")).resolve()
+        contents[path] = None
+        if root in target.parents and target.is_file():
+            contents[path] = target.read_text(errors="replace")
+    return contents
+
+
+def _guestfish_quote(text: str):
+    return '"' + text.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+class GuestfishEditor(GuestEditor):
+    """
+    Applies the manifest in a single batched libguestfs session.
+    """
+
+    name = "guestfish"
+    required_binaries = ["guestfish"]
+
+    def __init__(self, disk_file: Path, work_dir: Path):
+        super().__init__(disk_file, work_dir)
+        self._session_pid = None
+
+    def _guestfish(self, mode: str, script_file: Path, quiet=False, error_ok=False):
+        """
+        Run a script in the open session, or else in a session of its own
+        opened with mode.
+        """
+        if self._session_pid:
+            command = ["guestfish", f"--remote={self._session_pid}"]
+        else:
+            command = ["guestfish", mode, *self._drive_args()]
+        Command(command + ["-f", script_file], quiet=quiet).run(error_ok)
+
+    def _drive_args(self):
+        return [
+            f"--format={get_image_format(self.disk_file)}",
+            "-a", self.disk_file, "-m", "/dev/sda1",
+        ]
+
+    @contextmanager
+    def _session(self):
+        """
+        Keep a read-write guestfish session open for the block, in which
+        the read and write scripts run, so that the appliance starts once.
+        """
+        with self._phase("launch"):
+            output = sh(["guestfish", "--listen", "--rw", *self._drive_args()])
+        match = re.search(r"GUESTFISH_PID=(\d+)", output)
+        if match is None:
+            raise ApplicationError(f"Unexpected output of guestfish --listen: {output}")
+        self._session_pid = match.group(1)
+        try:
+            yield
+        finally:
+            sh(["guestfish", f"--remote={self._session_pid}", "exit"], error_ok=True)
+            self._session_pid = None
+
+    def _read_files(self, paths):
+        with tempfile.TemporaryDirectory(dir=self.work_dir) as download_dir:
+            download_dir = Path(download_dir)
+            # A leading "-" lets the session go on past files that do not exist
+            script = [
+                f"-download {_guestfish_quote(path)} "
+                f"{_guestfish_quote(str(download_dir / str(index)))}"
+                for index, path in enumerate(paths)
+            ]
+            script_file = download_dir / "script"
+            script_file.write_text("\n".join(script) + "\n")
+            # Remote sessions report the files that do not exist as errors
+            self._guestfish(
+                "--ro", script_file, quiet=True, error_ok=bool(self._session_pid)
+            )
+            contents = {}
+            for index, path in enumerate(paths):
+                local_file = download_dir / str(index)
+                contents[path] = None
+                if local_file.exists():
+                    contents[path] = local_file.read_text(errors="replace")
+            return contents
+
+    def apply(self, manifest: GuestManifest):
+        if manifest.deferred:
+            # Renderers read the guest, which is done in the session writing it
+            with self._session():
+                self._apply(manifest)
+        else:
+            self._apply(manifest)
+
+    def _apply(self, manifest: GuestManifest):
+        manifest.render(self)
+        with tempfile.TemporaryDirectory(dir=self.work_dir) as staging_dir:
+            staging_dir = Path(staging_dir)
+            with self._phase("prepare"):
+                script = []
+                for index, entry in enumerate(manifest):
+                    path = _guestfish_quote(entry.path)
+                    if entry.is_dir():
+                        script.append(f"mkdir-p {path}")
+                    else:
+                        local_file = staging_dir / str(index)
+                        local_file.write_text(entry.content)
+                        parent = _guestfish_quote(str(Path(entry.path).parent))
+                        script.append(f"mkdir-p {parent}")
+                        script.append(f"upload {_guestfish_quote(str(local_file))} {path}")
+                    script.append(f"chmod {entry.mode:04o} {path}")
+                    script.append(f"chown {entry.owner[0]} {entry.owner[1]} {path}")
+                script_file = staging_dir / "script"
+                script_file.write_text("\n".join(script) + "\n")
+            with self._phase("apply"):
+                self._guestfish("--rw", script_file)
+
+
+class NbdEditor(GuestEditor):
+    """
+    Applies the manifest by exporting the disk with qemu-nbd and mounting its
+    root partition directly on the host. Requires root.
+    """
+
+    name = "nbd"
+    required_binaries = ["qemu-nbd"]
+    lock_file = Path("/run/vmlight/nbd.lock")
+
+    def __init__(self, disk_file: Path, work_dir: Path):
+        super().__init__(disk_file, work_dir)
+        if os.geteuid() != 0:
+            raise ApplicationError(f"Guest editor '{self.name}' requires root.")
+        self.mount_point = self.work_dir / "mnt"
+        self.nbd_device = None
+
+    def _connect(self):
+        sh(["modprobe", "nbd", "max_part=8"], error_ok=True, timeout=CONTROL_TIMEOUT)
+        # Parallel deploys would otherwise pick the same free device
+        with file_lock(self.lock_file):
+            for device in sorted(Path("/sys/block").glob("nbd*")):
+                if (device / "pid").exists():
+                    continue  # Already in use
+                nbd_device = Path("/dev") / device.name
+                try:
+                    sh(
+                        [
+                            "qemu-nbd", f"--connect={nbd_device}",
+                            f"--format={get_image_format(self.disk_file)}",
+                            self.disk_file,
+                        ],
+                        timeout=CONTROL_TIMEOUT,
+                    )
+                except ApplicationError:
+                    continue  # Busy, e.g. taken by a program other than vmlight
+                self.nbd_device = nbd_device
+                return
+        raise ApplicationError("No free NBD device available.")
+
+    def _read_files(self, paths):
+        return read_guest_files(self.mount_point, paths)
+
+    def _wait_for_partition(self, partition: Path, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not partition.exists():
+            if time.monotonic() > deadline:
+                raise ApplicationError(f"Partition {partition} did not appear.")
+            time.sleep(0.1)
+
+    def apply(self, manifest: GuestManifest):
+        mounted = False
+        try:
+            with self._phase("connect"):
+                self._connect()
+                partition = Path(f"{self.nbd_device}p1")
+                self._wait_for_partition(partition)
+            with self._phase("mount"):
+                self.mount_point.mkdir(parents=True, exist_ok=True)
+                sh(["mount", partition, self.mount_point], timeout=CONTROL_TIMEOUT)
+                mounted = True
+            manifest.render(self)
+            with self._phase("write"):
+                write_manifest(self.mount_point, manifest)
+        finally:
+            with self._phase("umount"):
+                if mounted:
+                    sh(
+                        ["umount", self.mount_point],
+                        error_ok=True,
+                        timeout=CONTROL_TIMEOUT,
+                    )
+                if self.mount_point.exists():
+                    self.mount_point.rmdir()
+            with self._phase("disconnect"):
+                if self.nbd_device:
+                    sh(
+                        ["qemu-nbd", "--disconnect", self.nbd_device],
+                        error_ok=True,
+                        timeout=CONTROL_TIMEOUT,
+                    )
+
+
+class DirectoryEditor(GuestEditor):
+    """
+    Applies the manifest to a guest root directory on the host, as used by
+    container backends. disk_file is the root directory.
+    """
+
+    name = "directory"
+
+    def _read_files(self, paths):
+        return read_guest_files(self.disk_file, paths)
+
+    def apply(self, manifest: GuestManifest):
+        manifest.render(self)
+        with self._phase("write"):
+            write_manifest(self.disk_file, manifest)
+
+
+class NoCloudEditor(GuestEditor):
+    """
+    Writes the manifest into a NoCloud seed image next to the disk, for
+    cloud-init in the guest to apply on first boot, instead of into the
+    disk. The disk is never opened, so the cost does not grow with its
+    size, and the instance is given the seed as a second, read-only disk.
+
+    Files become write_files entries of the cloud-config and directories
+    are created by bootcmd. The guest cannot be read before it boots, so
+    deferred renderers that provide cloud_config() add to the cloud-config
+    instead, and files read by the others are missing.
+    """
+
+    name = "nocloud"
+    seed_file_name = "seed.iso"
+    # Volume label that cloud-init looks for
+    seed_label = "cidata"
+    # Commands that make services pick up files written after they started
+    reload_commands = {
+        "/etc/systemd/network/": ["networkctl", "reload"],
+        "/etc/netplan/": ["netplan", "apply"],
+        "/etc/network/interfaces.d/": ["ifup", "-a"],
+    }
+
+    def _read_files(self, paths):
+        return {path: None for path in paths}
+
+    def get_user_data(self, manifest: GuestManifest):
+        cloud_config = {"bootcmd": [], "write_files": [], "runcmd": []}
+        deferred = []
+        for render in manifest.deferred:
+            if hasattr(render, "cloud_config"):
+                for key, value in render.cloud_config().items():
+                    if isinstance(value, list):
+                        cloud_config.setdefault(key, []).extend(value)
+                    else:
+                        cloud_config[key] = value
+            else:
+                deferred.append(render)
+        manifest.deferred = deferred
+        manifest.render(self)
+
+        for entry in manifest:
+            if entry.is_dir():
+                cloud_config["bootcmd"].append(
+                    [
+                        "install", "-d", "-m", f"{entry.mode:04o}",
+                        "-o", str(entry.owner[0]), "-g", str(entry.owner[1]),
+                        entry.path,
+                    ]
+                )
+                continue
+            if entry.owner != (0, 0):
+                # cloud-init sets the owner of written files by name
+                raise ApplicationError(
+                    f"Guest file {entry.path} must be owned by root in a NoCloud seed."
+                )
+            cloud_config["write_files"].append(
+                {
+                    "path": entry.path,
+                    "encoding": "b64",
+                    "content": base64.b64encode(entry.content.encode()).decode(),
+                    "permissions": f"{entry.mode:04o}",
+                }
+            )
+            for prefix, command in self.reload_commands.items():
+                runcmd = cloud_config["runcmd"]
+                if entry.path.startswith(prefix) and command not in runcmd:
+                    runcmd.append(command)
+        cloud_config = {k: v for k, v in cloud_config.items() if v != []}
+        # JSON is valid YAML, so no YAML library is needed
+        return "#cloud-config\n" + json.dumps(cloud_config, indent=2) + "\n"
+
+    def get_meta_data(self, manifest: GuestManifest):
+        meta_data = {"instance-id": f"vmlight-{self.work_dir.name}"}
+        hostname = manifest.entries.get("/etc/hostname")
+        if hostname is not None:
+            # Or cloud-init would set a hostname of its own
+            meta_data["local-hostname"] = hostname.content.strip()
+        return json.dumps(meta_data) + "\n"
+
+    def apply(self, manifest: GuestManifest):
+        with self._phase("prepare"):
+            files = {
+                "user-data": self.get_user_data(manifest),
+                "meta-data": self.get_meta_data(manifest),
+                # The network is configured by the files of the manifest
+                "network-config": json.dumps({"config": "disabled"}) + "\n",
+            }
+        with self._phase("write"):
+            write_iso(
+                self.work_dir / self.seed_file_name,
+                {name: text.encode("utf-8") for name, text in files.items()},
+                self.seed_label,
+            )
+
+
+GUEST_EDITORS = {
+    GuestfishEditor.name: GuestfishEditor,
+    NbdEditor.name: NbdEditor,
+    NoCloudEditor.name: NoCloudEditor,
+}
+
+
+def get_guest_editor(name: str, disk_file: Path, work_dir: Path) -> GuestEditor:
+    """
+    Get a guest editor by name. 'auto' picks the qemu-nbd editor when running
+    as root with qemu-nbd installed, and the guestfish editor otherwise.
+    """
+    if name == "auto":
+        if os.geteuid() == 0 and shutil.which("qemu-nbd"):
+            name = NbdEditor.name
+        else:
+            name = GuestfishEditor.name
+    if name not in GUEST_EDITORS:
+        raise ApplicationError(f"Unknown guest editor: {name}")
+    return GUEST_EDITORS[name](disk_file, work_dir)
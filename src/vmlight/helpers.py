@@ -1,4 +1,7 @@
 class VmBackendHelper:
+    # File in the instance directory that identifies the backend
+    config_file_name = None
+
     def __init__(self, vm, config):
         self.vm = vm
         self.config = config
@@ -15,5 +18,48 @@ class VmBackendHelper:
     def restart(self):
         raise NotImplementedError
 
+    def destroy(self):
+        raise NotImplementedError
+
     def delete(self):
         raise NotImplementedError
+
+    def get_disk_file(self):
+        raise NotImplementedError
+
+    def get_boot_id(self):
+        """
+        Get a value that changes each time the instance boots, such as its
+        domain ID, or None if the backend cannot tell.
+        """
+        return None
+
+    def get_resource_usage(self):
+        """
+        Get the memory (bytes), vCPUs and CPU time (seconds) used by a
+        running instance, or None if the backend cannot tell.
+        """
+        return None
+
+    @classmethod
+    def refresh_state(cls, config):
+        """
+        Drop any cached domain state of the backend, so that the next
+        is_running() call sees the current state.
+        """
+
+    @classmethod
+    def start_state_tracking(cls, config, resync_interval=None):
+        """
+        Start keeping the state of all instances of the backend in memory,
+        updated from backend events, in a long-running process. Returns
+        False if the backend cannot do this.
+        """
+        return False
+
+    @classmethod
+    def read_instance_info(cls, instance_dir):
+        """
+        Read inventory fields from the files in an instance directory.
+        """
+        raise NotImplementedError
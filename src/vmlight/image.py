@@ -1,68 +1,526 @@
-from .utils import ApplicationError
+import hashlib
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
 from pathlib import Path
-from itertools import chain
 
-from .utils import sh
+from .fetch import (
+    download,
+    get_compression_suffix,
+    get_source_file_name,
+    is_url,
+    unpack,
+)
+from .inventory import Inventory
+from .utils import CONTROL_TIMEOUT, ApplicationError, file_lock, sh, sh_async
+
+# File in an instance directory naming the image its disk is an overlay of
+BACKING_IMAGE_FILE = "backing_image"
+
+IMAGE_SUFFIXES = [".qcow2", ".img"]
+# Format images are converted to when they are added
+CANONICAL_SUFFIX = ".qcow2"
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def get_image_format(image_path: Path):
+    """
+    Get the qemu-img format name of an image file from its suffix.
+    """
+    image_format = image_path.suffix[1:].lower()
+    if image_format == "img":
+        return "raw"
+    if image_format == "qcow2":
+        return "qcow2"
+    raise ApplicationError(f"Unsupported image format: {image_path.suffix}")
+
+
+def format_size(size):
+    """
+    Format a size in bytes for display.
+    """
+    if size is None:
+        return "-"
+    for unit in ["B", "K", "M", "G"]:
+        if size < 1024:
+            return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}T"
+
+
+def _parse_image_info(path: Path, output: str):
+    info = json.loads(output)
+    return {
+        "format": info.get("format"),
+        "virtual_size": info.get("virtual-size"),
+        "actual_size": info.get("actual-size"),
+        "cluster_size": info.get("cluster-size"),
+        "backing_file": info.get("backing-filename"),
+        "mtime_ns": path.stat().st_mtime_ns,
+    }
+
+
+def get_image_info(path: Path):
+    """
+    Get the format, sizes and backing file of an image from qemu-img info.
+    """
+    output = sh(["qemu-img", "info", "--output=json", path], timeout=CONTROL_TIMEOUT)
+    return _parse_image_info(path, output)
+
+
+def get_images_info(paths):
+    """
+    Get the info of several images, running qemu-img info for them in
+    parallel.
+    """
+    futures = [
+        sh_async(["qemu-img", "info", "--output=json", path], timeout=CONTROL_TIMEOUT)
+        for path in paths
+    ]
+    try:
+        return [
+            _parse_image_info(path, future.result())
+            for path, future in zip(paths, futures)
+        ]
+    finally:
+        for future in futures:
+            if not future.cancel():
+                future.command.cancel()
+
+
+def print_catalog(entries):
+    """
+    Print image catalog entries as returned by ImageManager.get_catalog().
+    """
+    print(
+        f"{'INDEX':<6} {'NAME':<40} {'FORMAT':<7} {'VIRTUAL':>8} "
+        f"{'ACTUAL':>8} {'NETWORK':<9} {'DIGEST'}"
+    )
+    for index, entry in enumerate(entries, start=1):
+        digest = entry["digest"][:12] if entry["digest"] else "-"
+        print(
+            f"{index:<6} {entry['name']:<40} {entry['format']:<7} "
+            f"{format_size(entry.get('virtual_size')):>8} "
+            f"{format_size(entry.get('actual_size')):>8} "
+            f"{entry.get('network_config') or '-':<9} {digest}"
+        )
+
+
+def _get_file_key(path: Path):
+    """
+    Get a key that changes whenever the content of a file may have changed.
+    """
+    st = path.stat()
+    return f"{st.st_dev}:{st.st_ino}:{st.st_mtime_ns}:{st.st_size}"
+
+
+class DigestCache:
+    """
+    Caches the sha256 digest of the stored image files by blob file name,
+    with the device, inode, mtime and size the file had when it was hashed.
+    A blob whose key no longer matches has changed since it was stored, and
+    has no cached digest. Entries of removed blobs are dropped whenever the
+    cache is written.
+    """
+
+    def __init__(self, cache_file: Path):
+        self.cache_file = cache_file
+        self.lock_file = cache_file.with_name(f".{cache_file.name}.lock")
+
+    def _read(self):
+        if not self.cache_file.exists():
+            return {}
+        entries = json.loads(self.cache_file.read_text())
+        # Older versions keyed any file by its file key, and are ignored
+        return {name: e for name, e in entries.items() if isinstance(e, dict)}
+
+    def _update(self, blob_path: Path, entry):
+        with file_lock(self.lock_file):
+            entries = self._read()
+            entries[blob_path.name] = entry
+            entries = {
+                name: e
+                for name, e in entries.items()
+                if e is not None and (blob_path.parent / name).exists()
+            }
+            tmp_file = self.cache_file.with_name(f".{self.cache_file.name}.tmp")
+            tmp_file.write_text(json.dumps(entries))
+            os.replace(tmp_file, self.cache_file)
+
+    def get(self, blob_path: Path):
+        """
+        Get the digest of a blob, or None if it is not cached or the blob
+        changed since.
+        """
+        entry = self._read().get(blob_path.name)
+        if entry is None or not blob_path.exists():
+            return None
+        if entry["key"] != _get_file_key(blob_path):
+            return None
+        return entry["digest"]
+
+    def put(self, blob_path: Path, digest: str):
+        self._update(blob_path, {"key": _get_file_key(blob_path), "digest": digest})
+
+    def remove(self, blob_path: Path):
+        self._update(blob_path, None)
+
+
+def hash_file(path: Path, copy_to: Path = None):
+    """
+    Hash a file in chunks, optionally copying it to copy_to in the same pass.
+    Returns the hex sha256 digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as src:
+        dst = open(copy_to, "wb") if copy_to else None
+        try:
+            while True:
+                chunk = src.read(HASH_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                if dst:
+                    dst.write(chunk)
+        finally:
+            if dst:
+                dst.close()
+    return digest.hexdigest()
 
 
 class ImageManager:
+    """
+    Content-addressed image store. Image files are stored once under their
+    sha256 digest in image_dir/blobs/sha256, and exposed by name through
+    index.json. Every name also has a <name>.<suffix> symlink in image_dir,
+    which is the path used for backing files and by the backends.
+
+    The index doubles as the image catalog: each entry holds the digest and
+    the qemu-img info of the image (format, virtual, actual and cluster
+    size, backing file). The info is refreshed only when the mtime of the
+    stored file changes, so listing and looking up images needs no
+    subprocess calls.
+
+    Image files placed directly in image_dir by older versions are moved
+    into the store by migrate(), and by the first add, remove or network
+    configuration change. Until then they are listed as they are.
+    """
+
     def __init__(self, config):
         self.config = config
         self.image_dir = Path(self.config["general"]["image_dir"]).absolute()
+        self.blob_dir = self.image_dir / "blobs" / "sha256"
+        self.index_file = self.image_dir / "index.json"
+        self.lock_file = self.image_dir / ".index.lock"
+        self.digest_cache = DigestCache(self.image_dir / "digests.json")
+        self.index = self._read_index()
+        self.images = self._get_images()
+
+    def _read_index(self):
+        if self.index_file.exists():
+            return json.loads(self.index_file.read_text())
+        # Not migrated yet, show the legacy files as they are
+        return {
+            path.stem: {
+                "digest": None,
+                "format": get_image_format(path),
+                "suffix": path.suffix,
+            }
+            for path in self._get_legacy_files()
+        }
+
+    @contextmanager
+    def _index(self):
+        """
+        Lock and load the index, and save it when the block exits without
+        an error.
+        """
+        with file_lock(self.lock_file):
+            index = {}
+            if self.index_file.exists():
+                index = json.loads(self.index_file.read_text())
+            yield index
+            tmp_file = self.index_file.with_name(f"{self.index_file.name}.tmp")
+            tmp_file.write_text(json.dumps(index, indent=2, sort_keys=True))
+            os.replace(tmp_file, self.index_file)
+        self.index = index
         self.images = self._get_images()
 
     def _get_images(self):
-        qcow_images = self.image_dir.glob("*.qcow2")
-        img_images = self.image_dir.glob("*.img")
-        return list(chain(qcow_images, img_images))
+        return [
+            self.image_dir / f"{name}{entry['suffix']}"
+            for name, entry in sorted(self.index.items())
+        ]
+
+    def _get_legacy_files(self):
+        if not self.image_dir.exists():
+            return []
+        return sorted(
+            path
+            for path in self.image_dir.iterdir()
+            if path.suffix in IMAGE_SUFFIXES
+            and path.is_file()
+            and not path.is_symlink()
+        )
+
+    def _get_blob_path(self, digest: str, suffix: str):
+        return self.blob_dir / f"{digest}{suffix}"
+
+    def _link_name(self, name: str, blob_path: Path):
+        link = self.image_dir / f"{name}{blob_path.suffix}"
+        tmp_link = link.with_name(f".{link.name}.tmp")
+        tmp_link.unlink(missing_ok=True)
+        tmp_link.symlink_to(blob_path.relative_to(self.image_dir))
+        os.replace(tmp_link, link)
+
+    def _store(self, index, name: str, src_path: Path, move=False, digest=None):
+        """
+        Store a file under its digest and index it as name. The digest may be
+        given if it is known already. The file is hashed where it is, and
+        only moved or copied into the store if no unchanged file with the
+        same digest is stored yet.
+        """
+        suffix = src_path.suffix
+        self.blob_dir.mkdir(parents=True, exist_ok=True)
+        if digest is None:
+            digest = hash_file(src_path)
+        blob_path = self._get_blob_path(digest, suffix)
+        if self.digest_cache.get(blob_path) == digest:
+            # A duplicate of a stored image only costs its index entry
+            if move:
+                src_path.unlink()
+        elif move:
+            src_path.replace(blob_path)
+            self.digest_cache.put(blob_path, digest)
+        else:
+            # Copied to a temporary file that is then stored in its place, and
+            # hashed again while copied in case it changed after it was hashed
+            tmp_path = self.blob_dir / f".{name}{suffix}.tmp"
+            try:
+                if hash_file(src_path, copy_to=tmp_path) != digest:
+                    raise ApplicationError(
+                        f"Image file {src_path} changed while it was added."
+                    )
+                shutil.copystat(src_path, tmp_path)
+                tmp_path.replace(blob_path)
+            finally:
+                tmp_path.unlink(missing_ok=True)
+            self.digest_cache.put(blob_path, digest)
+        index[name] = {
+            "digest": digest,
+            "suffix": suffix,
+            "added": int(time.time()),
+            **get_image_info(blob_path),
+        }
+        self._link_name(name, blob_path)
+        return digest
+
+    def _store_legacy_files(self, index):
+        for path in self._get_legacy_files():
+            print(f"Moving image {path.stem} into the image store...")
+            self._store(index, path.stem, path, move=True)
+
+    def migrate(self):
+        """
+        Move image files in image_dir into the content-addressed store.
+        """
+        with self._index() as index:
+            self._store_legacy_files(index)
+
+    def _refresh_info(self):
+        """
+        Refresh the qemu-img info of the images whose file has changed since
+        it was recorded. The index is only written if something changed and
+        it is writable.
+        """
+        stale = [
+            name
+            for name, entry in self.index.items()
+            if entry.get("mtime_ns") != self.get_path_by_name(name).stat().st_mtime_ns
+        ]
+        if not stale:
+            return
+        infos = get_images_info([self.get_path_by_name(name) for name in stale])
+        if not self.index_file.exists() or not os.access(self.image_dir, os.W_OK):
+            for name, info in zip(stale, infos):
+                self.index[name].update(info)
+            return
+        with self._index() as index:
+            for name, info in zip(stale, infos):
+                if name in index:
+                    index[name].update(info)
+
+    def get_info(self, image_name: str):
+        """
+        Get the catalog entry of an image.
+        """
+        path = self.get_path_by_name(image_name)
+        if self.index[image_name].get("mtime_ns") != path.stat().st_mtime_ns:
+            self._refresh_info()
+        return self.index[image_name]
+
+    def get_catalog(self):
+        """
+        Get the catalog entries of all images, with their names.
+        """
+        self._refresh_info()
+        return [{"name": image.stem, **self.index[image.stem]} for image in self.images]
 
     def list(self):
         """
         List all images in the image directory.
         """
-        print(f"{'INDEX':<6} {'NAME':<40} {'TYPE'}")
-        for index, image in enumerate(self.images, start=1):
-            name = image.stem
-            image_type = image.suffix[1:].upper()
-            print(f"{index:<6} {name:<40} {image_type}")
+        print_catalog(self.get_catalog())
 
-    def add(self, image_path: Path):
+    def add(self, source: str, image_name: str = None, network_config: str = None):
         """
-        Add an image to the image directory.
+        Add an image from a local file or an http(s) URL. Compressed sources
+        (.xz, .zst) are unpacked while they are read, and raw images are
+        converted to qcow2 once here, so that deploys only have to copy.
+        Interrupted downloads are resumed when the same URL is added again.
+        network_config names the network configuration its guests use.
         """
-        if not image_path.exists():
-            raise ApplicationError(f"Image file {image_path} does not exist.")
-        image_name = image_path.stem
-        image_type = image_path.suffix[1:]
-        if image_type not in ["qcow2", "img"]:
-            raise ApplicationError(f"Invalid image type: {image_type}")
-        dst_path = self.image_dir / f"{image_name}.{image_type}"
-        if dst_path.exists():
+        file_name = get_source_file_name(source)
+        suffix = Path(file_name).suffix
+        if suffix not in IMAGE_SUFFIXES:
+            raise ApplicationError(f"Invalid image type: {suffix[1:]}")
+        image_name = image_name or Path(file_name).stem
+        if image_name in self.index:
             raise ApplicationError(f"Image {image_name} already exists.")
-        self.image_dir.mkdir(parents=True, exist_ok=True)
-        sh(f"cp {image_path} {dst_path}")
-        self.images = self._get_images()
+        compression = get_compression_suffix(source)
+        staging_dir = self.image_dir / ".staging"
+        staging_dir.mkdir(parents=True, exist_ok=True)
+
+        part_file = None
+        if is_url(source):
+            part_file = staging_dir / f"{image_name}{suffix}{compression}.part"
+            download(source, part_file)
+            src_file = part_file
+        else:
+            src_file = Path(source).absolute()
+            if not src_file.exists():
+                raise ApplicationError(f"Image file {src_file} does not exist.")
+
+        staged_files = []
+        digest = None  # Of src_file, if known
+        try:
+            if compression or part_file:
+                staged_file = staging_dir / f"{image_name}{suffix}"
+                staged_files.append(staged_file)
+                if compression:
+                    digest = unpack(src_file, staged_file, compression)
+                else:
+                    src_file.replace(staged_file)  # The download is the image
+                src_file = staged_file
+            if suffix != CANONICAL_SUFFIX:
+                print(f"Converting {image_name} to qcow2...")
+                converted_file = staging_dir / f"{image_name}{CANONICAL_SUFFIX}"
+                staged_files.append(converted_file)
+                sh(["qemu-img", "convert", "-O", "qcow2", src_file, converted_file])
+                src_file = converted_file
+                digest = None
+            with self._index() as index:
+                self._store_legacy_files(index)
+                if image_name in index:
+                    raise ApplicationError(f"Image {image_name} already exists.")
+                digest = self._store(
+                    index,
+                    image_name,
+                    src_file,
+                    move=src_file in staged_files,
+                    digest=digest,
+                )
+                if network_config:
+                    index[image_name]["network_config"] = network_config
+        finally:
+            for staged_file in staged_files:
+                staged_file.unlink(missing_ok=True)
+        if part_file:
+            part_file.unlink(missing_ok=True)
+            part_file.with_name(f"{part_file.name}.json").unlink(missing_ok=True)
+
+        duplicates = [
+            name
+            for name, entry in self.index.items()
+            if entry["digest"] == digest and name != image_name
+        ]
+        if duplicates:
+            print(
+                f"Image {image_name} has the same content as "
+                f"{', '.join(duplicates)}, stored once."
+            )
 
     def remove(self, image_name: str):
         """
-        Remove an image from the image directory.
+        Remove an image from the image store. Its file is deleted once no
+        other image name refers to it.
         """
-        image_search = list(self.image_dir.glob(f"{image_name}.*"))
-        if not image_search:
+        if image_name not in self.index:
             raise ApplicationError(f"Image {image_name} does not exist.")
-        if len(image_search) > 1:
+        users = self.get_image_users(image_name)
+        if users:
             raise ApplicationError(
-                f"Multiple images found for {image_name} (should not happen)."
+                f"Image {image_name} is the base of linked clones: {', '.join(users)}. "
+                "Flatten or delete them first."
             )
-        image_path = image_search[0]
-        sh(f"rm {image_path}")
-        self.images = self._get_images()
+        with self._index() as index:
+            self._store_legacy_files(index)
+            entry = index.pop(image_name)
+            (self.image_dir / f"{image_name}{entry['suffix']}").unlink(missing_ok=True)
+            if not any(e["digest"] == entry["digest"] for e in index.values()):
+                blob_path = self._get_blob_path(entry["digest"], entry["suffix"])
+                blob_path.unlink(missing_ok=True)
+                self.digest_cache.remove(blob_path)
+
+    def set_network_config(self, image_name: str, network_config: str):
+        """
+        Set the network configuration the guests of an image use.
+        """
+        with self._index() as index:
+            self._store_legacy_files(index)
+            if image_name not in index:
+                raise ApplicationError(f"Image {image_name} does not exist.")
+            index[image_name]["network_config"] = network_config
+
+    def get_network_config(self, image_name: str):
+        """
+        Get the network configuration of an image, or None for the default.
+        """
+        return self.index.get(image_name, {}).get("network_config")
+
+    def get_image_users(self, image_name: str):
+        """
+        Get the names of the instances whose disk is an overlay of an image.
+        """
+        rows = Inventory(self.config).get_by_image(image_name, linked_clone=True)
+        return [f"{row['vm_id']}-{row['name']}" for row in rows]
 
     def get_path_by_name(self, image_name: str):
         """
         Get the path of an image by name.
         """
-        for image in self.images:
-            if image.stem == image_name:
-                return image
-        raise ApplicationError(f"Image {image_name} does not exist.")
+        entry = self.index.get(image_name)
+        if entry is None:
+            raise ApplicationError(f"Image {image_name} does not exist.")
+        return self.image_dir / f"{image_name}{entry['suffix']}"
+
+    def get_digest(self, image_name: str):
+        """
+        Get the digest of an image, or None if the store is not migrated yet.
+        """
+        self.get_path_by_name(image_name)  # Check that it exists
+        return self.index[image_name]["digest"]
+
+    def verify(self, image_name: str):
+        """
+        Check that the stored file of an image still matches its digest.
+        """
+        entry = self.index.get(image_name)
+        if entry is None:
+            raise ApplicationError(f"Image {image_name} does not exist.")
+        if entry["digest"] is None:
+            raise ApplicationError(f"Image {image_name} is not in the image store yet.")
+        blob_path = self._get_blob_path(entry["digest"], entry["suffix"])
+        return hash_file(blob_path) == entry["digest"]
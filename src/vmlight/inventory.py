@@ -0,0 +1,226 @@
+import bisect
+import json
+import sqlite3
+from contextlib import contextmanager
+from pathlib import Path
+
+from .utils import ApplicationError
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS instances (
+    vm_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    type TEXT NOT NULL,
+    state TEXT NOT NULL,
+    image TEXT,
+    linked_clone INTEGER NOT NULL DEFAULT 0,
+    ip TEXT,
+    memory TEXT,
+    vcpus TEXT,
+    disk_size TEXT,
+    disk_file TEXT
+);
+CREATE INDEX IF NOT EXISTS instances_name ON instances (name);
+CREATE INDEX IF NOT EXISTS instances_image ON instances (image);
+CREATE TABLE IF NOT EXISTS deploy_durations (
+    type TEXT NOT NULL,
+    result TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    sum REAL NOT NULL,
+    buckets TEXT NOT NULL,
+    PRIMARY KEY (type, result)
+);
+"""
+
+FIELDS = [
+    "name",
+    "type",
+    "state",
+    "image",
+    "linked_clone",
+    "ip",
+    "memory",
+    "vcpus",
+    "disk_size",
+    "disk_file",
+]
+
+# Instance states
+DEPLOYING = "deploying"
+DEPLOYED = "deployed"
+
+# Upper bounds in seconds of the deploy duration histogram buckets
+DEPLOY_DURATION_BUCKETS = [1, 2, 5, 10, 20, 30, 60, 120, 300, 600]
+
+
+class Inventory:
+    """
+    Persistent record of all instances, kept in an SQLite database.
+    Every change runs in its own transaction, so concurrent commands
+    always see a consistent inventory.
+    """
+
+    def __init__(self, config):
+        self.db_file = Path(config["general"]["inventory_file"]).absolute()
+
+    def exists(self):
+        return self.db_file.exists()
+
+    @contextmanager
+    def _transaction(self, write=False):
+        try:
+            self.db_file.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+        except (OSError, sqlite3.Error) as e:
+            raise ApplicationError(f"Cannot open inventory {self.db_file}: {e}") from e
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.executescript(SCHEMA)
+            # Writers take the write lock up front, so read-then-write
+            # sequences like ID allocation cannot interleave between commands
+            conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            raise ApplicationError(f"Inventory error: {e}") from e
+        finally:
+            conn.close()
+
+    def add(self, vm_id, **fields):
+        """
+        Record a new instance, by default in the 'deploying' state.
+        """
+        fields.setdefault("state", DEPLOYING)
+        with self._transaction(write=True) as conn:
+            if conn.execute(
+                "SELECT 1 FROM instances WHERE vm_id = ?", [int(vm_id)]
+            ).fetchone():
+                raise ApplicationError(f"VM ID {vm_id} is already in the inventory.")
+            self._insert(conn, int(vm_id), fields)
+
+    @staticmethod
+    def _insert(conn, vm_id, fields):
+        unknown = set(fields) - set(FIELDS)
+        if unknown:
+            raise ApplicationError(f"Unknown inventory fields: {', '.join(unknown)}")
+        columns = ["vm_id"] + list(fields)
+        conn.execute(
+            f"INSERT INTO instances ({', '.join(columns)}) "
+            f"VALUES ({', '.join('?' for _ in columns)})",
+            [vm_id] + list(fields.values()),
+        )
+
+    def update(self, vm_id, **fields):
+        """
+        Update fields of an instance.
+        """
+        unknown = set(fields) - set(FIELDS)
+        if unknown:
+            raise ApplicationError(f"Unknown inventory fields: {', '.join(unknown)}")
+        with self._transaction(write=True) as conn:
+            conn.execute(
+                f"UPDATE instances SET {', '.join(f'{f} = ?' for f in fields)} "
+                "WHERE vm_id = ?",
+                list(fields.values()) + [int(vm_id)],
+            )
+
+    def remove(self, vm_id):
+        """
+        Remove an instance.
+        """
+        with self._transaction(write=True) as conn:
+            conn.execute("DELETE FROM instances WHERE vm_id = ?", [int(vm_id)])
+
+    def get(self, vm_id):
+        """
+        Get an instance by VM ID, or None if there is none.
+        """
+        with self._transaction() as conn:
+            return conn.execute(
+                "SELECT * FROM instances WHERE vm_id = ?", [int(vm_id)]
+            ).fetchone()
+
+    def get_by_name(self, name: str):
+        """
+        Get all instances with a name.
+        """
+        with self._transaction() as conn:
+            return conn.execute(
+                "SELECT * FROM instances WHERE name = ? ORDER BY vm_id", [name]
+            ).fetchall()
+
+    def get_by_image(self, image: str, linked_clone=None):
+        """
+        Get all instances deployed from an image, optionally only those that
+        are (or are not) linked clones of it.
+        """
+        query = "SELECT * FROM instances WHERE image = ?"
+        params = [image]
+        if linked_clone is not None:
+            query += " AND linked_clone = ?"
+            params.append(int(linked_clone))
+        with self._transaction() as conn:
+            return conn.execute(query + " ORDER BY vm_id", params).fetchall()
+
+    def list(self):
+        """
+        Get all instances, ordered by VM ID.
+        """
+        with self._transaction() as conn:
+            return conn.execute("SELECT * FROM instances ORDER BY vm_id").fetchall()
+
+    def rebuild(self, entries):
+        """
+        Replace the whole inventory with the given entries, a dict of
+        VM ID to fields.
+        """
+        with self._transaction(write=True) as conn:
+            conn.execute("DELETE FROM instances")
+            for vm_id, fields in entries.items():
+                self._insert(conn, vm_id, fields)
+
+    def record_deploy(self, vm_type: str, seconds: float, ok=True):
+        """
+        Add a deploy to the deploy duration histogram of its instance type.
+        The histogram has fixed buckets, so it does not grow with the number
+        of deploys.
+        """
+        result = "ok" if ok else "failed"
+        with self._transaction(write=True) as conn:
+            row = conn.execute(
+                "SELECT * FROM deploy_durations WHERE type = ? AND result = ?",
+                [vm_type, result],
+            ).fetchone()
+            if row:
+                count, total = row["count"], row["sum"]
+                buckets = json.loads(row["buckets"])
+            else:
+                count, total = 0, 0.0
+                buckets = [0] * (len(DEPLOY_DURATION_BUCKETS) + 1)
+            buckets[bisect.bisect_left(DEPLOY_DURATION_BUCKETS, seconds)] += 1
+            conn.execute(
+                "INSERT OR REPLACE INTO deploy_durations VALUES (?, ?, ?, ?, ?)",
+                [vm_type, result, count + 1, total + seconds, json.dumps(buckets)],
+            )
+
+    def get_deploy_durations(self):
+        """
+        Get the deploy duration histograms, with the count of each bucket
+        (the last one counting deploys longer than the largest bound).
+        """
+        with self._transaction() as conn:
+            rows = conn.execute("SELECT * FROM deploy_durations").fetchall()
+        return [
+            {
+                "type": row["type"],
+                "result": row["result"],
+                "count": row["count"],
+                "sum": row["sum"],
+                "buckets": json.loads(row["buckets"]),
+            }
+            for row in rows
+        ]
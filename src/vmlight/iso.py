@@ -0,0 +1,199 @@
+import struct
+import time
+from pathlib import Path
+
+from .utils import ApplicationError
+
+SECTOR_SIZE = 2048
+# The first 16 sectors are the system area, then come the volume descriptors
+DESCRIPTOR_SECTOR = 16
+# Sectors of the little and big endian path tables, after the terminator
+PATH_TABLE_SECTORS = (18, 19)
+ROOT_DIR_SECTOR = 20
+
+FILE_MODE = 0o100444
+DIR_MODE = 0o040555
+
+RRIP_ID = b"RRIP_1991A"
+RRIP_DESCRIPTION = (
+    b"THE ROCK RIDGE INTERCHANGE PROTOCOL PROVIDES SUPPORT FOR POSIX FILE "
+    b"SYSTEM SEMANTICS"
+)
+
+
+def _both16(value: int):
+    return struct.pack("<H", value) + struct.pack(">H", value)
+
+
+def _both32(value: int):
+    return struct.pack("<I", value) + struct.pack(">I", value)
+
+
+def _record_date(timestamp: float):
+    t = time.gmtime(timestamp)
+    return bytes(
+        [t.tm_year - 1900, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec, 0]
+    )
+
+
+def _volume_date(timestamp: float):
+    return time.strftime("%Y%m%d%H%M%S00", time.gmtime(timestamp)).encode() + b"\0"
+
+
+def _text(text: str, size: int):
+    return text.upper().encode("ascii").ljust(size, b" ")[:size]
+
+
+def _susp(signature: bytes, data: bytes):
+    """
+    A System Use Sharing Protocol entry, as used by Rock Ridge.
+    """
+    return signature + bytes([4 + len(data), 1]) + data
+
+
+def _rr_attributes(mode: int):
+    return _susp(b"PX", _both32(mode) + _both32(1) + _both32(0) + _both32(0))
+
+
+def _dir_record(extent, size, is_dir, identifier: bytes, date, system_use=b""):
+    record = (
+        bytes([0, 0])
+        + _both32(extent)
+        + _both32(size)
+        + date
+        + bytes([2 if is_dir else 0, 0, 0])
+        + _both16(1)
+        + bytes([len(identifier)])
+        + identifier
+    )
+    if len(identifier) % 2 == 0:
+        record += b"\0"  # Keeps the system use area at an even offset
+    record += system_use
+    if len(record) % 2:
+        record += b"\0"
+    if len(record) > 255:
+        raise ApplicationError(f"ISO directory record too long: {identifier!r}")
+    return bytes([len(record)]) + record[1:]
+
+
+def _path_table(byte_order: str):
+    """
+    The path table of a volume whose only directory is the root.
+    """
+    table = bytes([1, 0]) + struct.pack(f"{byte_order}IH", ROOT_DIR_SECTOR, 1)
+    return (table + b"\0\0").ljust(SECTOR_SIZE, b"\0")
+
+
+def _d_characters(text: str):
+    return "".join(c if c.isascii() and c.isalnum() else "_" for c in text.upper())
+
+
+def _iso_names(names):
+    """
+    Get ISO 9660 level 1 identifiers (8.3, upper case) for file names.
+    """
+    identifiers = {}
+    for index, name in enumerate(sorted(names)):
+        stem, _, extension = name.partition(".")
+        stem, extension = _d_characters(stem), _d_characters(extension)
+        identifier = f"{stem[:8]}.{extension[:3]};1"
+        if identifier in identifiers.values():
+            identifier = f"{stem[:4]}{index:04d}.{extension[:3]};1"
+        identifiers[name] = identifier
+    return identifiers
+
+
+def write_iso(path: Path, files, volume_id: str):
+    """
+    Write an ISO 9660 image with files in its root directory, given as a
+    dict of name to bytes. The names are kept as they are by Rock Ridge
+    entries, which Linux reads, next to 8.3 names for other readers.
+    """
+    now = time.time()
+    date = _record_date(now)
+    identifiers = _iso_names(files)
+    names = sorted(files, key=lambda name: identifiers[name])
+
+    def build_directory(extents):
+        root_attributes = _rr_attributes(DIR_MODE)
+        records = [
+            _dir_record(
+                ROOT_DIR_SECTOR, directory_size, True, b"\0", date,
+                _susp(b"SP", b"\xbe\xef\0")
+                + root_attributes
+                + _susp(
+                    b"ER",
+                    bytes([len(RRIP_ID), len(RRIP_DESCRIPTION), 0, 1])
+                    + RRIP_ID
+                    + RRIP_DESCRIPTION,
+                ),
+            ),
+            _dir_record(
+                ROOT_DIR_SECTOR, directory_size, True, b"\1", date, root_attributes
+            ),
+        ]
+        for name in names:
+            records.append(
+                _dir_record(
+                    extents.get(name, 0),
+                    len(files[name]),
+                    False,
+                    identifiers[name].encode("ascii"),
+                    date,
+                    _rr_attributes(FILE_MODE)
+                    + _susp(b"NM", b"\0" + name.encode("utf-8")),
+                )
+            )
+        directory = b""
+        for record in records:
+            # Records may not cross a sector boundary
+            if len(directory) % SECTOR_SIZE + len(record) > SECTOR_SIZE:
+                directory += b"\0" * (-len(directory) % SECTOR_SIZE)
+            directory += record
+        return directory + b"\0" * (-len(directory) % SECTOR_SIZE)
+
+    # Record sizes do not depend on their extents, so the size is known first
+    directory_size = 0
+    directory_size = len(build_directory({}))
+    next_sector = ROOT_DIR_SECTOR + directory_size // SECTOR_SIZE
+    extents = {}
+    for name in names:
+        extents[name] = next_sector
+        next_sector += -(-len(files[name]) // SECTOR_SIZE)
+    directory = build_directory(extents)
+
+    root_record = _dir_record(ROOT_DIR_SECTOR, directory_size, True, b"\0", date)
+    descriptor = bytearray(SECTOR_SIZE)
+    descriptor[0:8] = b"\x01CD001\x01\0"
+    descriptor[8:40] = _text("LINUX", 32)
+    descriptor[40:72] = volume_id.encode("ascii").ljust(32, b" ")[:32]
+    descriptor[80:88] = _both32(next_sector)
+    descriptor[120:124] = _both16(1)
+    descriptor[124:128] = _both16(1)
+    descriptor[128:132] = _both16(SECTOR_SIZE)
+    descriptor[132:140] = _both32(10)
+    descriptor[140:144] = struct.pack("<I", PATH_TABLE_SECTORS[0])
+    descriptor[148:152] = struct.pack(">I", PATH_TABLE_SECTORS[1])
+    descriptor[156:190] = root_record
+    descriptor[190:813] = b" " * 623  # Volume set to bibliographic file ids
+    descriptor[574:702] = _text("VMLIGHT", 128)
+    descriptor[813:830] = _volume_date(now)
+    descriptor[830:847] = _volume_date(now)
+    descriptor[847:864] = b"0" * 16 + b"\0"
+    descriptor[864:881] = b"0" * 16 + b"\0"
+    descriptor[881] = 1
+    terminator = b"\xffCD001\x01".ljust(SECTOR_SIZE, b"\0")
+
+    tmp_file = path.with_name(f".{path.name}.tmp")
+    with open(tmp_file, "wb") as f:
+        f.write(b"\0" * DESCRIPTOR_SECTOR * SECTOR_SIZE)
+        f.write(descriptor)
+        f.write(terminator)
+        for byte_order in "<>":
+            f.write(_path_table(byte_order))
+        f.write(directory)
+        for name in names:
+            f.write(files[name])
+            f.write(b"\0" * (-len(files[name]) % SECTOR_SIZE))
+    tmp_file.replace(path)
+
@@ -0,0 +1,224 @@
+import configparser
+import os
+import shutil
+from pathlib import Path
+
+from . import deploy
+from .helpers import VmBackendHelper
+from .image import get_image_format
+from .qmp import QmpClient
+from .utils import CONTROL_TIMEOUT, ApplicationError, sh
+
+KVMCFG_TEMPLATE = """# vmlight KVM instance configuration
+[vm]
+name = {vm_id}-{name}
+memory = {memory}
+vcpus = {vcpus}
+ip = {ip}
+disk_image = {disk_image}
+disk_format = {disk_format}
+seed_image = {seed_image}
+"""
+
+# PCI slot of the NIC, which fixes its predictable name in the guest
+NIC_PCI_SLOT = 3
+
+
+class KvmVmHelper(VmBackendHelper):
+    """
+    Runs an instance as a QEMU process with a QMP socket in its instance
+    directory. The state of the instance is queried through that socket.
+    """
+
+    config_file_name = "kvm_vm.cfg"
+    qmp_timeout = 5.0
+
+    def __init__(self, vm, config):
+        super().__init__(vm, config)
+        self.instances_dir = Path(config["general"]["instances_dir"]).absolute()
+        self.instance_dir = self.instances_dir / f"{self.vm.id}-{self.vm.name}"
+        self.qmp_socket = self.instance_dir / "qmp.sock"
+        self.tap_name = f"vm{self.vm.id}"
+
+    def _qmp(self, command, arguments=None):
+        with QmpClient(self.qmp_socket, self.qmp_timeout) as qmp:
+            return qmp.execute(command, arguments)
+
+    def _read_config(self):
+        parser = configparser.ConfigParser()
+        parser.read(self.instance_dir / self.config_file_name)
+        return parser["vm"]
+
+    def get_qemu_args(self):
+        """
+        Get the QEMU command line of the instance.
+        """
+        vm_config = self._read_config()
+        kvm_config = self.config["kvm"]
+        vcpus = int(vm_config["vcpus"])
+        queues = int(kvm_config["net_queues"] or vcpus)
+        args = [
+            kvm_config["qemu_path"],
+            "-name", f"{vm_config['name']},process={vm_config['name']}",
+            "-machine", "q35,accel=kvm",
+            "-cpu", "host",
+            "-m", vm_config["memory"],
+            "-smp", str(vcpus),
+            "-drive",
+            f"file={vm_config['disk_image']},if=none,id=root,"
+            f"format={vm_config['disk_format']},cache=none,aio={kvm_config['aio']},"
+            "discard=unmap",
+            "-device", f"virtio-blk-pci,drive=root,num-queues={vcpus}",
+            "-netdev",
+            f"tap,id=net0,ifname={self.tap_name},script=no,downscript=no,"
+            f"vhost=on,queues={queues}",
+            "-device",
+            f"virtio-net-pci,netdev=net0,mq=on,vectors={2 * queues + 2},"
+            f"addr={NIC_PCI_SLOT:#x}",
+            "-qmp", f"unix:{self.qmp_socket},server=on,wait=off",
+            "-pidfile", str(self.instance_dir / "qemu.pid"),
+            "-serial", f"file:{self.instance_dir / 'console.log'}",
+            "-display", "none",
+            "-daemonize",
+        ]
+        if vm_config.get("seed_image"):
+            # After the NIC, so that it cannot take the NIC's PCI slot
+            args += [
+                "-drive",
+                f"file={vm_config['seed_image']},if=none,id=seed,format=raw,"
+                "readonly=on",
+                "-device", "virtio-blk-pci,drive=seed",
+            ]
+        return args
+
+    def _setup_host_network(self):
+        # Route the instance IP to its tap device, with the gateway address on
+        # the host side, like the Xen vif-route script does
+        ip = self._read_config()["ip"]
+        gateway = self.config["deploy"]["default_gateway"]
+        for command in [
+            ["ip", "link", "set", "dev", self.tap_name, "up"],
+            ["ip", "addr", "replace", f"{gateway}/32", "dev", self.tap_name],
+            ["ip", "route", "replace", f"{ip}/32", "dev", self.tap_name],
+        ]:
+            sh(command, timeout=CONTROL_TIMEOUT)
+        Path(f"/proc/sys/net/ipv4/conf/{self.tap_name}/proxy_arp").write_text("1\n")
+
+    def is_running(self):
+        try:
+            return self._qmp("query-status")["status"] == "running"
+        except (OSError, ApplicationError):
+            # Not listening, or hung or not QEMU: either way not running for us
+            return False
+
+    def get_resource_usage(self):
+        # Read from /proc, which costs no QMP round trip
+        try:
+            pid = int((self.instance_dir / "qemu.pid").read_text())
+            stat = Path(f"/proc/{pid}/stat").read_text()
+            rss_pages = int(Path(f"/proc/{pid}/statm").read_text().split()[1])
+        except (OSError, ValueError):
+            return None
+        # Fields after the command name, which may contain spaces
+        fields = stat[stat.rindex(")") + 2 :].split()
+        clock_ticks = os.sysconf("SC_CLK_TCK")
+        return {
+            "memory_bytes": rss_pages * os.sysconf("SC_PAGE_SIZE"),
+            "vcpus": int(self._read_config()["vcpus"]),
+            "cpu_seconds": (int(fields[11]) + int(fields[12])) / clock_ticks,
+        }
+
+    def start(self):
+        try:
+            sh(self.get_qemu_args(), timeout=CONTROL_TIMEOUT)
+            self._setup_host_network()
+            return True
+        except ApplicationError as e:
+            raise ApplicationError(f"Error starting KVM VM: {e}") from e
+
+    def stop(self):
+        try:
+            self._qmp("system_powerdown")
+            return True
+        except OSError as e:
+            raise ApplicationError(f"Error stopping KVM VM: {e}") from e
+
+    def restart(self):
+        try:
+            self._qmp("system_reset")
+            return True
+        except OSError as e:
+            raise ApplicationError(f"Error restarting KVM VM: {e}") from e
+
+    def destroy(self):
+        try:
+            self._qmp("quit")
+            return True
+        except OSError as e:
+            raise ApplicationError(f"Error destroying KVM VM: {e}") from e
+
+    @classmethod
+    def read_instance_info(cls, instance_dir):
+        parser = configparser.ConfigParser()
+        parser.read(instance_dir / cls.config_file_name)
+        vm_config = parser["vm"]
+        return {
+            "memory": vm_config.get("memory"),
+            "vcpus": vm_config.get("vcpus"),
+            "ip": vm_config.get("ip"),
+            "disk_file": vm_config.get("disk_image"),
+        }
+
+    def get_disk_file(self):
+        return self.instance_dir / "root.qcow2"
+
+    def delete(self):
+        pass  # Everything lives in the instance directory
+
+
+class KvmDeployManager(deploy.DeployManager):
+    vm_type = "kvm"
+    guest_interface = f"enp0s{NIC_PCI_SLOT}"
+
+    def __init__(self, args, config):
+        qemu_path = config["kvm"]["qemu_path"]
+        if not shutil.which(qemu_path):
+            raise ApplicationError(f"QEMU binary not found: {qemu_path}")
+        if config["kvm"]["aio"] not in ["io_uring", "native", "threads"]:
+            raise ApplicationError(f"Unsupported aio mode: {config['kvm']['aio']}")
+        super().__init__(args, config)
+
+    def _setup_instance_paths(self):
+        super()._setup_instance_paths()
+        self.instance_config_file = self.instance_dir / KvmVmHelper.config_file_name
+
+    def _get_disk_file_name(self):
+        return "root.qcow2"
+
+    def create_instance_config(self):
+        seed_file = self.get_seed_file()
+        with open(self.instance_config_file, "w") as f:
+            f.write(
+                KVMCFG_TEMPLATE.format(
+                    vm_id=self.vm_id,
+                    name=self.instance_name,
+                    memory=self.args["memory"],
+                    vcpus=self.args["vcpus"],
+                    ip=self.args["ip"],
+                    disk_image=self.disk_file.absolute().as_posix(),
+                    disk_format=get_image_format(self.disk_file),
+                    seed_image=seed_file.absolute().as_posix() if seed_file else "",
+                )
+            )
+
+    def remove_instance_config(self):
+        self.instance_config_file.unlink(missing_ok=True)
+
+    def enable_instance_autostart(self):
+        """
+        KVM instances are started explicitly with 'vm --start', there is no
+        hypervisor autostart directory to link into.
+        """
+
+    def disable_instance_autostart(self):
+        pass
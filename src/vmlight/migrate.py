@@ -0,0 +1,311 @@
+import json
+import re
+import shlex
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .image import BACKING_IMAGE_FILE, ImageManager
+from .inventory import DEPLOYED
+from .operations import OperationResult
+from .trace import tracer
+from .utils import CONTROL_TIMEOUT, ApplicationError, sh
+from .vm import VmType
+from .xen import XenVmHelper, invalidate_domain_snapshot
+
+
+def _run_remote(config, host: str, argv, timeout=CONTROL_TIMEOUT):
+    """
+    Run a command on a host over ssh and return its output.
+    """
+    ssh = shlex.split(config["migrate"]["ssh_command"])
+    return sh([*ssh, host, shlex.join(str(arg) for arg in argv)], timeout=timeout)
+
+
+def _get_free_memory(config):
+    """
+    Get the memory in MB that Xen has free for new domains.
+    """
+    output = sh([config["xen"]["xl_path"], "info"], timeout=CONTROL_TIMEOUT)
+    match = re.search(r"^free_memory\s*:\s*(\d+)", output, re.MULTILINE)
+    if match is None:
+        raise ApplicationError("Cannot read free_memory from 'xl info'.")
+    return int(match.group(1))
+
+
+def check_receive(vm_manager, spec):
+    """
+    Check on the destination host that an instance described by spec, as
+    sent by XenMigration, can be moved here. Returns a list of problems.
+    """
+    config = vm_manager.config
+    instance_dir = Path(spec["instance_dir"])
+    problems = []
+    if instance_dir.parent != vm_manager.instances_dir:
+        problems.append(
+            f"Instances are kept in {vm_manager.instances_dir}, "
+            f"not {instance_dir.parent}."
+        )
+    if instance_dir.exists():
+        problems.append(f"{instance_dir} already exists.")
+    if vm_manager.inventory.get(spec["vm_id"]) is not None:
+        problems.append(f"VM ID {spec['vm_id']} is in the inventory.")
+    problems += vm_manager.allocator.check_free(spec["vm_id"], spec["ip"])
+    if spec["running"]:
+        free_memory = _get_free_memory(config)
+        if free_memory < int(spec["memory"]):
+            problems.append(
+                f"Only {free_memory}MB of memory free, {spec['memory']}MB needed."
+            )
+    if spec["backing_file"]:
+        # The overlay refers to its base image by path, so the same image must
+        # be at the same path
+        image_manager = ImageManager(config)
+        if not Path(spec["backing_file"]).exists():
+            problems.append(f"Base image {spec['backing_file']} does not exist.")
+        elif image_manager.get_digest(spec["image"]) != spec["image_digest"]:
+            problems.append(f"Base image {spec['image']} has a different digest.")
+    return problems
+
+
+def commit_receive(vm_manager, spec):
+    """
+    Add an instance moved here to the inventory, and enable its autostart.
+    """
+    instance_dir = Path(spec["instance_dir"])
+    vm = vm_manager.import_instance(instance_dir, spec["image"])
+    if spec["autostart"]:
+        auto_dir = Path(vm_manager.config["xen"]["conf_dir"]) / "auto"
+        auto_dir.mkdir(parents=True, exist_ok=True)
+        auto_link = auto_dir / instance_dir.name
+        auto_link.unlink(missing_ok=True)
+        auto_link.symlink_to(instance_dir / XenVmHelper.config_file_name)
+    return vm
+
+
+def receive(vm_manager, step: str, spec_text: str):
+    """
+    Run a step of receiving an instance, for the 'vm --receive-check' and
+    'vm --receive-commit' commands run by the sending host. The outcome is
+    printed as JSON, which the sending host reads.
+    """
+    spec = json.loads(spec_text)
+    try:
+        if step == "check":
+            errors = check_receive(vm_manager, spec)
+        else:
+            commit_receive(vm_manager, spec)
+            errors = []
+    except ApplicationError as e:
+        errors = [e.message]
+    print(json.dumps({"errors": errors}))
+
+
+class XenMigration:
+    """
+    Moves a Xen instance to another host with the same instances and image
+    directories. A running instance is migrated live:
+
+    1. Pre-flight checks on both hosts.
+    2. The instance directory is copied with rsync while the domain runs.
+    3. The domain is paused and rsync copies what changed since.
+    4. 'xl migrate' moves the paused domain, which resumes on the host.
+
+    A stopped instance is only copied. The inventory entry and autostart
+    link then move to the host, and the local copy is removed. Until the
+    domain has moved, a failure unpauses it and removes the copy.
+    """
+
+    def __init__(self, vm_manager, vm, host: str, bwlimit=0):
+        self.vm_manager = vm_manager
+        self.config = vm_manager.config
+        self.vm = vm
+        self.host = host
+        self.bwlimit = int(bwlimit)
+        self.helper = XenVmHelper(vm, self.config)
+        self.instance_dir = vm_manager.instances_dir / f"{vm.id}-{vm.name}"
+        auto_dir = Path(self.config["xen"]["conf_dir"]) / "auto"
+        self.auto_link = auto_dir / self.instance_dir.name
+        self.xl_path = self.config["xen"]["xl_path"]
+        self._copied = False
+
+    def get_spec(self):
+        """
+        Get what the destination needs to know about the instance.
+        """
+        info = XenVmHelper.read_instance_info(self.instance_dir)
+        backing_image_file = self.instance_dir / BACKING_IMAGE_FILE
+        spec = {
+            "vm_id": self.vm.id,
+            "name": self.vm.name,
+            "ip": self.vm.ip,
+            "memory": info.get("memory", 0),
+            "instance_dir": str(self.instance_dir),
+            "image": self.vm.image,
+            "running": self.helper.is_running(),
+            "autostart": self.auto_link.is_symlink(),
+            "backing_file": None,
+            "image_digest": None,
+        }
+        if backing_image_file.exists():
+            image_manager = ImageManager(self.config)
+            spec["image"] = backing_image_file.read_text().strip()
+            spec["backing_file"] = str(image_manager.get_path_by_name(spec["image"]))
+            spec["image_digest"] = image_manager.get_digest(spec["image"])
+        return spec
+
+    def _receive(self, step: str, spec):
+        output = _run_remote(
+            self.config,
+            self.host,
+            [
+                self.config["migrate"]["remote_vmlight"], "--no-daemon", "vm",
+                f"--receive-{step}", json.dumps(spec),
+            ],
+        )
+        try:
+            errors = json.loads(output.strip().splitlines()[-1])["errors"]
+        except (ValueError, IndexError, KeyError):
+            raise ApplicationError(f"Unexpected reply from {self.host}: {output}")
+        if errors:
+            raise ApplicationError(f"{self.host}: {' '.join(errors)}")
+
+    def check(self):
+        if self.vm.type != VmType.XEN:
+            raise ApplicationError("only Xen instances can be migrated")
+        if self.vm.state != DEPLOYED:
+            raise ApplicationError("still deploying")
+        spec = self.get_spec()
+        with tracer.span("migrate.check", host=self.host):
+            self._receive("check", spec)
+        return spec
+
+    def copy(self):
+        """
+        Copy the instance directory to the host. Runs again after the domain
+        is paused, and then transfers only the blocks that changed.
+        """
+        command = [
+            self.config["migrate"]["rsync_path"],
+            "--archive", "--sparse", "--inplace",
+            "-e", self.config["migrate"]["ssh_command"],
+        ]
+        if self.bwlimit:
+            command.append(f"--bwlimit={self.bwlimit}")
+        self._copied = True
+        with tracer.span("migrate.copy", host=self.host):
+            source = f"{self.instance_dir}/"
+            sh(command + [source, f"{self.host}:{source}"])
+
+    def _move_domain(self):
+        domain_id = self.helper._get_xen_domain_id()
+        sh([self.xl_path, "pause", domain_id], timeout=CONTROL_TIMEOUT)
+        try:
+            self.copy()
+            with tracer.span("migrate.xl", host=self.host):
+                sh(
+                    [
+                        self.xl_path, "migrate",
+                        "-s", self.config["migrate"]["ssh_command"],
+                        domain_id, self.host,
+                    ]
+                )
+        except BaseException:
+            # xl resumes the domain here if the migration fails, but it stays
+            # paused by us
+            sh(
+                [self.xl_path, "unpause", domain_id],
+                error_ok=True,
+                timeout=CONTROL_TIMEOUT,
+            )
+            raise
+        finally:
+            invalidate_domain_snapshot(self.helper.xl_path)
+
+    def _remove_copy(self):
+        try:
+            _run_remote(
+                self.config, self.host, ["rm", "-rf", "--", self.instance_dir]
+            )
+        except ApplicationError as e:
+            print(
+                f"Could not remove the copy of {self.instance_dir.name} "
+                f"on {self.host}: {e.message}"
+            )
+
+    def run(self):
+        """
+        Migrate the instance, returning a message about the outcome.
+        """
+        spec = self.check()
+        try:
+            self.copy()
+            if spec["running"]:
+                self._move_domain()
+        except BaseException:
+            if self._copied:
+                self._remove_copy()
+            raise
+        # The domain now lives on the host, so this one must not start it again
+        self.auto_link.unlink(missing_ok=True)
+        try:
+            self._receive("commit", spec)
+        except ApplicationError as e:
+            raise ApplicationError(
+                f"moved, but not added to the inventory of {self.host} "
+                f"({e.message}), run 'vmlight inventory --rebuild' there; "
+                f"the local copy is kept"
+            ) from e
+        self.vm_manager.remove_instance(self.vm)
+        return "migrated" if spec["running"] else "moved (stopped)"
+
+
+class MigrationManager:
+    """
+    Migrates many instances to a host at once. The bandwidth limit, in
+    KiB/s, is shared by the copies that run at the same time.
+    """
+
+    def __init__(self, vm_manager, host: str, jobs=2, bwlimit=0):
+        self.vm_manager = vm_manager
+        if not host or host.startswith("-"):
+            raise ApplicationError(f"Invalid host: {host}")
+        self.host = host
+        self.jobs = int(jobs)
+        if self.jobs < 1:
+            raise ApplicationError(f"Invalid number of jobs: {jobs}")
+        self.bwlimit = int(bwlimit)
+        if self.bwlimit < 0:
+            raise ApplicationError(f"Invalid bandwidth limit: {bwlimit}")
+
+    def _migrate(self, vm, bwlimit):
+        result = OperationResult(vm)
+        start = time.monotonic()
+        try:
+            migration = XenMigration(self.vm_manager, vm, self.host, bwlimit)
+            result.message = migration.run()
+        except ApplicationError as e:
+            result.error = e.message
+        except Exception as e:
+            result.error = repr(e)
+        finally:
+            result.duration = time.monotonic() - start
+        return result
+
+    def run(self, vms):
+        """
+        Migrate all VMs and print the outcome for each.
+        """
+        jobs = min(self.jobs, len(vms))
+        bwlimit = max(self.bwlimit // jobs, 1) if self.bwlimit else 0
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(lambda vm: self._migrate(vm, bwlimit), vms))
+        failed = [r for r in results if r.error]
+        for r in results:
+            outcome = f"failed: {r.error}" if r.error else r.message
+            print(f"{r.vm.id:<6} {r.vm.name:<40} {outcome} ({r.duration:.1f}s)")
+        if failed:
+            raise ApplicationError(
+                f"Migration to {self.host} failed for {len(failed)} of "
+                f"{len(results)} VMs."
+            )
@@ -0,0 +1,297 @@
+import configparser
+import shutil
+from pathlib import Path
+
+from . import deploy
+from .guest import DirectoryEditor
+from .helpers import VmBackendHelper
+from .utils import CONTROL_TIMEOUT, ApplicationError, Command, file_lock, sh
+
+NSPAWNCFG_TEMPLATE = """# vmlight systemd-nspawn instance configuration
+[vm]
+name = {vm_id}-{name}
+ip = {ip}
+root_dir = {root_dir}
+"""
+
+NSPAWN_UNIT_TEMPLATE = """[Exec]
+Boot=yes
+
+[Network]
+{network}
+"""
+
+# Drop-in for the systemd-nspawn@ service of a routed instance, which sets
+# up the host side of its veth on every start, like the Xen vif-route script
+NSPAWN_ROUTE_DROPIN_TEMPLATE = """[Service]
+ExecStartPost=ip link set dev {host_interface} up
+ExecStartPost=ip addr replace {gateway}/32 dev {host_interface}
+ExecStartPost=ip route replace {ip}/32 dev {host_interface}
+ExecStartPost=sysctl -q -w net.ipv4.conf.{host_interface}.proxy_arp=1
+"""
+
+# Marker in an unpacked image recording the digest of the image it came from
+UNPACKED_SOURCE_FILE = ".vmlight-source"
+
+
+class MachineSnapshot:
+    """
+    The parsed output of a single 'machinectl list' call.
+    """
+
+    def __init__(self):
+        lines = Command(
+            ["machinectl", "list", "--no-legend", "--no-pager"], CONTROL_TIMEOUT
+        ).stream()
+        self.machines = {line.split()[0] for line in lines if line.strip()}
+
+
+_machine_snapshot = None
+
+
+def get_machine_snapshot(refresh=False) -> MachineSnapshot:
+    """
+    Get the running machines, running 'machinectl list' only if there is no
+    snapshot yet or a refresh is requested.
+    """
+    global _machine_snapshot
+    if refresh or _machine_snapshot is None:
+        _machine_snapshot = MachineSnapshot()
+    return _machine_snapshot
+
+
+def invalidate_machine_snapshot():
+    global _machine_snapshot
+    _machine_snapshot = None
+
+
+class NspawnVmHelper(VmBackendHelper):
+    """
+    Runs an instance as a systemd-nspawn container managed by machinectl.
+    """
+
+    config_file_name = "nspawn_vm.cfg"
+
+    def __init__(self, vm, config):
+        super().__init__(vm, config)
+        self.instances_dir = Path(config["general"]["instances_dir"]).absolute()
+        self.instance_dir = self.instances_dir / f"{self.vm.id}-{self.vm.name}"
+        self.machine_name = f"{self.vm.id}-{self.vm.name}"
+
+    @staticmethod
+    def get_route_dropin_file(config, machine_name):
+        """
+        Get the systemd-nspawn@ service drop-in that routes to an instance.
+        """
+        return (
+            Path(config["nspawn"]["unit_dir"])
+            / f"systemd-nspawn@{machine_name}.service.d"
+            / "vmlight-route.conf"
+        )
+
+    def is_running(self):
+        return self.machine_name in get_machine_snapshot().machines
+
+    def get_boot_id(self):
+        # The leader process is started anew on each boot
+        leader = sh(
+            ["machinectl", "show", "--property=Leader", "--value", self.machine_name],
+            error_ok=True,
+            timeout=CONTROL_TIMEOUT,
+        )
+        return leader.strip() or None
+
+    def _machinectl(self, command, action):
+        try:
+            sh(["machinectl", command, self.machine_name], timeout=CONTROL_TIMEOUT)
+            invalidate_machine_snapshot()
+            return True
+        except ApplicationError as e:
+            raise ApplicationError(f"Error {action} systemd-nspawn instance: {e}") from e
+
+    def start(self):
+        return self._machinectl("start", "starting")
+
+    def stop(self):
+        return self._machinectl("poweroff", "stopping")
+
+    def restart(self):
+        return self._machinectl("reboot", "restarting")
+
+    def destroy(self):
+        return self._machinectl("terminate", "destroying")
+
+    @classmethod
+    def refresh_state(cls, config):
+        invalidate_machine_snapshot()
+
+    @classmethod
+    def read_instance_info(cls, instance_dir):
+        parser = configparser.ConfigParser()
+        parser.read(instance_dir / cls.config_file_name)
+        vm_config = parser["vm"]
+        return {"ip": vm_config.get("ip"), "disk_file": vm_config.get("root_dir")}
+
+    def get_disk_file(self):
+        return self.instance_dir / "rootfs"
+
+    def delete(self):
+        nspawn_config = self.config["nspawn"]
+        sh(
+            ["machinectl", "disable", self.machine_name],
+            error_ok=True,
+            timeout=CONTROL_TIMEOUT,
+        )
+        for link in [
+            Path(nspawn_config["machines_dir"]) / self.machine_name,
+            Path(nspawn_config["conf_dir"]) / f"{self.machine_name}.nspawn",
+        ]:
+            link.unlink(missing_ok=True)
+        dropin_file = self.get_route_dropin_file(self.config, self.machine_name)
+        if dropin_file.exists():
+            dropin_file.unlink()
+            dropin_file.parent.rmdir()
+            sh(["systemctl", "daemon-reload"], error_ok=True, timeout=CONTROL_TIMEOUT)
+
+
+class NspawnDeployManager(deploy.DeployManager):
+    """
+    Deploys a container whose root directory is a copy of the image's root
+    filesystem. Each image is unpacked once into image_dir/unpacked, and
+    instances are cloned from there with reflinks where the filesystem
+    supports them, so they share their data blocks until written to.
+    """
+
+    vm_type = "systemd-nspawn"
+    guest_interface = "host0"
+
+    def __init__(self, args, config):
+        if not shutil.which("machinectl"):
+            raise ApplicationError("machinectl is not installed.")
+        self.machines_dir = Path(config["nspawn"]["machines_dir"])
+        self.nspawn_conf_dir = Path(config["nspawn"]["conf_dir"])
+        super().__init__(args, config)
+
+    def _setup_instance_paths(self):
+        super()._setup_instance_paths()
+        self.machine_name = f"{self.vm_id}-{self.instance_name}"
+        self.instance_config_file = self.instance_dir / NspawnVmHelper.config_file_name
+        self.nspawn_unit_file = self.instance_dir / f"{self.machine_name}.nspawn"
+        self.nspawn_unit_link = self.nspawn_conf_dir / f"{self.machine_name}.nspawn"
+        self.machine_link = self.machines_dir / self.machine_name
+        # Named like the Xen vif and KVM tap device of the same VM ID
+        self.host_interface = f"vm{self.vm_id}"
+        self.route_dropin_file = NspawnVmHelper.get_route_dropin_file(
+            self.config, self.machine_name
+        )
+
+    def _get_disk_file_name(self):
+        return "rootfs"
+
+    def _unpack_image(self):
+        """
+        Get the unpacked root filesystem of the image, unpacking it if it
+        is missing or was unpacked from an earlier image of the same name.
+        """
+        image_file = self.image_manager.get_path_by_name(self.args["image"])
+        unpacked_dir = self.image_dir / "unpacked" / self.args["image"]
+        source = self.image_manager.get_digest(self.args["image"]) or str(
+            image_file.stat().st_mtime_ns
+        )
+        with file_lock(unpacked_dir.with_name(f".{unpacked_dir.name}.lock")):
+            marker = unpacked_dir / UNPACKED_SOURCE_FILE
+            if marker.exists() and marker.read_text() == source:
+                return unpacked_dir
+            self.log(f"Unpacking image {self.args['image']}...")
+            tmp_dir = unpacked_dir.with_name(f".{unpacked_dir.name}.tmp")
+            tar_file = unpacked_dir.with_name(f".{unpacked_dir.name}.tar")
+            sh(["rm", "-rf", tmp_dir, unpacked_dir])
+            tmp_dir.mkdir(parents=True)
+            try:
+                sh(
+                    [
+                        # Inspection finds and mounts the root filesystem,
+                        # whatever the partition layout
+                        "guestfish", "--ro", "-a", image_file, "-i",
+                        "tar-out", "/", tar_file,
+                    ]
+                )
+                sh(["tar", "--numeric-owner", "-xpf", tar_file, "-C", tmp_dir])
+                (tmp_dir / UNPACKED_SOURCE_FILE).write_text(source)
+                tmp_dir.rename(unpacked_dir)
+            finally:
+                sh(["rm", "-rf", tmp_dir, tar_file])
+        return unpacked_dir
+
+    def copy_image(self):
+        if self.args.get("linked_clone"):
+            raise ApplicationError("Linked clones are not supported for systemd-nspawn.")
+        unpacked_dir = self._unpack_image()
+        sh(["cp", "-a", "--reflink=auto", unpacked_dir, self.disk_file])
+        (self.disk_file / UNPACKED_SOURCE_FILE).unlink(missing_ok=True)
+
+    def resize_disk(self):
+        """
+        A root directory has no size of its own.
+        """
+
+    def create_instance_config(self):
+        with open(self.instance_config_file, "w") as f:
+            f.write(
+                NSPAWNCFG_TEMPLATE.format(
+                    vm_id=self.vm_id,
+                    name=self.instance_name,
+                    ip=self.args["ip"],
+                    root_dir=self.disk_file,
+                )
+            )
+        bridge = self.config["nspawn"]["bridge"]
+        if bridge:
+            network = f"VirtualEthernet=yes\nBridge={bridge}"
+        else:
+            # Routed like Xen and KVM instances, through a veth whose host
+            # side has a known name
+            network = (
+                f"VirtualEthernetExtra={self.host_interface}:{self.guest_interface}"
+            )
+            self.route_dropin_file.parent.mkdir(parents=True, exist_ok=True)
+            self.route_dropin_file.write_text(
+                NSPAWN_ROUTE_DROPIN_TEMPLATE.format(
+                    host_interface=self.host_interface,
+                    gateway=self.config["deploy"]["default_gateway"],
+                    ip=self.args["ip"],
+                )
+            )
+            sh(["systemctl", "daemon-reload"], timeout=CONTROL_TIMEOUT)
+        with open(self.nspawn_unit_file, "w") as f:
+            f.write(NSPAWN_UNIT_TEMPLATE.format(network=network))
+        self.nspawn_conf_dir.mkdir(parents=True, exist_ok=True)
+        self.nspawn_unit_link.symlink_to(self.nspawn_unit_file)
+        self.machines_dir.mkdir(parents=True, exist_ok=True)
+        self.machine_link.symlink_to(self.disk_file)
+
+    def remove_instance_config(self):
+        self.machine_link.unlink(missing_ok=True)
+        self.nspawn_unit_link.unlink(missing_ok=True)
+        self.nspawn_unit_file.unlink(missing_ok=True)
+        self.instance_config_file.unlink(missing_ok=True)
+        if self.route_dropin_file.exists():
+            self.route_dropin_file.unlink()
+            self.route_dropin_file.parent.rmdir()
+
+    def enable_instance_autostart(self):
+        sh(["machinectl", "enable", self.machine_name], timeout=CONTROL_TIMEOUT)
+
+    def disable_instance_autostart(self):
+        sh(
+            ["machinectl", "disable", self.machine_name],
+            error_ok=True,
+            timeout=CONTROL_TIMEOUT,
+        )
+
+    def get_guest_editor_name(self):
+        # The root directory is edited in place, whatever editor is configured
+        return DirectoryEditor.name
+
+    def get_guest_editor(self):
+        return DirectoryEditor(self.disk_file, self.instance_dir)
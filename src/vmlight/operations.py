@@ -0,0 +1,219 @@
+import asyncio
+import fnmatch
+import time
+
+from .inventory import DEPLOYED
+from .state import add_state_listener, remove_state_listener
+from .utils import ApplicationError
+
+# Operations and the state each one leaves the VM in (True means running)
+OPERATIONS = {
+    "start": True,
+    "stop": False,
+    "restart": True,
+}
+
+
+class DomainStatePoller:
+    """
+    Waits for VMs to reach a state. A single task refreshes the domain state
+    of all backends once per interval and wakes up every waiter whose
+    condition holds, so waiting on many VMs costs the same as waiting on one.
+    Backends with a live state tracker also wake the task as soon as their
+    state changes.
+    """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.waiters = []
+        self._task = None
+        self._changed = None
+        self._listener = None
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self._changed = asyncio.Event()
+
+        def listener():
+            try:
+                loop.call_soon_threadsafe(self._changed.set)
+            except RuntimeError:
+                pass  # The loop is closed
+
+        self._listener = listener
+        add_state_listener(listener)
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        remove_state_listener(self._listener)
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await asyncio.wait_for(self._changed.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._changed.clear()
+            if not self.waiters:
+                continue
+            waiters = list(self.waiters)
+            reached = await loop.run_in_executor(None, self._poll, waiters)
+            for (_, _, _, future), done in zip(waiters, reached):
+                if done and not future.done():
+                    future.set_result(True)
+
+    @staticmethod
+    def _poll(waiters):
+        """
+        Get whether each waiter's VM is in its target state.
+        """
+        refreshed = set()
+        reached = []
+        for helper, target, old_boot_id, _ in waiters:
+            if type(helper) not in refreshed:
+                type(helper).refresh_state(helper.config)
+                refreshed.add(type(helper))
+            done = helper.is_running() == target
+            if done and old_boot_id is not None:
+                done = helper.get_boot_id() not in (None, old_boot_id)
+            reached.append(done)
+        return reached
+
+    async def wait_for(self, helper, running: bool, timeout: float, old_boot_id=None):
+        """
+        Wait until a VM is (or is not) running, and with old_boot_id, has
+        booted again since. Returns False on timeout.
+        """
+        future = asyncio.get_running_loop().create_future()
+        waiter = (helper, running, old_boot_id, future)
+        self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(future, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+
+
+class OperationResult:
+    def __init__(self, vm):
+        self.vm = vm
+        self.error = None
+        self.message = ""
+        self.duration = 0.0
+
+
+class VmOperations:
+    """
+    Runs start/stop/restart on many VMs at once, with bounded concurrency,
+    optionally waiting for each VM to reach its target state. The concurrency
+    limit applies to issuing the operations; waiting takes no slot, so a slow
+    shutdown does not hold up the others.
+    """
+
+    def __init__(self, vm_manager, jobs=8, wait=False, timeout=300, force=False):
+        self.vm_manager = vm_manager
+        self.jobs = int(jobs)
+        if self.jobs < 1:
+            raise ApplicationError(f"Invalid number of jobs: {jobs}")
+        self.wait = wait
+        self.timeout = float(timeout)
+        self.force = force
+
+    def select(self, vm_ids=(), select_all=False, image=None, name_glob=None):
+        """
+        Get the VMs matching explicit IDs or selectors. With --all, --image or
+        --name-glob, all deployed VMs that match every given selector are
+        included, in addition to the explicit IDs.
+        """
+        selected = {vm_id: self.vm_manager.get_vm_by_id(vm_id) for vm_id in vm_ids}
+        if select_all or image or name_glob:
+            for vm in self.vm_manager.instances:
+                if vm.state != DEPLOYED:
+                    continue
+                if image and vm.image != image:
+                    continue
+                if name_glob and not fnmatch.fnmatchcase(vm.name, name_glob):
+                    continue
+                selected[vm.id] = vm
+        if not selected:
+            raise ApplicationError("No VMs selected.")
+        return sorted(selected.values(), key=lambda vm: int(vm.id))
+
+    def run(self, operation: str, vms):
+        """
+        Run an operation on all VMs and print the outcome for each.
+        """
+        if operation not in OPERATIONS:
+            raise ApplicationError(f"Unknown operation: {operation}")
+        results = asyncio.run(self._run_all(operation, vms))
+        failed = [r for r in results if r.error]
+        for r in results:
+            outcome = f"failed: {r.error}" if r.error else r.message
+            print(f"{r.vm.id:<6} {r.vm.name:<40} {outcome} ({r.duration:.1f}s)")
+        if failed:
+            raise ApplicationError(
+                f"{operation} failed for {len(failed)} of {len(results)} VMs."
+            )
+
+    async def _run_all(self, operation, vms):
+        semaphore = asyncio.Semaphore(self.jobs)
+        poller = DomainStatePoller()
+        poller.start()
+        try:
+            return await asyncio.gather(
+                *(self._run_one(operation, vm, semaphore, poller) for vm in vms)
+            )
+        finally:
+            await poller.stop()
+
+    async def _run_one(self, operation, vm, semaphore, poller):
+        result = OperationResult(vm)
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        try:
+            target = OPERATIONS[operation]
+            async with semaphore:
+                helper = self.vm_manager._get_vm_backend_helper(vm.id)
+                running = await loop.run_in_executor(None, helper.is_running)
+                if operation != "restart" and running == target:
+                    result.message = "already " + ("running" if target else "stopped")
+                    return result
+                if operation == "restart" and not running:
+                    raise ApplicationError("not running")
+                old_boot_id = None
+                if operation == "restart" and self.wait:
+                    # The VM is running before the restart as well as after
+                    # it, so waiting means waiting for the next boot
+                    old_boot_id = await loop.run_in_executor(None, helper.get_boot_id)
+                await loop.run_in_executor(None, getattr(helper, operation))
+                result.message = f"{operation} requested"
+            if self.wait:
+                await self._wait(operation, helper, target, poller, result, old_boot_id)
+        except ApplicationError as e:
+            result.error = e.message
+        except Exception as e:
+            result.error = repr(e)
+        finally:
+            result.duration = time.monotonic() - start
+        return result
+
+    async def _wait(self, operation, helper, target, poller, result, old_boot_id):
+        if await poller.wait_for(helper, target, self.timeout, old_boot_id):
+            result.message = "running" if target else "stopped"
+            return
+        if not (self.force and operation == "stop"):
+            raise ApplicationError(f"timed out after {self.timeout:.0f}s")
+        await asyncio.get_running_loop().run_in_executor(None, helper.destroy)
+        if not await poller.wait_for(helper, False, self.timeout):
+            raise ApplicationError("still running after destroy")
+        result.message = "destroyed after timeout"
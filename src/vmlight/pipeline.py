@@ -0,0 +1,123 @@
+import contextvars
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .trace import tracer
+from .utils import ApplicationError
+
+
+class Stage:
+    """
+    A step of a pipeline. A stage runs once all stages it depends on have
+    completed. If the pipeline fails, the rollback hook of every stage that
+    was started is called, in reverse order.
+    """
+
+    def __init__(self, name: str, message: str, run, deps=(), rollback=None):
+        self.name = name
+        self.message = message
+        self.run = run
+        self.deps = list(deps)
+        self.rollback = rollback
+
+
+class StageTiming:
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+
+class Pipeline:
+    """
+    Runs a set of stages as a dependency graph, running independent stages
+    concurrently.
+    """
+
+    def __init__(self, stages, max_workers=4, log=print):
+        self.stages = {s.name: s for s in stages}
+        self.max_workers = max_workers
+        self.log = log
+        self.timings = {}
+        self._check_graph()
+
+    def _check_graph(self):
+        for stage in self.stages.values():
+            for dep in stage.deps:
+                if dep not in self.stages:
+                    raise ApplicationError(
+                        f"Stage '{stage.name}' depends on unknown stage '{dep}'"
+                    )
+        done = set()
+        remaining = dict(self.stages)
+        while remaining:
+            ready = [n for n, s in remaining.items() if set(s.deps) <= done]
+            if not ready:
+                raise ApplicationError(
+                    f"Dependency cycle between stages: {', '.join(remaining)}"
+                )
+            for name in ready:
+                done.add(name)
+                del remaining[name]
+
+    def _run_stage(self, stage: Stage, origin: float, parent):
+        start = time.monotonic() - origin
+        try:
+            with tracer.span(stage.name, parent=parent):
+                stage.run()
+        finally:
+            self.timings[stage.name] = StageTiming(start, time.monotonic() - origin)
+
+    def run(self):
+        """
+        Run all stages. On failure, wait for the running stages to finish,
+        roll back every started stage and re-raise the first error.
+        """
+        origin = time.monotonic()
+        parent = tracer.current()  # Stages run in other threads
+        started = []
+        done = set()
+        running = {}
+        error = None
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                if error is None:
+                    for stage in self.stages.values():
+                        if stage in started or not set(stage.deps) <= done:
+                            continue
+                        self.log(f"{stage.message}...")
+                        started.append(stage)
+                        # Stages see the context of the caller, such as the
+                        # daemon job their output goes to
+                        future = executor.submit(
+                            contextvars.copy_context().run,
+                            self._run_stage,
+                            stage,
+                            origin,
+                            parent,
+                        )
+                        running[future] = stage
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    if future.exception() is None:
+                        done.add(stage.name)
+                    elif error is None:
+                        error = future.exception()
+        if error is not None:
+            self._rollback(started)
+            raise error
+
+    def _rollback(self, started):
+        for stage in reversed(started):
+            if stage.rollback is None:
+                continue
+            try:
+                stage.rollback()
+            except Exception as e:
+                self.log(f"Rollback of stage '{stage.name}' failed: {e!r}")
@@ -0,0 +1,218 @@
+import errno
+import fcntl
+import json
+import os
+import subprocess
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+from .clone import clone_file
+from .image import ImageManager, get_image_format
+from .utils import ApplicationError, file_lock, sh
+
+POOL_DISK_SUFFIX = ".qcow2"
+
+
+def get_pool_key(image: str, disk_size: str):
+    return f"{image}@{disk_size}"
+
+
+class InstancePool:
+    """
+    Keeps disks that are already copied from an image and resized, so that a
+    deploy only has to rename one into its instance directory and write the
+    per-instance files. Disks are kept per image and disk size in
+    pool_dir/<image>@<disk_size>, named after the digest of the image they
+    were copied from, and claimed with an atomic rename, so concurrent
+    deploys never get the same disk.
+
+    Pooled disks are only copied and resized, not customized: everything a
+    deploy writes into the guest (hostname, network configuration and SSH
+    keys) depends on the instance, so a claim saves the copy and resize
+    stages and the guest files are still written per deploy.
+
+    The state file holds the target size of each pool and its hit and miss
+    counters. Refills run in a separate 'vmlight pool --refill' process.
+    """
+
+    def __init__(self, config, image_manager=None):
+        self.config = config
+        self.image_manager = image_manager
+        self.pool_dir = Path(config["general"]["pool_dir"]).absolute()
+        self.state_file = self.pool_dir / "pool.json"
+        self.lock_file = self.pool_dir / "pool.lock"
+
+    @contextmanager
+    def _state(self):
+        """
+        Lock and load the pool state, and save it when the block exits
+        without an error.
+        """
+        with file_lock(self.lock_file):
+            state = {}
+            if self.state_file.exists():
+                state = json.loads(self.state_file.read_text())
+            yield state
+            tmp_file = self.state_file.with_name(f"{self.state_file.name}.tmp")
+            tmp_file.write_text(json.dumps(state, indent=2))
+            os.replace(tmp_file, self.state_file)
+
+    def _get_image_manager(self):
+        # A refill runs for long, so it reads the image index again each time
+        return self.image_manager or ImageManager(self.config)
+
+    def _read_state(self):
+        with file_lock(self.lock_file):
+            if self.state_file.exists():
+                return json.loads(self.state_file.read_text())
+        return {}
+
+    def _get_pool_dir(self, key: str):
+        return self.pool_dir / key
+
+    def get_ready_disks(self, key: str):
+        pool_dir = self._get_pool_dir(key)
+        if not pool_dir.exists():
+            return []
+        return sorted(pool_dir.glob(f"*{POOL_DISK_SUFFIX}"))
+
+    def set_size(self, image: str, disk_size: str, size: int):
+        """
+        Set the number of disks kept for an image and disk size.
+        """
+        if size < 0:
+            raise ApplicationError(f"Invalid pool size: {size}")
+        self._get_image_manager().get_path_by_name(image)  # Check that it exists
+        key = get_pool_key(image, disk_size)
+        with self._state() as state:
+            entry = state.setdefault(key, {"hits": 0, "misses": 0, "claim_seconds": 0.0})
+            entry.update(image=image, disk_size=disk_size, size=size)
+
+    def claim(self, image: str, disk_size: str, dst_file: Path):
+        """
+        Move a ready disk to dst_file. Returns True on a pool hit, and False
+        if there is no pool for the image and disk size or it is empty.
+        """
+        key = get_pool_key(image, disk_size)
+        start = time.monotonic()
+        entry = self._read_state().get(key)
+        if not entry or not entry["size"]:
+            return False
+        digest = self._get_image_manager().get_digest(image)
+        claimed = False
+        for disk in self.get_ready_disks(key):
+            if not disk.name.startswith(f"{digest}-"):
+                continue  # Copied from an earlier image of the same name
+            try:
+                os.rename(disk, dst_file)
+                claimed = True
+                break
+            except FileNotFoundError:
+                continue  # Claimed by a concurrent deploy
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                raise ApplicationError(
+                    f"Pool directory {self.pool_dir} must be on the same "
+                    "filesystem as the instances directory."
+                ) from e
+        latency = time.monotonic() - start
+        with self._state() as state:
+            entry = state.setdefault(key, entry)
+            entry["hits" if claimed else "misses"] += 1
+            if claimed:
+                entry["claim_seconds"] += latency
+        self.start_refill()
+        return claimed
+
+    def start_refill(self):
+        """
+        Refill the pools in a detached background process.
+        """
+        subprocess.Popen(
+            [sys.executable, "-m", "vmlight", "pool", "--refill"],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+
+    def refill(self):
+        """
+        Bring every pool to its target size. Only one refill runs at a time;
+        a refill started while another is running returns immediately.
+        """
+        refill_lock = self.pool_dir / "refill.lock"
+        self.pool_dir.mkdir(parents=True, exist_ok=True)
+        with open(refill_lock, "a") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            # Pools may be resized or new ones added while a refill runs
+            while self._refill_once():
+                pass
+
+    def _refill_once(self):
+        """
+        Add or remove one disk of the first pool that is not at its target
+        size. Returns False when all pools are at their target size.
+        """
+        for key, entry in self._read_state().items():
+            pool_dir = self._get_pool_dir(key)
+            for tmp_file in pool_dir.glob(".*.tmp"):
+                tmp_file.unlink()  # Left behind by an interrupted refill
+            digest = self._get_image_manager().get_digest(entry["image"])
+            for disk in self.get_ready_disks(key):
+                if not disk.name.startswith(f"{digest}-"):
+                    disk.unlink(missing_ok=True)
+            ready = self.get_ready_disks(key)
+            if len(ready) > entry["size"]:
+                ready[-1].unlink(missing_ok=True)
+                return True
+            if len(ready) < entry["size"]:
+                self._prepare_disk(entry["image"], entry["disk_size"], pool_dir)
+                return True
+        return False
+
+    def _prepare_disk(self, image: str, disk_size: str, pool_dir: Path):
+        """
+        Copy the image to a new disk of the pool and resize it. The guest
+        filesystem is left as it is in the image.
+        """
+        image_manager = self._get_image_manager()
+        src_file = image_manager.get_path_by_name(image)
+        disk_id = f"{image_manager.get_digest(image)}-{uuid.uuid4().hex}"
+        tmp_file = pool_dir / f".{disk_id}{POOL_DISK_SUFFIX}.tmp"
+        pool_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            if get_image_format(src_file) == "qcow2":
+                clone_file(src_file, tmp_file)
+            else:
+                sh(["qemu-img", "convert", "-O", "qcow2", src_file, tmp_file])
+            sh(["qemu-img", "resize", "-f", "qcow2", tmp_file, disk_size])
+            tmp_file.rename(pool_dir / f"{disk_id}{POOL_DISK_SUFFIX}")
+        except BaseException:
+            tmp_file.unlink(missing_ok=True)
+            raise
+
+    def status(self):
+        """
+        Print the size, hit and miss counters and claim latency of each pool.
+        """
+        state = self._read_state()
+        print(
+            f"{'IMAGE':<30} {'DISK':<8} {'READY':>5} {'SIZE':>5} "
+            f"{'HITS':>6} {'MISSES':>6} {'CLAIM':>8}"
+        )
+        for key, entry in sorted(state.items()):
+            ready = len(self.get_ready_disks(key))
+            hits = entry["hits"]
+            claim = f"{entry['claim_seconds'] / hits * 1000:.1f}ms" if hits else "-"
+            print(
+                f"{entry['image']:<30} {entry['disk_size']:<8} {ready:>5} "
+                f"{entry['size']:>5} {hits:>6} {entry['misses']:>6} {claim:>8}"
+            )
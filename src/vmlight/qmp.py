@@ -0,0 +1,86 @@
+import json
+import socket
+from pathlib import Path
+
+from .utils import ApplicationError
+
+
+class QmpClient:
+    """
+    Minimal client for the QEMU Machine Protocol over a Unix socket.
+    Use as a context manager:
+
+        with QmpClient(socket_path) as qmp:
+            status = qmp.execute("query-status")
+    """
+
+    def __init__(self, socket_path: Path, timeout=5.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.sock = None
+        self.reader = None
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def connect(self):
+        """
+        Connect to the socket and negotiate capabilities.
+        Raises ConnectionError if QEMU is not listening on the socket, and
+        socket.timeout or ApplicationError if it does not speak QMP.
+        """
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        try:
+            self.sock.connect(str(self.socket_path))
+        except (FileNotFoundError, ConnectionRefusedError) as e:
+            self.close()
+            raise ConnectionError(f"QMP socket {self.socket_path} unavailable") from e
+        try:
+            self.reader = self.sock.makefile("rb")
+            greeting = self._read_message()
+            if "QMP" not in greeting:
+                raise ApplicationError(f"Unexpected QMP greeting: {greeting}")
+            self.execute("qmp_capabilities")
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        if self.reader:
+            self.reader.close()
+            self.reader = None
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def _read_message(self):
+        line = self.reader.readline()
+        if not line:
+            raise ApplicationError(f"QMP socket {self.socket_path} closed")
+        try:
+            return json.loads(line)
+        except ValueError:
+            raise ApplicationError(f"Invalid QMP message: {line!r}") from None
+
+    def execute(self, command: str, arguments=None):
+        """
+        Execute a QMP command and return its result.
+        """
+        request = {"execute": command}
+        if arguments:
+            request["arguments"] = arguments
+        self.sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        while True:
+            message = self._read_message()
+            if "return" in message:
+                return message["return"]
+            if "error" in message:
+                raise ApplicationError(
+                    f"QMP command {command} failed: {message['error'].get('desc')}"
+                )
+            # Anything else is an asynchronous event, which we ignore
@@ -1,74 +1,409 @@
-from .utils import ApplicationError
+import base64
+import binascii
+import hashlib
+import os
+import struct
+import sys
+from contextlib import contextmanager
 from pathlib import Path
 
+from .guest import GuestFile
+from .utils import ApplicationError, file_lock
+
+# Prefix of group lines in the key store
+GROUP_PREFIX = "@group"
+
+# Prefixes of fingerprints, whose colon does not separate a user
+FINGERPRINT_PREFIXES = ["SHA256", "MD5"]
+
+KEY_STORE_HEADER = """# Put your SSH keys here, one per line as: TYPE KEY NAME
+# Groups of keys are lines of: @group GROUP NAME...
+"""
+
+
+def print_keys(keys, groups=None):
+    """
+    Print SSH keys and groups as returned by SshKeyManager.get_keys() and
+    SshKeyManager.get_groups().
+    """
+    print(
+        f"{'INDEX':<6} {'NAME':<30} {'TYPE':<20} "
+        f"{'KEY SNIPPET':<23} {'FINGERPRINT'}"
+    )
+    for index, k in enumerate(keys, start=1):
+        key_part = k["key"][:10] + "..." + k["key"][-10:]
+        print(
+            f"{index:<6} {k['name']:<30} {k['type']:<20} {key_part:<23} "
+            f"{k['fingerprint']}"
+        )
+    if groups:
+        print()
+        print(f"{'GROUP':<30} {'KEYS'}")
+        for name, members in groups.items():
+            print(f"{name:<30} {' '.join(members)}")
+
+
+class SshKey:
+    def __init__(self, key_type: str, key: str, name: str):
+        self.type = key_type
+        self.key = key
+        self.name = name
+        self.fingerprint = get_fingerprint(key_type, key)
+
+    @classmethod
+    def from_text(cls, text: str):
+        """
+        Parse a key given as "TYPE KEY NAME".
+        """
+        parts = text.strip().split(None, 2)
+        if len(parts) != 3:
+            raise ApplicationError(f"Invalid SSH key, expected TYPE KEY NAME: {text}")
+        return cls(*parts)
+
+    @property
+    def text(self):
+        return f"{self.type} {self.key} {self.name}"
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "type": self.type,
+            "key": self.key,
+            "fingerprint": self.fingerprint,
+        }
+
+
+def get_fingerprint(key_type: str, key: str):
+    """
+    Get the SHA256 fingerprint of a public key, as shown by ssh-keygen -l.
+    """
+    try:
+        blob = base64.b64decode(key, validate=True)
+        (length,) = struct.unpack(">I", blob[:4])
+        blob_type = blob[4 : 4 + length].decode("ascii")
+    except (binascii.Error, struct.error, UnicodeDecodeError):
+        raise ApplicationError(f"Invalid {key_type} key: {key[:20]}...") from None
+    if blob_type != key_type:
+        raise ApplicationError(f"Key of type {blob_type} is labelled {key_type}.")
+    digest = base64.b64encode(hashlib.sha256(blob).digest()).decode("ascii")
+    return f"SHA256:{digest.rstrip('=')}"
+
+
+def parse_key_target(text: str):
+    """
+    Split a key reference given as KEY or KEY:USER into the reference and
+    the guest user, which defaults to root. The colon of a fingerprint such
+    as SHA256:... does not separate a user.
+    """
+    reference, separator, user = text.rpartition(":")
+    if not separator or not reference or reference in FINGERPRINT_PREFIXES:
+        return text, "root"
+    return reference, user
+
+
+def _get_line_fingerprint(line: str):
+    """
+    Get the fingerprint of the key on an authorized_keys line, which may
+    start with options, or None if the line has no key we can read.
+    """
+    tokens = line.split()
+    for key_type, key in zip(tokens, tokens[1:]):
+        if key_type.startswith(("ssh-", "ecdsa-", "sk-")):
+            try:
+                return get_fingerprint(key_type, key)
+            except ApplicationError:
+                continue
+    return None
+
+
+def _parse_passwd(text: str):
+    """
+    Get the uid, gid and home directory of each user in /etc/passwd.
+    """
+    users = {}
+    for line in text.splitlines():
+        fields = line.split(":")
+        if len(fields) >= 6 and fields[2].isdigit() and fields[3].isdigit():
+            users.setdefault(fields[0], (int(fields[2]), int(fields[3]), fields[5]))
+    return users
+
+
+def _guess_home(user: str):
+    return "/root" if user == "root" else f"/home/{user}"
+
+
+class AuthorizedKeys:
+    """
+    Renders the authorized_keys files of guest users, as a deferred step of
+    a GuestManifest. The guest's /etc/passwd and the current files are read
+    in one batch, using the usual home directories as a guess, so that each
+    file is written once with the keys it already has followed by the new
+    ones, and owned by its user.
+    """
+
+    def __init__(self):
+        self.keys_by_user = {}
+
+    def add(self, user: str, keys):
+        user_keys = self.keys_by_user.setdefault(user, {})
+        for key in keys:
+            user_keys.setdefault(key.fingerprint, key)
+
+    def cloud_config(self):
+        """
+        Get the keys as cloud-config users, for a NoCloud seed. cloud-init
+        merges them into the users' authorized_keys and creates users that
+        do not exist.
+        """
+        return {
+            "users": [
+                {
+                    "name": user,
+                    "ssh_authorized_keys": [key.text for key in keys.values()],
+                }
+                for user, keys in self.keys_by_user.items()
+            ],
+            "disable_root": False,
+        }
+
+    def __call__(self, editor):
+        guesses = [
+            f"{_guess_home(user)}/.ssh/authorized_keys" for user in self.keys_by_user
+        ]
+        files = editor.read_files(["/etc/passwd"] + guesses)
+        users = _parse_passwd(files["/etc/passwd"] or "")
+        unknown = [user for user in self.keys_by_user if user not in users]
+        if unknown:
+            raise ApplicationError(
+                f"Users not found in the guest: {', '.join(unknown)}"
+            )
+        paths = {
+            user: f"{users[user][2].rstrip('/')}/.ssh/authorized_keys"
+            for user in self.keys_by_user
+        }
+        files.update(editor.read_files(paths.values()))
+
+        entries = []
+        for user, keys in self.keys_by_user.items():
+            uid, gid, home = users[user]
+            lines = (files[paths[user]] or "").splitlines()
+            present = {_get_line_fingerprint(line) for line in lines}
+            lines += [
+                key.text for key in keys.values() if key.fingerprint not in present
+            ]
+            ssh_dir = f"{home.rstrip('/')}/.ssh"
+            entries.append(GuestFile(ssh_dir, None, 0o700, (uid, gid)))
+            content = "".join(f"{line}\n" for line in lines)
+            entries.append(GuestFile(paths[user], content, 0o600, (uid, gid)))
+        return entries
+
 
 class SshKeyManager:
     """
-    Manages the list of SSH keys available for deployment.
+    Manages the store of SSH keys available for deployment. The keys are
+    indexed by name and by fingerprint, and no two keys may have the same
+    name or key material. Groups of keys can be deployed by their name,
+    which shares the namespace of key names.
+
+    Changes are made under a lock on the store, from its current content,
+    and written once per operation to a temporary file that replaces the
+    store.
     """
 
     def __init__(self, config) -> None:
         self.key_list_file = Path(config["deploy"]["ssh_key_list_file"])
         if not self.key_list_file.exists():
             raise EnvironmentError("SSH key store file doesn't exist!")
-        self.keys = self.key_list_file.read_text().splitlines()
-        self.keys = [
-            k.split(" ", maxsplit=2) for k in self.keys if (k and not k.startswith("#"))
-        ]
+        self.lock_file = self.key_list_file.with_name(
+            f".{self.key_list_file.name}.lock"
+        )
+        self._read_key_list()
+
+    @property
+    def keys(self):
+        return list(self.keys_by_name.values())
+
+    def _read_key_list(self):
+        self.keys_by_name = {}
+        self.keys_by_fingerprint = {}
+        self.groups = {}
+        # Kept as they are when the store is written, for the user to fix
+        self.invalid_lines = []
+        lines = self.key_list_file.read_text().splitlines()
+        for number, line in enumerate(lines, start=1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                if line.split(None, 1)[0] == GROUP_PREFIX:
+                    _, name, *members = line.split()
+                    self.groups[name] = members
+                else:
+                    key = SshKey.from_text(line)
+                    self.keys_by_name[key.name] = key
+                    self.keys_by_fingerprint.setdefault(key.fingerprint, key)
+            except (ApplicationError, ValueError) as e:
+                message = getattr(e, "message", str(e))
+                print(
+                    f"Warning: skipping invalid line {number} in "
+                    f"{self.key_list_file}: {message}",
+                    file=sys.stderr,
+                )
+                self.invalid_lines.append(line)
 
     def _write_key_list(self):
-        with self.key_list_file.open("w") as f:
-            f.write("# Put your SSH keys here\n")
-            for k in self.keys:
-                f.write(f"{k[0]} {k[1]} {k[2]}\n")
+        tmp_file = self.key_list_file.with_name(f".{self.key_list_file.name}.tmp")
+        with open(tmp_file, "w") as f:
+            f.write(KEY_STORE_HEADER)
+            for key in self.keys_by_name.values():
+                f.write(f"{key.text}\n")
+            for name, members in self.groups.items():
+                f.write(f"{GROUP_PREFIX} {name} {' '.join(members)}\n")
+            for line in self.invalid_lines:
+                f.write(f"{line}\n")
+        os.chmod(tmp_file, self.key_list_file.stat().st_mode & 0o7777)
+        os.replace(tmp_file, self.key_list_file)
+
+    @contextmanager
+    def _update(self):
+        """
+        Change the store in the block, which is written once at the end.
+        """
+        with file_lock(self.lock_file):
+            self._read_key_list()
+            yield
+            self._write_key_list()
+
+    def _check_new_name(self, name: str):
+        if name in self.keys_by_name or name in self.groups:
+            raise ApplicationError(
+                f"A key or group with the name {name} already exists in the store."
+            )
+
+    def _add(self, key: SshKey):
+        self._check_new_name(key.name)
+        existing = self.keys_by_fingerprint.get(key.fingerprint)
+        if existing:
+            raise ApplicationError(
+                f"Key {key.name} is already in the store as {existing.name}."
+            )
+        self.keys_by_name[key.name] = key
+        self.keys_by_fingerprint[key.fingerprint] = key
 
     def add_key(self, key_text: str):
         """
         Add a new SSH key to the store.
         """
-        key_type, key, key_name = key_text.split(" ", maxsplit=2)
-        for k in self.keys:
-            if k[2] == key_name:
-                raise ApplicationError(
-                    f"A key with the name {key_name} already exists in the store."
-                )
-        self.keys.append([key_type, key, key_name])  # type: ignore
-        self._write_key_list()
+        self.add_keys([key_text])
+
+    def add_keys(self, key_texts):
+        """
+        Add SSH keys to the store in one write. Nothing is added if any of
+        the keys is invalid or already in the store.
+        """
+        keys = [SshKey.from_text(text) for text in key_texts]
+        with self._update():
+            for key in keys:
+                self._add(key)
 
     def add_key_from_file(self, file: Path):
         """
-        Add a new SSH key to the store from a file.
+        Add the SSH keys in a file to the store.
         """
-        key_lines = file.read_text().splitlines()
-        for k in key_lines:
-            if not k.startswith("#"):
-                self.add_key(k)
+        self.add_keys(
+            line
+            for line in file.read_text().splitlines()
+            if line.strip() and not line.startswith("#")
+        )
 
     def remove_key(self, key_name: str):
         """
-        Remove an SSH key from the store.
+        Remove an SSH key from the store, and from the groups it is in.
+        """
+        with self._update():
+            key = self.keys_by_name.pop(key_name, None)
+            if key is None:
+                raise ApplicationError(
+                    f"Key with name {key_name} not found in the store."
+                )
+            if self.keys_by_fingerprint.get(key.fingerprint) is key:
+                del self.keys_by_fingerprint[key.fingerprint]
+            for members in self.groups.values():
+                if key_name in members:
+                    members.remove(key_name)
+
+    def add_group(self, group_name: str, key_names):
+        """
+        Create a group of keys, or replace the keys of an existing group.
+        """
+        with self._update():
+            if group_name in self.keys_by_name:
+                raise ApplicationError(
+                    f"A key with the name {group_name} already exists."
+                )
+            unknown = [name for name in key_names if name not in self.keys_by_name]
+            if unknown:
+                raise ApplicationError(
+                    f"Keys not found in the store: {', '.join(unknown)}"
+                )
+            self.groups[group_name] = list(dict.fromkeys(key_names))
+
+    def remove_group(self, group_name: str):
         """
-        for i, k in enumerate(self.keys):
-            if k[2] == key_name:
-                self.keys.pop(i)
-                self._write_key_list()
-                return
-        raise ApplicationError(f"Key with name {key_name} not found in the store.")
+        Remove a group, keeping its keys.
+        """
+        with self._update():
+            if self.groups.pop(group_name, None) is None:
+                raise ApplicationError(f"Group {group_name} not found in the store.")
+
+    def get_keys(self):
+        """
+        Get the name, type, key and fingerprint of all SSH keys in the store.
+        """
+        return [key.to_dict() for key in self.keys_by_name.values()]
+
+    def get_groups(self):
+        return {name: list(members) for name, members in self.groups.items()}
 
     def list_keys(self):
         """
-        List all SSH keys in the store.
+        List all SSH keys and groups in the store.
         """
-        print(f"{'INDEX':<6} {'NAME':<30} {'TYPE':<10} {'KEY SNIPPET'}")
-        for index, k in enumerate(self.keys, start=1):
-            key_part = k[1][:10] + "..." + k[1][-10:]
-            print(f"{index:<6} {k[2]:<30} {k[0]:<10} {key_part}")
+        print_keys(self.get_keys(), self.get_groups())
 
     def get_key_by_name(self, key_name: str, as_text: bool = False):
         """
         Get an SSH key by name.
         """
-        for k in self.keys:
-            if k[2] == key_name:
-                return f"{k[0]} {k[1]} {k[2]}" if as_text else k
-        raise ApplicationError(f"Key with name {key_name} not found in the store.")
+        key = self.keys_by_name.get(key_name)
+        if key is None:
+            raise ApplicationError(f"Key with name {key_name} not found in the store.")
+        return key.text if as_text else key
+
+    def resolve(self, references):
+        """
+        Get the keys for a list of key names, group names and fingerprints,
+        in order and without duplicates.
+        """
+        keys = {}
+        for reference in references:
+            if reference in self.groups:
+                members = self.groups[reference]
+                missing = [name for name in members if name not in self.keys_by_name]
+                if missing:
+                    raise ApplicationError(
+                        f"Group {reference} has keys not in the store: "
+                        f"{', '.join(missing)}"
+                    )
+                found = [self.keys_by_name[name] for name in members]
+            elif reference in self.keys_by_name:
+                found = [self.keys_by_name[reference]]
+            elif reference in self.keys_by_fingerprint:
+                found = [self.keys_by_fingerprint[reference]]
+            else:
+                raise ApplicationError(
+                    f"Key or group {reference} not found in the store."
+                )
+            for key in found:
+                keys.setdefault(key.fingerprint, key)
+        return list(keys.values())
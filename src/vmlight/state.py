@@ -0,0 +1,184 @@
+import queue
+import sys
+import threading
+
+from .utils import ApplicationError, Command
+
+# Seconds between full resyncs of a tracker, which catch state changes that
+# raise no event, such as a domain being paused
+RESYNC_INTERVAL = 60.0
+
+# Functions called with no arguments whenever a tracker's state changes
+_listeners = []
+_listeners_lock = threading.Lock()
+
+
+def add_state_listener(listener):
+    with _listeners_lock:
+        _listeners.append(listener)
+
+
+def remove_state_listener(listener):
+    with _listeners_lock:
+        if listener in _listeners:
+            _listeners.remove(listener)
+
+
+def _notify_listeners():
+    with _listeners_lock:
+        listeners = list(_listeners)
+    for listener in listeners:
+        listener()
+
+
+class DomainEvent:
+    """
+    A change of a domain: its new state, or None if it is gone. An event
+    without a VM ID says that something changed, and the whole state must
+    be read again.
+    """
+
+    def __init__(self, vm_id=None, domain=None):
+        self.vm_id = vm_id
+        self.domain = domain
+
+
+class QueueEventSource:
+    """
+    Events put on a queue by the caller, such as a fake event feed.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+
+    def put(self, event: DomainEvent):
+        self.queue.put(event)
+
+    def events(self):
+        while True:
+            event = self.queue.get()
+            if event is None:
+                return
+            yield event
+
+    def close(self):
+        self.queue.put(None)
+
+
+class XenstoreWatchSource:
+    """
+    Events from xenstore-watch on @introduceDomain and @releaseDomain, which
+    fire whenever a domain is created or destroyed. They do not say which
+    domain it was, so each one asks for a resync.
+    """
+
+    def __init__(self, xenstore_watch_path):
+        self.command = Command(
+            [xenstore_watch_path, "@introduceDomain", "@releaseDomain"]
+        )
+
+    def events(self):
+        for _ in self.command.stream():
+            yield DomainEvent()
+
+    def close(self):
+        self.command.cancel()
+
+
+class DomainStateTracker:
+    """
+    Keeps the state of all domains of a backend in memory, reading it in
+    full once with load() and then updating it from the events of a source.
+    Events that name a domain are applied directly; others, and a timer
+    every resync_interval, make the tracker load the whole state again.
+
+    The state is live while the source delivers events. If the source
+    fails, live turns False and callers should query the backend instead.
+    """
+
+    def __init__(self, load, source, resync_interval=RESYNC_INTERVAL):
+        self.load = load
+        self.source = source
+        self.resync_interval = resync_interval
+        self.domains = {}
+        self.live = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def start(self):
+        """
+        Load the state and start following the events.
+        """
+        self.resync()
+        self.live = True
+        threading.Thread(target=self._follow, daemon=True).start()
+        threading.Thread(target=self._resync_periodically, daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        self.live = False
+        self.source.close()
+
+    def get(self, vm_id):
+        """
+        Get the domain of a VM, or None if the VM has no domain.
+        """
+        return self.domains.get(str(vm_id))
+
+    def resync(self):
+        """
+        Load the whole state and apply what changed.
+        """
+        try:
+            domains = self.load()
+        except ApplicationError as e:
+            print(f"Reading domain state failed: {e.message}", file=sys.stderr)
+            return
+        with self._lock:
+            changed = {k: _domain_key(d) for k, d in self.domains.items()} != {
+                k: _domain_key(d) for k, d in domains.items()
+            }
+            self.domains = dict(domains)  # Also takes new usage counters
+        if changed:
+            _notify_listeners()
+
+    def _apply(self, changes):
+        if not changes:
+            return
+        with self._lock:
+            domains = dict(self.domains)
+            for vm_id, domain in changes.items():
+                if domain is None:
+                    domains.pop(str(vm_id), None)
+                else:
+                    domains[str(vm_id)] = domain
+            self.domains = domains  # Replaced whole, so readers need no lock
+        _notify_listeners()
+
+    def _follow(self):
+        try:
+            for event in self.source.events():
+                if self._stop.is_set():
+                    return
+                if event.vm_id is None:
+                    self.resync()
+                else:
+                    self._apply({event.vm_id: event.domain})
+        except ApplicationError as e:
+            if not self._stop.is_set():
+                print(f"Domain events stopped: {e.message}", file=sys.stderr)
+        finally:
+            self.live = False
+
+    def _resync_periodically(self):
+        while not self._stop.wait(self.resync_interval):
+            self.resync()
+
+
+def _domain_key(domain):
+    """
+    Get what decides whether a domain changed, leaving out usage counters.
+    """
+    if domain is None:
+        return None
+    return (domain.name, domain.domain_id, domain.state)
@@ -0,0 +1,243 @@
+import string
+import threading
+from pathlib import Path
+
+from .guest import GuestFile
+from .utils import ApplicationError
+
+# Built-in templates, which a file of the same name in the template directory
+# replaces. They are str.format templates, so literal braces are doubled.
+BUILTIN_TEMPLATES = {
+    "xen.cfg": """
+# This configures a PVH rather than PV guest
+type = "pvh"
+
+# Guest name
+name = "{vm_id}-{name}"
+
+# 128-bit UUID for the domain as a hexadecimal number.
+# Use "uuidgen" to generate one if required.
+# The default behavior is to generate a new UUID each time the guest is started.
+#uuid = "XXXXXXXX-XXXX-XXXX-XXXX-XXXXXXXXXXXX"
+
+# Kernel image to boot
+kernel = "{pvgrub_path}"
+
+# Initial memory allocation (MB)
+memory = {memory}
+
+# Number of VCPUS
+vcpus = {vcpus}
+
+# Network devices
+# A list of 'vifspec' entries as described in
+# docs/misc/xl-network-configuration.markdown
+vif = [ 'vifname=vm{vm_id},ip={ip}' ]
+
+# Disk Devices
+# A list of `diskspec' entries as described in
+# docs/misc/xl-disk-configuration.txt
+disk = [ {disks} ]
+""",
+    "networkd.network": """
+[Match]
+Name={interface}
+
+[Network]
+Address={ip}/{prefix}
+
+[Route]
+Destination={gateway}/32
+
+[Route]
+Gateway={gateway}
+Metric={metric}
+""",
+    "netplan.yaml": """network:
+  version: 2
+  ethernets:
+    {interface}:
+      addresses:
+        - {ip}/{prefix}
+      routes:
+        - to: {gateway}/32
+          scope: link
+        - to: 0.0.0.0/0
+          via: {gateway}
+          metric: {metric}
+""",
+    "ifupdown.interfaces": """auto {interface}
+iface {interface} inet static
+    address {ip}/{prefix}
+    up ip route replace {gateway}/32 dev {interface}
+    up ip route replace default via {gateway} dev {interface} metric {metric}
+""",
+}
+
+INTERFACE_VARIABLES = ["interface", "ip", "prefix", "gateway", "metric"]
+# Variables each template may use
+TEMPLATE_VARIABLES = {
+    "xen.cfg": ["vm_id", "name", "memory", "vcpus", "ip", "disks", "pvgrub_path"],
+    "networkd.network": INTERFACE_VARIABLES,
+    "netplan.yaml": INTERFACE_VARIABLES,
+    "ifupdown.interfaces": INTERFACE_VARIABLES,
+}
+
+# Templates loaded in this process, by template directory and name
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+class Template:
+    """
+    A str.format template, parsed once when it is loaded. The variables it
+    uses must be among the allowed ones, and rendering checks that all of
+    them are given and that no value is more than one line, so that a value
+    cannot add lines of its own to a configuration file.
+    """
+
+    def __init__(self, name: str, text: str, variables):
+        self.name = name
+        self.text = text
+        self.fields = set()
+        # Line breaks of the template itself, to check values for them quickly
+        self.line_breaks = 0
+        try:
+            parsed = list(string.Formatter().parse(text))
+        except ValueError as e:
+            raise ApplicationError(f"Invalid template {name}: {e}") from None
+        for literal, field, _, _ in parsed:
+            self.line_breaks += literal.count("\n")
+            if field is None:
+                continue
+            if not field.isidentifier():
+                raise ApplicationError(
+                    f"Invalid field {{{field}}} in template {name}, "
+                    f"fields must be plain variable names."
+                )
+            self.fields.add(field)
+        unknown = self.fields - set(variables)
+        if unknown:
+            raise ApplicationError(
+                f"Template {name} uses unknown variables: {', '.join(sorted(unknown))}"
+            )
+
+    def render(self, **values):
+        missing = self.fields - values.keys()
+        if missing:
+            raise ApplicationError(
+                f"Missing variables for template {self.name}: "
+                f"{', '.join(sorted(missing))}"
+            )
+        text = self.text.format_map(values)
+        if text.count("\n") != self.line_breaks:
+            broken = [key for key in sorted(self.fields) if "\n" in str(values[key])]
+            raise ApplicationError(
+                f"Variables of template {self.name} have line breaks: "
+                f"{', '.join(broken)}"
+            )
+        return text
+
+
+def get_template(config, name: str):
+    """
+    Get a template from the template directory, or the built-in one if the
+    directory has no file of that name. Templates are loaded once per
+    process, so changes to the files apply to processes started later.
+    """
+    template_dir = config["general"]["template_dir"]
+    template = _templates.get((template_dir, name))
+    if template is None:
+        if name not in TEMPLATE_VARIABLES:
+            raise ApplicationError(f"Unknown template: {name}")
+        with _templates_lock:
+            template_file = Path(template_dir) / name
+            if template_file.is_file():
+                text = template_file.read_text()
+            else:
+                text = BUILTIN_TEMPLATES[name]
+            template = Template(name, text, TEMPLATE_VARIABLES[name])
+            _templates[(template_dir, name)] = template
+    return template
+
+
+def render_template(config, name: str, /, **values):
+    """
+    Render a template with the given variables.
+    """
+    return get_template(config, name).render(**values)
+
+
+class GuestInterface:
+    """
+    A network interface of a guest, with its address and the gateway it
+    routes through.
+    """
+
+    def __init__(self, name: str, ip: str, gateway: str, prefix=32):
+        self.name = name
+        self.ip = ip
+        self.gateway = gateway
+        self.prefix = prefix
+
+
+class NetworkConfigRenderer:
+    """
+    Renders the network configuration of a guest as one file per interface,
+    from a template. The default route of each further interface gets a
+    higher metric, so that the first interface is preferred.
+    """
+
+    def __init__(self, name: str, template: str, path: str, mode=0o644):
+        self.name = name
+        self.template = template
+        self.path = path
+        self.mode = mode
+
+    def render(self, config, interfaces):
+        """
+        Get the guest files configuring the interfaces.
+        """
+        template = get_template(config, self.template)
+        return [
+            GuestFile(
+                self.path.format(interface=interface.name),
+                template.render(
+                    interface=interface.name,
+                    ip=interface.ip,
+                    prefix=interface.prefix,
+                    gateway=interface.gateway,
+                    metric=100 * (index + 1),
+                ),
+                self.mode,
+            )
+            for index, interface in enumerate(interfaces)
+        ]
+
+
+NETWORK_RENDERERS = {
+    renderer.name: renderer
+    for renderer in [
+        NetworkConfigRenderer(
+            "networkd",
+            "networkd.network",
+            "/etc/systemd/network/10-{interface}.network",
+        ),
+        # netplan warns about configuration files that others can read
+        NetworkConfigRenderer(
+            "netplan", "netplan.yaml", "/etc/netplan/60-vmlight-{interface}.yaml", 0o600
+        ),
+        NetworkConfigRenderer(
+            "ifupdown", "ifupdown.interfaces", "/etc/network/interfaces.d/{interface}"
+        ),
+    ]
+}
+
+
+def get_network_renderer(name: str):
+    if name not in NETWORK_RENDERERS:
+        raise ApplicationError(
+            f"Unknown network configuration {name}, "
+            f"expected one of: {', '.join(NETWORK_RENDERERS)}"
+        )
+    return NETWORK_RENDERERS[name]
@@ -0,0 +1,191 @@
+import contextvars
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+# Kinds of spans: the whole command, a phase of it, or a subprocess
+COMMAND = "command"
+PHASE = "phase"
+SUBPROCESS = "subprocess"
+
+_current_span = contextvars.ContextVar("vmlight_current_span", default=None)
+
+
+class Span:
+    def __init__(self, trace_id, name, kind, parent=None, attributes=None):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.name = name
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+        self._start = time.monotonic()
+        self.duration = 0.0
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def finish(self):
+        self.duration = time.monotonic() - self._start
+        self.end_ns = self.start_ns + int(self.duration * 1e9)
+
+    def to_otlp(self):
+        """
+        Get the span in the OTLP JSON encoding.
+        """
+        attributes = {"vmlight.kind": self.kind, **self.attributes}
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": _otlp_attributes(attributes),
+            # STATUS_CODE_OK or STATUS_CODE_ERROR
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+def _otlp_attributes(attributes):
+    result = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            encoded = {"boolValue": value}
+        elif isinstance(value, int):
+            encoded = {"intValue": str(value)}
+        elif isinstance(value, float):
+            encoded = {"doubleValue": value}
+        else:
+            encoded = {"stringValue": str(value)}
+        result.append({"key": key, "value": encoded})
+    return result
+
+
+class Tracer:
+    """
+    Records spans for the phases of a command and for every subprocess it
+    runs. Spans nest under the span that is current in the calling thread;
+    work handed to other threads passes its parent explicitly.
+    """
+
+    def __init__(self):
+        self.trace_id = os.urandom(16).hex()
+        self.spans = []
+        self.origin = time.monotonic()
+        # Long-running processes turn this off, so that spans do not pile up
+        self.recording = True
+        self._lock = threading.Lock()
+
+    def current(self):
+        return _current_span.get()
+
+    def start_span(self, name: str, kind=PHASE, parent=None, **attributes):
+        """
+        Start a span without making it current, for work that outlives the
+        block it starts in. It is recorded by end_span().
+        """
+        return Span(self.trace_id, name, kind, parent or self.current(), attributes)
+
+    def end_span(self, span: Span, error: BaseException = None):
+        if error is not None:
+            span.error = getattr(error, "message", None) or repr(error)
+        span.finish()
+        if self.recording:
+            with self._lock:
+                self.spans.append(span)
+
+    @contextmanager
+    def span(self, name: str, kind=PHASE, parent=None, **attributes):
+        """
+        Record a span for the duration of the block. Errors raised in the
+        block are recorded on the span and re-raised.
+        """
+        span = self.start_span(name, kind, parent, **attributes)
+        token = _current_span.set(span)
+        error = None
+        try:
+            yield span
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            _current_span.reset(token)
+            self.end_span(span, error)
+
+    def print_summary(self):
+        """
+        Print the time spent per phase and per program run as a subprocess.
+        """
+        phases = {}
+        commands = {}
+        for span in sorted(self.spans, key=lambda s: s.start_ns):
+            if span.kind == PHASE:
+                phases.setdefault(span.name, []).append(span)
+            elif span.kind == SUBPROCESS:
+                program = Path(span.attributes.get("process.command", "?")).name
+                commands.setdefault(program, []).append(span)
+
+        origin_ns = min((s.start_ns for s in self.spans), default=0)
+        print()
+        print(f"{'PHASE':<30} {'COUNT':>5} {'START':>8} {'TOTAL':>8} {'MAX':>8}")
+        for name, spans in phases.items():
+            start = (spans[0].start_ns - origin_ns) / 1e9
+            print(
+                f"{name:<30} {len(spans):>5} {start:>7.2f}s "
+                f"{sum(s.duration for s in spans):>7.2f}s "
+                f"{max(s.duration for s in spans):>7.2f}s"
+            )
+        print()
+        print(
+            f"{'COMMAND':<30} {'COUNT':>5} {'TOTAL':>8} {'MAX':>8} "
+            f"{'FAILED':>6} {'STDERR':>8}"
+        )
+        for program, spans in sorted(
+            commands.items(), key=lambda c: -sum(s.duration for s in c[1])
+        ):
+            failed = sum(1 for s in spans if s.attributes.get("process.exit_code"))
+            stderr = sum(s.attributes.get("process.stderr_bytes", 0) for s in spans)
+            print(
+                f"{program:<30} {len(spans):>5} "
+                f"{sum(s.duration for s in spans):>7.2f}s "
+                f"{max(s.duration for s in spans):>7.2f}s {failed:>6} {stderr:>7}B"
+            )
+        print()
+        print(f"Total: {time.monotonic() - self.origin:.2f}s")
+
+    def write(self, trace_file: Path):
+        """
+        Append the spans to a file as one line of OTLP JSON, as written by
+        the OpenTelemetry file exporter.
+        """
+        resource = {"service.name": "vmlight", "host.name": socket.gethostname()}
+        request = {
+            "resourceSpans": [
+                {
+                    "resource": {"attributes": _otlp_attributes(resource)},
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "vmlight"},
+                            "spans": [span.to_otlp() for span in self.spans],
+                        }
+                    ],
+                }
+            ]
+        }
+        trace_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(trace_file, "a") as f:
+            f.write(json.dumps(request) + "\n")
+
+
+tracer = Tracer()
@@ -1,6 +1,15 @@
-import subprocess
+import contextvars
+import fcntl
 import os
+import shlex
+import subprocess
 import sys
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+from .trace import SUBPROCESS, tracer
 
 
 class VmlightError(Exception):
@@ -19,17 +28,255 @@ class ApplicationError(VmlightError):
     """
 
 
-def sh(cmd: str, error_ok: bool = False) -> str:
+# Timeout in seconds of commands that control or query a VM, which should
+# return quickly; long-running commands such as image copies have none
+CONTROL_TIMEOUT = 120
+# Number of commands the shared executor runs at the same time
+MAX_PARALLEL_COMMANDS = 8
+# Amount of stderr included in the message of a failed command
+STDERR_TAIL_SIZE = 2000
+
+_active_commands = set()
+_active_lock = threading.Lock()
+_executor = None
+
+
+def _get_argv(cmd) -> list:
+    """
+    Get the argument vector of a command. Commands should be given as lists;
+    strings are split with shell quoting rules.
+    """
+    if isinstance(cmd, str):
+        return shlex.split(cmd)
+    return [str(arg) for arg in cmd]
+
+
+def _stderr_tail(stderr: str) -> str:
+    stderr = stderr.strip()
+    if len(stderr) > STDERR_TAIL_SIZE:
+        stderr = "..." + stderr[-STDERR_TAIL_SIZE:]
+    return stderr
+
+
+class Command:
+    """
+    A command run as a subprocess from an argument vector, never through a
+    shell. Each run is recorded as a span with its duration, exit code and
+    the size of its stderr. A command can be given a timeout, after which
+    it is killed, and can be cancelled from another thread. The stderr of
+    a quiet command is only kept for the error of a failed run.
+    """
+
+    def __init__(self, cmd, timeout: float = None, quiet: bool = False):
+        self.argv = _get_argv(cmd)
+        self.command_line = shlex.join(self.argv)
+        self.timeout = timeout
+        self.quiet = quiet
+        self.process = None
+        self.cancelled = False
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        """
+        Kill the command if it is running, and keep it from starting.
+        """
+        with self._lock:
+            self.cancelled = True
+            if self.process is not None and self.process.poll() is None:
+                self.process.kill()
+
+    def _start(self, span):
+        span.set("process.command_line", self.command_line)
+        with self._lock:
+            if self.cancelled:
+                with _active_lock:
+                    _active_commands.discard(self)
+                raise ApplicationError(f"Command cancelled: {self.command_line}")
+            try:
+                self.process = subprocess.Popen(
+                    self.argv,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                )
+            except OSError as e:
+                with _active_lock:
+                    _active_commands.discard(self)
+                raise ApplicationError(f"Command failed: {self.command_line}: {e}")
+        with _active_lock:
+            _active_commands.add(self)
+
+    def _finish(self, span, stderr: bytes, timed_out: bool, error_ok: bool):
+        """
+        Check the result of the command, returning True if it succeeded.
+        """
+        with _active_lock:
+            _active_commands.discard(self)
+        returncode = self.process.returncode
+        span.set("process.exit_code", returncode)
+        span.set("process.stderr_bytes", len(stderr))
+        stderr = stderr.decode("utf-8", errors="replace")
+        if self.cancelled:
+            raise ApplicationError(f"Command cancelled: {self.command_line}")
+        if timed_out:
+            message = f"Command timed out after {self.timeout}s: {self.command_line}"
+        elif returncode != 0:
+            message = f"Command failed: {self.command_line}: return code {returncode}"
+        else:
+            if not self.quiet:
+                sys.stderr.write(stderr)
+            return True
+        if error_ok:
+            if not self.quiet:
+                sys.stderr.write(stderr)
+            return False
+        if stderr.strip():
+            message += f": {_stderr_tail(stderr)}"
+        raise ApplicationError(message)
+
+    def run(self, error_ok: bool = False) -> str:
+        """
+        Run the command and return its output. A failed command raises an
+        ApplicationError that includes the end of its stderr, or returns ""
+        if error_ok is set. A cancelled command always raises.
+        """
+        with tracer.span(
+            self.command_line, SUBPROCESS, **{"process.command": self.argv[0]}
+        ) as span:
+            try:
+                self._start(span)
+            except ApplicationError:
+                if error_ok and not self.cancelled:
+                    return ""
+                raise
+            timed_out = False
+            try:
+                stdout, stderr = self.process.communicate(timeout=self.timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                stdout, stderr = self.process.communicate()
+                timed_out = True
+            except BaseException:
+                self.process.kill()
+                self.process.wait()
+                with _active_lock:
+                    _active_commands.discard(self)
+                raise
+            if not self._finish(span, stderr, timed_out, error_ok):
+                return ""
+            return stdout.decode("utf-8")
+
+    def stream(self):
+        """
+        Run the command and yield the lines of its output as they are
+        written, so that large outputs are never held in memory. Errors
+        are raised as in run() once the output ends. The command is killed
+        if the caller stops reading early.
+        """
+        span = tracer.start_span(
+            self.command_line, SUBPROCESS, **{"process.command": self.argv[0]}
+        )
+        error = None
+        stderr_chunks = []
+        timer = None
+        try:
+            self._start(span)
+            # Drain stderr alongside stdout, so neither pipe can fill up
+            reader = threading.Thread(
+                target=lambda: stderr_chunks.append(self.process.stderr.read()),
+                daemon=True,
+            )
+            reader.start()
+            timed_out = threading.Event()
+            if self.timeout is not None:
+
+                def expire():
+                    timed_out.set()
+                    self.process.kill()
+
+                timer = threading.Timer(self.timeout, expire)
+                timer.daemon = True
+                timer.start()
+            for line in self.process.stdout:
+                yield line.decode("utf-8")
+            self.process.wait()
+            reader.join()
+            self._finish(span, b"".join(stderr_chunks), timed_out.is_set(), False)
+        except BaseException as e:
+            if not isinstance(e, GeneratorExit):  # The caller stopped reading
+                error = e
+            if self.process is not None and self.process.poll() is None:
+                self.process.kill()
+                self.process.wait()
+            with _active_lock:
+                _active_commands.discard(self)
+            raise
+        finally:
+            if timer is not None:
+                timer.cancel()
+            if self.process is not None:
+                self.process.stdout.close()
+            tracer.end_span(span, error)
+
+
+def sh(cmd, error_ok: bool = False, timeout: float = None) -> str:
+    """
+    Execute a command, given as a list of arguments, and return the output.
+    See Command.run().
+    """
+    return Command(cmd, timeout).run(error_ok)
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _active_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=MAX_PARALLEL_COMMANDS, thread_name_prefix="sh"
+            )
+        return _executor
+
+
+def sh_async(cmd, error_ok: bool = False, timeout: float = None) -> Future:
+    """
+    Execute a command on the shared executor and return a future of its
+    output. The future's command attribute is the Command, which can be
+    cancelled while it runs.
+    """
+    command = Command(cmd, timeout)
+    with _active_lock:
+        _active_commands.add(command)  # So that it can be cancelled while queued
+    context = contextvars.copy_context()  # Keep the current span as parent
+    future = _get_executor().submit(context.run, command.run, error_ok)
+    future.command = command
+    return future
+
+
+def cancel_commands():
+    """
+    Cancel every command that is running or queued on the shared executor,
+    e.g. when the user interrupts.
+    """
+    with _active_lock:
+        commands = list(_active_commands)
+    for command in commands:
+        command.cancel()
+
+
+@contextmanager
+def file_lock(lock_file: Path):
     """
-    Execute a command and return the output.
+    Hold an exclusive lock on a file for the duration of the block.
+    The lock is shared between processes and between threads that open
+    the file separately.
     """
-    cmdlist = cmd.split(" ")
-    try:
-        return subprocess.check_output(cmdlist).decode("utf-8")
-    except subprocess.CalledProcessError as e:
-        if not error_ok:
-            raise ApplicationError(f"Command failed: {cmd}: return code {e.returncode}")
-        return ""
+    lock_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_file, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
 
 
 def require_root():
@@ -1,8 +1,12 @@
 from pathlib import Path
 from .utils import ApplicationError
 from .utils import sh
-from .xen import XenVmHelper
-import subprocess
+from .image import BACKING_IMAGE_FILE
+from .allocator import Allocator
+from .inventory import DEPLOYED, DEPLOYING, Inventory
+from .kvm import KvmDeployManager, KvmVmHelper
+from .nspawn import NspawnDeployManager, NspawnVmHelper
+from .xen import XenDeployManager, XenVmHelper
 from enum import Enum
 
 
@@ -14,10 +18,62 @@ class VmType(Enum):
 
 
 class Vm:
-    def __init__(self, vm_id, vm_name, vm_type):
+    def __init__(self, vm_id, vm_name, vm_type, state=DEPLOYED, image=None, ip=None):
         self.id = vm_id
         self.name = vm_name
         self.type = vm_type
+        self.state = state
+        self.image = image
+        self.ip = ip
+
+    @classmethod
+    def from_inventory(cls, row):
+        return cls(
+            str(row["vm_id"]),
+            row["name"],
+            VmType(row["type"]),
+            state=row["state"],
+            image=row["image"],
+            ip=row["ip"],
+        )
+
+
+VM_BACKEND_HELPERS = {
+    VmType.XEN: XenVmHelper,
+    VmType.KVM: KvmVmHelper,
+    VmType.SYSTEMD_NSPAWN: NspawnVmHelper,
+}
+
+DEPLOY_MANAGERS = {
+    VmType.XEN: XenDeployManager,
+    VmType.KVM: KvmDeployManager,
+    VmType.SYSTEMD_NSPAWN: NspawnDeployManager,
+}
+
+# Colors of the instance states in listings
+STATE_COLORS = {"deploying": "1;33", "running": "1;32", "stopped": "1;31"}
+
+
+def get_deploy_manager_class(vm_type: str):
+    """
+    Get the deploy manager class of an instance type.
+    """
+    try:
+        return DEPLOY_MANAGERS[VmType(vm_type)]
+    except (ValueError, KeyError):
+        raise ApplicationError(f"Unsupported instance type: {vm_type}") from None
+
+
+def print_instances(instances):
+    """
+    Print instances as returned by VmManager.get_instance_states().
+    """
+    print(f"{'ID':<6} {'NAME':<40} {'TYPE':<15} {'STATUS'}")
+    for instance in instances:
+        state = instance["state"]
+        status = f"\033[{STATE_COLORS[state]}m{state.capitalize()}\033[0m"
+        vm_type = instance["type"]
+        print(f"{instance['id']:<6} {instance['name']:<40} {vm_type:<15} {status}")
 
 
 class VmManager:
@@ -25,55 +81,123 @@ class VmManager:
         self.config = config
         self.instances_dir = Path(self.config["general"]["instances_dir"]).absolute()
         self.image_dir = Path(self.config["general"]["image_dir"]).absolute()
-        self.instances = self._get_instances()
+        self.inventory = Inventory(config)
+        self.allocator = Allocator(config)
+        if not self.inventory.exists():
+            self.rebuild_inventory()
+        elif not self.allocator.exists():
+            self.allocator.rebuild(
+                [(row["vm_id"], row["ip"]) for row in self.inventory.list()]
+            )
 
-    def _get_instances(self):
+    @property
+    def instances(self):
         """
         Get all VMs.
         """
-        if not self.instances_dir.exists():
-            return []
-        instances = [i.name for i in self.instances_dir.glob("*")]
-        instances.sort()
-        vms = []
-        for i in instances:
-            vm_id, vm_name = i.split("-")
-            vm_type = self._get_vm_type(i)
-            vms.append(Vm(vm_id, vm_name, vm_type))
-        return vms
-
-    def _get_vm_type(self, instance_dir_name):
-        if Path(self.instances_dir / instance_dir_name / "xen_vm.cfg").exists():
-            return VmType.XEN
+        return [Vm.from_inventory(row) for row in self.inventory.list()]
+
+    def _get_vm_type(self, instance_dir: Path):
+        for vm_type, helper_class in VM_BACKEND_HELPERS.items():
+            if (instance_dir / helper_class.config_file_name).exists():
+                return vm_type
         return VmType.UNKNOWN
 
+    def rebuild_inventory(self):
+        """
+        Rebuild the inventory from the instance directories, and the VM ID
+        and IP address pools from the inventory.
+        """
+        entries = {}
+        if self.instances_dir.exists():
+            for instance_dir in sorted(self.instances_dir.glob("*")):
+                vm_id, _, vm_name = instance_dir.name.partition("-")
+                if not (instance_dir.is_dir() and vm_id.isdigit() and vm_name):
+                    print(f"Skipping unrecognized instance directory: {instance_dir}")
+                    continue
+                fields = self._read_instance_fields(instance_dir)
+                if fields is None:
+                    print(f"Skipping instance of unknown type: {instance_dir}")
+                    continue
+                entries[int(vm_id)] = fields
+        self.inventory.rebuild(entries)
+        self.allocator.rebuild([(i, e.get("ip")) for i, e in entries.items()])
+        return len(entries)
+
+    def _read_instance_fields(self, instance_dir: Path):
+        """
+        Get the inventory fields of a deployed instance from its directory,
+        or None if its type is unknown.
+        """
+        vm_type = self._get_vm_type(instance_dir)
+        if vm_type == VmType.UNKNOWN:
+            return None
+        vm_name = instance_dir.name.partition("-")[2]
+        fields = {"name": vm_name, "type": vm_type.value, "state": DEPLOYED}
+        backing_image_file = instance_dir / BACKING_IMAGE_FILE
+        if backing_image_file.exists():
+            fields["image"] = backing_image_file.read_text().strip()
+            fields["linked_clone"] = 1
+        fields.update(VM_BACKEND_HELPERS[vm_type].read_instance_info(instance_dir))
+        return fields
+
+    def import_instance(self, instance_dir: Path, image=None):
+        """
+        Add an instance whose directory was moved here from another host to
+        the inventory, keeping its VM ID and IP address.
+        """
+        vm_id = instance_dir.name.partition("-")[0]
+        fields = self._read_instance_fields(instance_dir)
+        if not vm_id.isdigit() or fields is None:
+            raise ApplicationError(f"Not an instance directory: {instance_dir}")
+        if image:
+            fields.setdefault("image", image)
+        self.allocator.reserve(vm_id, fields.get("ip"))
+        try:
+            self.inventory.add(vm_id, **fields)
+        except ApplicationError:
+            self.allocator.release(vm_id, fields.get("ip"))
+            raise
+        return Vm.from_inventory(self.inventory.get(vm_id))
+
     def _get_vm_backend_helper(self, vm_id):
         vm = self.get_vm_by_id(vm_id)
-        if vm.type == VmType.XEN:
-            return XenVmHelper(vm, self.config)
+        if vm.type in VM_BACKEND_HELPERS:
+            return VM_BACKEND_HELPERS[vm.type](vm, self.config)
         raise ApplicationError(f"Unsupported VM type: {vm.type}")
 
+    def get_instance_states(self, vms=None):
+        """
+        Get the ID, name, type and state (deploying, running or stopped) of
+        all instances, or of the given VMs.
+        """
+        instances = []
+        for vm in self.instances if vms is None else vms:
+            if vm.state == DEPLOYING:
+                state = "deploying"
+            elif VM_BACKEND_HELPERS[vm.type](vm, self.config).is_running():
+                state = "running"
+            else:
+                state = "stopped"
+            instances.append(
+                {"id": vm.id, "name": vm.name, "type": vm.type.value, "state": state}
+            )
+        return instances
+
     def list_instances(self):
         """
         List all instances.
         """
-        print(f"{'ID':<6} {'NAME':<40} {'TYPE':<10} {'STATUS'}")
-        for vm in self.instances:
-            status = (
-                "\033[1;32mRunning\033[0m"
-                if self.is_running(vm.id)
-                else "\033[1;31mStopped\033[0m"
-            )
-            print(f"{vm.id:<6} {vm.name:<40} {vm.type.value:<10} {status}")
+        print_instances(self.get_instance_states())
 
     def get_vm_by_id(self, vm_id) -> Vm:
         """
         Get a VM by ID.
         """
-        for vm in self.instances:
-            if vm.id == vm_id:
-                return vm
-        raise ApplicationError(f"VM with ID {vm_id} not found")
+        row = self.inventory.get(vm_id) if str(vm_id).isdigit() else None
+        if row is None:
+            raise ApplicationError(f"VM with ID {vm_id} not found")
+        return Vm.from_inventory(row)
 
     def is_running(self, vm_id):
         """
@@ -117,6 +241,36 @@ class VmManager:
         )
         if confirmation != "YES, I am sure!":
             raise ApplicationError("Instance deletion aborted by user.")
-        sh(f"rm -rf {self.instances_dir / f'{vm_id}-{vm.name}'}")
+        self.remove_instance(vm)
+
+    def remove_instance(self, vm: Vm):
+        """
+        Remove the files, inventory entry, VM ID and IP address of an
+        instance that is not running.
+        """
+        sh(["rm", "-rf", self.instances_dir / f"{vm.id}-{vm.name}"])
+        VM_BACKEND_HELPERS[vm.type](vm, self.config).delete()
+        self.inventory.remove(vm.id)
+        self.allocator.release(vm.id, vm.ip)
+
+    def flatten_instance(self, vm_id):
+        """
+        Turn the overlay disk of a linked clone into a standalone disk.
+        """
+        vm = self.get_vm_by_id(vm_id)
+        backing_image_file = self.instances_dir / f"{vm_id}-{vm.name}" / BACKING_IMAGE_FILE
+        if not backing_image_file.exists():
+            raise ApplicationError(f"VM with ID {vm_id} is not a linked clone")
+        if self.is_running(vm_id):
+            raise ApplicationError(f"VM with ID {vm_id} is running")
         helper = self._get_vm_backend_helper(vm_id)
-        helper.delete()
+        disk_file = helper.get_disk_file()
+        flat_file = disk_file.with_name(f"{disk_file.name}.flat")
+        try:
+            sh(["qemu-img", "convert", "-O", "qcow2", disk_file, flat_file])
+        except ApplicationError:
+            flat_file.unlink(missing_ok=True)
+            raise
+        flat_file.replace(disk_file)
+        backing_image_file.unlink()
+        self.inventory.update(vm_id, linked_clone=0)
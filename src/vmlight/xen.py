@@ -1,98 +1,144 @@
-from .utils import ApplicationError, sh
+from .utils import CONTROL_TIMEOUT, ApplicationError, Command, sh
 from .helpers import VmBackendHelper
+from .state import RESYNC_INTERVAL, DomainStateTracker, XenstoreWatchSource
+from .templates import render_template
 from . import deploy
 from pathlib import Path
-import subprocess
+import re
+import shutil
 
-XENCFG_TEMPLATE = """
-# This configures a PVH rather than PV guest
-type = "pvh"
 
-# Guest name
-name = "{vm_id}-{name}"
+class XenDomain:
+    def __init__(self, name, domain_id, memory, vcpus, state, cpu_time):
+        self.name = name
+        self.domain_id = domain_id
+        self.memory = memory
+        self.vcpus = vcpus
+        self.state = state
+        self.cpu_time = cpu_time
 
-# 128-bit UUID for the domain as a hexadecimal number.
-# Use "uuidgen" to generate one if required.
-# The default behavior is to generate a new UUID each time the guest is started.
-#uuid = "XXXXXXXX-XXXX-XXXX-XXXX-XXXXXXXXXXXX"
+    def is_running(self):
+        return any(s in self.state for s in ["r", "b"])
+
+
+class XenDomainSnapshot:
+    """
+    The parsed output of a single 'xl list' call, indexed by VM ID
+    (the prefix of the domain name before the first '-').
+    """
+
+    def __init__(self, xl_path):
+        self.xl_path = xl_path
+        self.domains = self._get_domains()
+
+    def _get_domains(self):
+        lines = Command([self.xl_path, "list"], CONTROL_TIMEOUT).stream()
+        next(lines, None)  # Skip the header line
+        domains = {}
+        for line in lines:
+            columns = line.split()
+            if len(columns) < 6:
+                continue
+            name = columns[0]
+            domains[name.split("-", 1)[0]] = XenDomain(
+                name=name,
+                domain_id=columns[1],
+                memory=int(columns[2]),
+                vcpus=int(columns[3]),
+                state=columns[4],
+                cpu_time=float(columns[5]),
+            )
+        return domains
+
+    def get(self, vm_id):
+        """
+        Get the domain of a VM, or None if the VM has no domain.
+        """
+        return self.domains.get(str(vm_id))
 
-# Kernel image to boot
-kernel = "{pvgrub_path}"
 
-# Initial memory allocation (MB)
-memory = {memory}
+_domain_snapshots = {}
 
-# Number of VCPUS
-vcpus = {vcpus}
 
-# Network devices
-# A list of 'vifspec' entries as described in
-# docs/misc/xl-network-configuration.markdown
-vif = [ 'vifname=vm{vm_id},ip={ip}' ]
+def get_domain_snapshot(xl_path, refresh=False) -> XenDomainSnapshot:
+    """
+    Get the domain snapshot for an xl binary, running 'xl list' only
+    if there is no snapshot yet or a refresh is requested.
+    """
+    key = str(xl_path)
+    if refresh or key not in _domain_snapshots:
+        _domain_snapshots[key] = XenDomainSnapshot(xl_path)
+    return _domain_snapshots[key]
 
-# Disk Devices
-# A list of `diskspec' entries as described in
-# docs/misc/xl-disk-configuration.txt
-disk = [ '{disk_image},{disk_format},xvda,rw' ]
-"""
 
-NETWORK_CONFIG_TEMPLATE = """
-[Match]
-Name=enX0
+def invalidate_domain_snapshot(xl_path):
+    """
+    Drop the cached domain snapshot, e.g. after a domain changed state.
+    """
+    _domain_snapshots.pop(str(xl_path), None)
 
-[Network]
-Address={ip}/32
-Gateway={gateway}
 
-[Route]
-Destination={gateway}/32
-"""
+_domain_trackers = {}
+
+
+def get_domain_tracker(xl_path):
+    """
+    Get the domain state tracker of an xl binary, if one is live.
+    """
+    tracker = _domain_trackers.get(str(xl_path))
+    return tracker if tracker is not None and tracker.live else None
 
 
 class XenVmHelper(VmBackendHelper):
+    config_file_name = "xen_vm.cfg"
+
     def __init__(self, vm, config):
         super().__init__(vm, config)
         self.xl_path = Path(config["xen"]["xl_path"]).absolute()
         self.instances_dir = Path(config["general"]["instances_dir"]).absolute()
 
+    def _get_domain(self):
+        tracker = get_domain_tracker(self.xl_path)
+        if tracker is not None:
+            return tracker.get(self.vm.id)
+        return get_domain_snapshot(self.xl_path).get(self.vm.id)
+
     def _get_xen_domain_id(self):
         """
         Get the domain ID of a Xen VM.
         """
-        try:
-            result = sh(f"{self.xl_path} list")
-            lines = result.splitlines()
-            for line in lines[1:]:  # Skip the header line
-                columns = line.split()
-                name = columns[0]
-                domain_id = columns[1]
-                if name.startswith(f"{self.vm.id}-"):
-                    return domain_id
+        domain = self._get_domain()
+        if domain is None:
             raise ApplicationError(f"A running Xen VM with ID {self.vm.id} not found")
-        except subprocess.CalledProcessError as e:
-            raise ApplicationError(f"Error executing 'xl list': {e}") from e
+        return domain.domain_id
 
     def is_running(self):
-        try:
-            result = sh(f"{self.xl_path} list")
-            lines = result.splitlines()
-            for line in lines[1:]:  # Skip the header line
-                columns = line.split()
-                name = columns[0]
-                state = columns[4]
-                if name.startswith(f"{self.vm.id}-") and any(
-                    l in state for l in ["r", "b"]
-                ):
-                    return True
-            return False
-        except subprocess.CalledProcessError as e:
-            raise ApplicationError(f"Error executing 'xl list': {e}") from e
+        domain = self._get_domain()
+        return domain is not None and domain.is_running()
+
+    def get_boot_id(self):
+        # A reboot destroys the domain and creates a new one
+        domain = self._get_domain()
+        return domain.domain_id if domain is not None else None
+
+    def get_resource_usage(self):
+        domain = self._get_domain()
+        if domain is None:
+            return None
+        return {
+            "memory_bytes": domain.memory * 2**20,
+            "vcpus": domain.vcpus,
+            "cpu_seconds": domain.cpu_time,
+        }
 
     def start(self):
         try:
+            instance_dir = self.instances_dir / f"{self.vm.id}-{self.vm.name}"
             sh(
-                f"{self.xl_path} create {self.instances_dir / f'{self.vm.id}-{self.vm.name}' / 'xen_vm.cfg'}"
+                [self.xl_path, "create", instance_dir / self.config_file_name],
+                timeout=CONTROL_TIMEOUT,
             )
+            invalidate_domain_snapshot(self.xl_path)
             return True
         except ApplicationError as e:
             raise ApplicationError(f"Error starting Xen VM: {e}") from e
@@ -100,7 +146,8 @@ class XenVmHelper(VmBackendHelper):
     def stop(self):
         try:
             domain_id = self._get_xen_domain_id()
-            sh(f"{self.xl_path} shutdown {domain_id}")
+            sh([self.xl_path, "shutdown", domain_id], timeout=CONTROL_TIMEOUT)
+            invalidate_domain_snapshot(self.xl_path)
             return True
         except ApplicationError as e:
             raise ApplicationError(f"Error stopping Xen VM: {e}") from e
@@ -108,17 +155,70 @@ class XenVmHelper(VmBackendHelper):
     def restart(self):
         try:
             domain_id = self._get_xen_domain_id()
-            sh(f"{self.xl_path} reboot {domain_id}")
+            sh([self.xl_path, "reboot", domain_id], timeout=CONTROL_TIMEOUT)
+            invalidate_domain_snapshot(self.xl_path)
             return True
         except ApplicationError as e:
             raise ApplicationError(f"Error restarting Xen VM: {e}") from e
 
+    def destroy(self):
+        try:
+            domain_id = self._get_xen_domain_id()
+            sh([self.xl_path, "destroy", domain_id], timeout=CONTROL_TIMEOUT)
+            invalidate_domain_snapshot(self.xl_path)
+            return True
+        except ApplicationError as e:
+            raise ApplicationError(f"Error destroying Xen VM: {e}") from e
+
+    @classmethod
+    def refresh_state(cls, config):
+        invalidate_domain_snapshot(Path(config["xen"]["xl_path"]).absolute())
+
+    @classmethod
+    def start_state_tracking(cls, config, resync_interval=None):
+        xl_path = Path(config["xen"]["xl_path"]).absolute()
+        xenstore_watch_path = shutil.which(config["xen"]["xenstore_watch_path"])
+        if get_domain_tracker(xl_path) is not None:
+            return True
+        if xenstore_watch_path is None or not xl_path.exists():
+            return False
+        tracker = DomainStateTracker(
+            lambda: XenDomainSnapshot(xl_path).domains,
+            XenstoreWatchSource(xenstore_watch_path),
+            resync_interval or RESYNC_INTERVAL,
+        )
+        tracker.start()
+        _domain_trackers[str(xl_path)] = tracker
+        return True
+
+    @classmethod
+    def read_instance_info(cls, instance_dir):
+        text = (instance_dir / cls.config_file_name).read_text()
+        patterns = {
+            "memory": r"^memory\s*=\s*(\d+)",
+            "vcpus": r"^vcpus\s*=\s*(\d+)",
+            "ip": r"^vif\s*=.*\bip=([^,' \]]+)",
+            "disk_file": r"^disk\s*=\s*\[\s*'([^,']+)",
+        }
+        info = {}
+        for field, pattern in patterns.items():
+            match = re.search(pattern, text, re.MULTILINE)
+            if match:
+                info[field] = match.group(1)
+        return info
+
+    def get_disk_file(self):
+        return self.instances_dir / f"{self.vm.id}-{self.vm.name}" / "root.qcow2"
+
     def delete(self):
         auto_dir = Path(self.config["xen"]["conf_dir"]) / "auto"
-        sh(f"rm -f {auto_dir / f'{self.vm.id}-{self.vm.name}'}")
+        (auto_dir / f"{self.vm.id}-{self.vm.name}").unlink(missing_ok=True)
 
 
 class XenDeployManager(deploy.DeployManager):
+    vm_type = "xen"
+    guest_interface = "enX0"
+
     def __init__(self, args, config):
         self.xenconf_dir = Path(config["xen"]["conf_dir"]).absolute()
         if not self.xenconf_dir.exists():
@@ -146,16 +246,22 @@ class XenDeployManager(deploy.DeployManager):
         if disk_format not in ["qcow2", "raw"]:
             raise ApplicationError(f"Unsupported disk format: {disk_format}")
 
+        disks = [f"'{self.disk_file.absolute().as_posix()},{disk_format},xvda,rw'"]
+        seed_file = self.get_seed_file()
+        if seed_file:
+            disks.append(f"'{seed_file.absolute().as_posix()},raw,xvdb,ro'")
+
         with open(self.instance_config_file, "w") as f:
             f.write(
-                XENCFG_TEMPLATE.format(
+                render_template(
+                    self.config,
+                    "xen.cfg",
                     vm_id=self.vm_id,
                     name=self.instance_name,
                     memory=self.args["memory"],
                     vcpus=self.args["vcpus"],
                     ip=self.args["ip"],
-                    disk_image=self.disk_file.absolute().as_posix(),
-                    disk_format=disk_format,
+                    disks=", ".join(disks),
                     pvgrub_path=self.config["xen"]["pvgrub_path"],
                 )
             )
@@ -164,16 +270,8 @@ class XenDeployManager(deploy.DeployManager):
         self.xen_autostart_dir.mkdir(parents=True, exist_ok=True)
         self.xen_autostart_file.symlink_to(self.instance_config_file)
 
-    def deploy_network_config(self):
-        network_config_file = self.mount_point / "etc/systemd/network/10-enX0.network"
-        network_config_file.parent.mkdir(parents=True, exist_ok=True)
-        network_config_file.write_text(
-            NETWORK_CONFIG_TEMPLATE.format(
-                ip=self.args["ip"],
-                gateway=self.config["deploy"]["default_gateway"],
-            )
-        )
+    def remove_instance_config(self):
+        self.instance_config_file.unlink(missing_ok=True)
 
-    def cleanup_backend_specific(self):
-        self.instance_config_file.unlink()
-        self.xen_autostart_file.unlink()
+    def disable_instance_autostart(self):
+        self.xen_autostart_file.unlink(missing_ok=True)
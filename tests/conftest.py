@@ -0,0 +1,59 @@
+import shutil
+import tempfile
+from pathlib import Path
+
+import pytest
+
+from vmlight.__main__ import get_config
+
+
+@pytest.fixture
+def tmp_dir():
+    """
+    A temporary directory with a short path, as Unix socket paths are
+    limited to about 100 bytes.
+    """
+    path = Path(tempfile.mkdtemp(prefix="vmlight-", dir="/tmp"))
+    yield path
+    shutil.rmtree(path, ignore_errors=True)
+
+
+@pytest.fixture
+def config(tmp_dir, monkeypatch):
+    """
+    The default configuration, with all state kept in tmp_dir.
+    """
+    monkeypatch.setenv("HOME", str(tmp_dir))
+    config = get_config()
+    var_dir = tmp_dir / "var"
+    config["general"].update(
+        image_dir=str(var_dir / "images"),
+        instances_dir=str(var_dir / "instances"),
+        inventory_file=str(var_dir / "inventory.db"),
+        allocator_state_file=str(var_dir / "allocator.json"),
+        pool_dir=str(var_dir / "pool"),
+        socket_path=str(tmp_dir / "vmlightd.sock"),
+        template_dir=str(tmp_dir / "templates"),
+    )
+    config["deploy"]["subnet"] = "10.10.10.0/24"
+    config["deploy"]["ssh_key_list_file"] = str(tmp_dir / "ssh_key_store")
+    config["xen"]["conf_dir"] = str(var_dir / "xen")
+    return config
+
+
+@pytest.fixture
+def fake_bin(tmp_dir):
+    """
+    Create stand-in executables: fake_bin(name, script) writes a shell
+    script to tmp_dir/bin and returns its path.
+    """
+    bin_dir = tmp_dir / "bin"
+    bin_dir.mkdir(exist_ok=True)
+
+    def make(name, script):
+        path = bin_dir / name
+        path.write_text("#!/bin/sh\n" + script)
+        path.chmod(0o755)
+        return path
+
+    return make
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+A stand-in for guestfish that edits a directory instead of a disk.
+
+    FAKE_GUEST_ROOT=DIR FAKE_GUESTFISH_LOG=FILE stub_guestfish.py ARGS...
+
+It supports what GuestfishEditor uses: scripts given with -f, run in a
+session of their own (--ro or --rw) or in a --listen session through
+--remote, with the download, upload, mkdir-p, chmod and chown commands.
+Each invocation is logged as a line of JSON, with "launch" true when it
+would have started an appliance.
+"""
+import json
+import os
+import shlex
+import shutil
+import sys
+from pathlib import Path
+
+
+def guest_path(root: Path, path: str):
+    return root / path.lstrip("/")
+
+
+def run_script(root: Path, script_file: Path, read_only: bool):
+    for line in script_file.read_text().splitlines():
+        if not line.strip():
+            continue
+        command, *args = shlex.split(line)
+        ignore_errors = command.startswith("-")
+        command = command.lstrip("-")
+        try:
+            if command == "download":
+                shutil.copyfile(guest_path(root, args[0]), args[1])
+            elif read_only:
+                raise PermissionError(f"{command}: read-only session")
+            elif command == "upload":
+                shutil.copyfile(args[0], guest_path(root, args[1]))
+            elif command == "mkdir-p":
+                guest_path(root, args[0]).mkdir(parents=True, exist_ok=True)
+            elif command == "chmod":
+                os.chmod(guest_path(root, args[1]), int(args[0], 8))
+            elif command == "chown":
+                pass  # Not needed by the tests, and they may not run as root
+            else:
+                raise ValueError(f"unknown command {command}")
+        except (OSError, ValueError) as e:
+            if not ignore_errors:
+                print(f"libguestfs: error: {e}", file=sys.stderr)
+                sys.exit(1)
+
+
+def main():
+    args = sys.argv[1:]
+    root = Path(os.environ["FAKE_GUEST_ROOT"])
+    launch = "--remote" not in " ".join(args)
+    with open(os.environ["FAKE_GUESTFISH_LOG"], "a") as log:
+        log.write(json.dumps({"args": args, "launch": launch}) + "\n")
+    if "--listen" in args:
+        print("GUESTFISH_PID=4242; export GUESTFISH_PID")
+        return
+    if "exit" in args:
+        return
+    script_file = Path(args[args.index("-f") + 1])
+    run_script(root, script_file, read_only="--ro" in args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+A stand-in for QEMU that serves the QMP socket of an instance.
+
+    tests/stub_qemu.py SOCKET [--status running] [--greeting qmp|silent|garbage]
+
+The tests run it in a thread through StubQemu. As a script it serves until
+it receives 'quit', which lets a KVM instance be poked at by hand.
+"""
+import argparse
+import json
+import socket
+import threading
+from pathlib import Path
+
+GREETING = {"QMP": {"version": {"qemu": {"major": 8}}, "capabilities": []}}
+
+
+class StubQemu:
+    """
+    Answers QMP commands on a Unix socket like QEMU would:
+
+    - greeting "qmp" greets and answers commands, with an event before
+      each reply, and query-status reporting status;
+    - greeting "silent" accepts connections but never says anything;
+    - greeting "garbage" greets with a line that is not JSON.
+
+    Commands received are kept in commands.
+    """
+
+    def __init__(self, socket_path: Path, status="running", greeting="qmp"):
+        self.socket_path = Path(socket_path)
+        self.status = status
+        self.greeting = greeting
+        self.commands = []
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(str(self.socket_path))
+        self.server.listen(8)
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.running = True
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def stop(self):
+        self.running = False
+        self.server.close()
+        self.socket_path.unlink(missing_ok=True)
+
+    def serve(self):
+        while self.running:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                return
+            with connection:
+                self._handle(connection)
+
+    def _handle(self, connection):
+        stream = connection.makefile("rwb")
+        if self.greeting == "silent":
+            stream.read()  # Until the client gives up
+            return
+        if self.greeting == "garbage":
+            stream.write(b"220 smtp.example.com ESMTP\n")
+            stream.flush()
+            return
+        self._send(stream, GREETING)
+        for line in stream:
+            command = json.loads(line)["execute"]
+            self.commands.append(command)
+            self._send(stream, {"event": "STUB", "data": {}})
+            if command == "query-status":
+                self._send(stream, {"return": {"status": self.status}})
+            else:
+                self._send(stream, {"return": {}})
+            if command == "quit":
+                self.running = False
+                return
+
+    @staticmethod
+    def _send(stream, message):
+        stream.write(json.dumps(message).encode() + b"\n")
+        stream.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("socket")
+    parser.add_argument("--status", default="running")
+    parser.add_argument(
+        "--greeting", default="qmp", choices=["qmp", "silent", "garbage"]
+    )
+    args = parser.parse_args()
+    stub = StubQemu(args.socket, args.status, args.greeting)
+    try:
+        stub.serve()
+    finally:
+        stub.stop()
+
+
+if __name__ == "__main__":
+    main()
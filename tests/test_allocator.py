@@ -0,0 +1,27 @@
+import pytest
+
+from vmlight.allocator import Allocator
+from vmlight.utils import ApplicationError
+
+
+def test_allocate_requested_ip(config):
+    allocator = Allocator(config)
+    assert allocator.allocate("10.10.10.50") == (1, "10.10.10.50")
+    assert allocator.allocate()[1] != "10.10.10.50"
+
+
+@pytest.mark.parametrize(
+    "ip, error",
+    [
+        ("192.168.1.5", "IP address 192.168.1.5 is not in 10.10.10.0/24."),
+        ("10.10.10.1", "IP address 10.10.10.1 is the default gateway."),
+        ("10.10.10.300", "Invalid IP address: 10.10.10.300"),
+    ],
+)
+def test_allocate_rejects_invalid_ip(config, ip, error):
+    config["deploy"]["default_gateway"] = "10.10.10.1"
+    allocator = Allocator(config)
+    with pytest.raises(ApplicationError) as excinfo:
+        allocator.allocate(ip)
+    assert excinfo.value.message == error
+    assert allocator.check_free(1, "10.10.10.50") == []  # Nothing was recorded
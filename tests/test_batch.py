@@ -0,0 +1,27 @@
+from argparse import Namespace
+
+import pytest
+
+from vmlight.batch import BatchDeployManager
+from vmlight.utils import ApplicationError
+
+
+def read_manifest(tmp_dir, text):
+    manifest = tmp_dir / "manifest.ini"
+    manifest.write_text(text)
+    args = Namespace(manifest=str(manifest), jobs=2, image=None, linked_clone=False)
+    return BatchDeployManager(args, {}, None).instances
+
+
+def test_linked_clone_is_read_as_a_boolean(tmp_dir):
+    instances = read_manifest(
+        tmp_dir, "[DEFAULT]\nimage = debian\n\n[web1]\nlinked_clone = yes\n\n[web2]\n"
+    )
+    assert [i.linked_clone for i in instances] == [True, False]
+
+
+def test_invalid_linked_clone_names_the_instance(tmp_dir):
+    with pytest.raises(
+        ApplicationError, match="Invalid linked_clone for instance web1: maybe"
+    ):
+        read_manifest(tmp_dir, "[web1]\nimage = debian\nlinked_clone = maybe\n")
@@ -0,0 +1,84 @@
+import io
+import os
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+from vmlight.daemon import QUEUED, RUNNING, VmlightDaemon, _OutputRouter
+from vmlight.image import ImageManager
+
+STUB_GUESTFISH = Path(__file__).with_name("stub_guestfish.py")
+FAKE_QEMU_IMG = """
+case $1 in
+info) echo '{"format": "qcow2", "virtual-size": 1048576, "actual-size": 4096}';;
+resize) echo "qemu-img: resized $2 to $3" >&2;;
+esac
+"""
+
+
+@pytest.fixture
+def daemon(config, fake_bin, tmp_dir, monkeypatch):
+    """
+    A daemon that deploys Xen instances of the image 'debian' with the
+    guestfish stand-in.
+    """
+    fake_bin("qemu-img", FAKE_QEMU_IMG)
+    fake_bin("guestfish", f'exec {sys.executable} {STUB_GUESTFISH} "$@"\n')
+    xl = fake_bin("xl", "")
+    monkeypatch.setenv("PATH", f"{xl.parent}:{os.environ['PATH']}")
+    guest_root = tmp_dir / "guest"
+    (guest_root / "etc").mkdir(parents=True)
+    monkeypatch.setenv("FAKE_GUEST_ROOT", str(guest_root))
+    monkeypatch.setenv("FAKE_GUESTFISH_LOG", str(tmp_dir / "guestfish.log"))
+    config["xen"]["xl_path"] = str(xl)
+    Path(config["xen"]["conf_dir"]).mkdir(parents=True)
+    config["deploy"]["guest_editor"] = "guestfish"
+    image = tmp_dir / "debian.qcow2"
+    image.write_bytes(b"disk" * 1000)
+    ImageManager(config).add(str(image))
+    daemon = VmlightDaemon(config)
+    yield daemon
+    daemon._executor.shutdown(wait=True)
+
+
+def wait_for_job(daemon, job, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while job["state"] in (QUEUED, RUNNING):
+        if time.monotonic() > deadline:
+            raise AssertionError(f"Job {job['id']} did not finish")
+        time.sleep(0.05)
+        job = daemon.get_job(job["id"])
+    return job
+
+
+def test_pipelined_deploy_output_goes_to_the_job(daemon, monkeypatch):
+    # Routed as in vmlightd, with the daemon's own output kept apart
+    daemon_output = io.StringIO()
+    monkeypatch.setattr(sys, "stdout", _OutputRouter(daemon_output))
+    monkeypatch.setattr(sys, "stderr", _OutputRouter(daemon_output))
+    args = {
+        "type": "xen",
+        "name": "web",
+        "image": "debian",
+        "ip": None,
+        "disk_size": "2G",
+        "memory": "512",
+        "vcpus": "1",
+        "ssh_key": None,
+        "linked_clone": False,
+        "manifest": None,
+        "jobs": 1,
+        "interactive": False,
+    }
+    response = daemon.handle({"method": "deploy", "params": {"args": args}})
+    assert response["ok"], response
+    job = wait_for_job(daemon, response["result"])
+    assert job["error"] is None
+    # Printed in stage threads: messages, command stderr and editor timings
+    assert "Cloned image" in job["output"]
+    assert "qemu-img: resized" in job["output"]
+    assert "guestfish apply" in job["output"]
+    assert "Deployment complete!" in job["output"]
+    assert daemon_output.getvalue() == ""
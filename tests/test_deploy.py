@@ -0,0 +1,120 @@
+import os
+from argparse import Namespace
+
+import pytest
+
+from vmlight.image import ImageManager
+from vmlight.nspawn import NspawnDeployManager
+from vmlight.xen import XenDeployManager
+
+QEMU_IMG_INFO = '{"format": "qcow2", "virtual-size": 1048576, "actual-size": 4096}'
+
+
+def get_dependencies(manager, stage_name):
+    stages = {stage.name: stage for stage in manager.get_deploy_stages()}
+    return stages[stage_name].deps
+
+
+@pytest.fixture
+def nocloud_config(config, fake_bin, monkeypatch):
+    machinectl = fake_bin("machinectl", "")
+    monkeypatch.setenv("PATH", f"{machinectl.parent}:{os.environ['PATH']}")
+    config["deploy"]["guest_editor"] = "nocloud"
+    os.makedirs(config["xen"]["conf_dir"])
+    config["nspawn"]["machines_dir"] = str(machinectl.parent.parent / "machines")
+    return config
+
+
+def test_seed_is_written_without_waiting_for_the_disk(nocloud_config):
+    manager = XenDeployManager(Namespace(name="web", image="debian"), nocloud_config)
+    assert manager.uses_seed()
+    assert "create_instance_dir" in get_dependencies(manager, "apply_guest_manifest")
+    assert "resize_disk" not in get_dependencies(manager, "apply_guest_manifest")
+
+
+def test_nspawn_writes_into_the_copied_root(nocloud_config):
+    manager = NspawnDeployManager(
+        Namespace(name="web", image="debian"), nocloud_config
+    )
+    assert not manager.uses_seed()
+    assert manager.get_seed_file() is None
+    assert "resize_disk" in get_dependencies(manager, "apply_guest_manifest")
+
+
+@pytest.fixture
+def nspawn_config(config, fake_bin, tmp_dir, monkeypatch):
+    """
+    A config for nspawn deploys of the image 'debian', whose root
+    filesystem is tmp_dir/image-root, with stand-ins for the tools used.
+    """
+    image_root = tmp_dir / "image-root"
+    (image_root / "etc").mkdir(parents=True)
+    (image_root / "etc" / "os-release").write_text("ID=debian\n")
+    fake_bin("machinectl", "")
+    fake_bin("systemctl", f'echo "systemctl $*" >> {tmp_dir}/calls\n')
+    fake_bin("qemu-img", f"echo '{QEMU_IMG_INFO}'\n")
+    guestfish = fake_bin(
+        "guestfish",
+        f'echo "guestfish $*" >> {tmp_dir}/calls\n'
+        'for arg; do tar_file="$arg"; done\n'
+        f'tar -cf "$tar_file" -C {image_root} .\n',
+    )
+    monkeypatch.setenv("PATH", f"{guestfish.parent}:{os.environ['PATH']}")
+    config["nspawn"].update(
+        machines_dir=str(tmp_dir / "machines"),
+        conf_dir=str(tmp_dir / "nspawn"),
+        unit_dir=str(tmp_dir / "system"),
+    )
+    image = tmp_dir / "debian.qcow2"
+    image.write_bytes(b"disk")
+    ImageManager(config).add(str(image))
+    return config
+
+
+def deploy_nspawn(config):
+    args = Namespace(
+        name="web", image="debian", ip=None, memory="512", vcpus="1", disk_size="2G"
+    )
+    manager = NspawnDeployManager(args, config)
+    manager.log = lambda message: None
+    manager.create_instance_dir()
+    manager.copy_image()
+    manager.create_instance_config()
+    return manager
+
+
+def test_nspawn_unpacks_the_inspected_root(nspawn_config, tmp_dir):
+    manager = deploy_nspawn(nspawn_config)
+    assert (manager.disk_file / "etc" / "os-release").read_text() == "ID=debian\n"
+    guestfish_call = (tmp_dir / "calls").read_text().splitlines()[0]
+    assert " -i tar-out / " in guestfish_call
+    assert "/dev/sda1" not in guestfish_call
+
+
+def test_nspawn_instance_is_routed(nspawn_config, tmp_dir):
+    manager = deploy_nspawn(nspawn_config)
+    unit = manager.nspawn_unit_file.read_text()
+    assert "VirtualEthernetExtra=vm1:host0\n" in unit
+    assert "Bridge=" not in unit
+    dropin = (
+        tmp_dir / "system" / "systemd-nspawn@1-web.service.d" / "vmlight-route.conf"
+    )
+    gateway = nspawn_config["deploy"]["default_gateway"]
+    assert dropin.read_text().splitlines()[1:] == [
+        "ExecStartPost=ip link set dev vm1 up",
+        f"ExecStartPost=ip addr replace {gateway}/32 dev vm1",
+        f"ExecStartPost=ip route replace {manager.args['ip']}/32 dev vm1",
+        "ExecStartPost=sysctl -q -w net.ipv4.conf.vm1.proxy_arp=1",
+    ]
+    assert "systemctl daemon-reload" in (tmp_dir / "calls").read_text()
+
+    manager.remove_instance_config()
+    assert not dropin.parent.exists()
+
+
+def test_nspawn_instance_on_a_bridge(nspawn_config, tmp_dir):
+    nspawn_config["nspawn"]["bridge"] = "br0"
+    manager = deploy_nspawn(nspawn_config)
+    unit = manager.nspawn_unit_file.read_text()
+    assert "VirtualEthernet=yes\nBridge=br0\n" in unit
+    assert not (tmp_dir / "system").exists()
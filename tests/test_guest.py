@@ -0,0 +1,151 @@
+import json
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+from vmlight.guest import (
+    GUEST_EDITORS,
+    DirectoryEditor,
+    GuestfishEditor,
+    GuestManifest,
+    NbdEditor,
+    NoCloudEditor,
+)
+from vmlight.ssh import AuthorizedKeys, SshKey
+from vmlight.utils import ApplicationError
+
+STUB_GUESTFISH = Path(__file__).with_name("stub_guestfish.py")
+KEY = SshKey(
+    "ssh-ed25519",
+    "AAAAC3NzaC1lZDI1NTE5AAAAIMi7FQ1APW4QpxdFu2Mnu2r1eCH0JBg2YQDoXaGmDp1F",
+    "alice",
+)
+IMAGE_KEY = (
+    "ssh-ed25519 "
+    "AAAAC3NzaC1lZDI1NTE5AAAAIMchf+EScGT6s5iF7BDwEl66eRv5bl1FhM55orHOupAu image"
+)
+
+
+@pytest.fixture
+def guest(tmp_dir, fake_bin, monkeypatch):
+    """
+    A guest root directory edited by the guestfish stand-in, and a function
+    returning the logged guestfish invocations.
+    """
+    root = tmp_dir / "guest"
+    (root / "etc").mkdir(parents=True)
+    (root / "etc" / "passwd").write_text("root:x:0:0:root:/root:/bin/sh\n")
+    log = tmp_dir / "guestfish.log"
+    guestfish = fake_bin(
+        "guestfish", f'exec {sys.executable} {STUB_GUESTFISH} "$@"\n'
+    )
+    monkeypatch.setenv("PATH", f"{guestfish.parent}:{os.environ['PATH']}")
+    monkeypatch.setenv("FAKE_GUEST_ROOT", str(root))
+    monkeypatch.setenv("FAKE_GUESTFISH_LOG", str(log))
+
+    def calls():
+        if not log.exists():
+            return []
+        return [json.loads(line) for line in log.read_text().splitlines()]
+
+    return root, calls
+
+
+@pytest.fixture
+def editor(tmp_dir, guest):
+    work_dir = tmp_dir / "work"
+    work_dir.mkdir()
+    return GuestfishEditor(tmp_dir / "root.qcow2", work_dir)
+
+
+def test_manifest_is_written_in_one_session(editor, guest):
+    root, calls = guest
+    manifest = GuestManifest()
+    manifest.add_file("/etc/hostname", "web\n")
+    manifest.add_dir("/etc/vmlight", 0o750)
+    editor.apply(manifest)
+    assert (root / "etc" / "hostname").read_text() == "web\n"
+    assert (root / "etc" / "vmlight").stat().st_mode & 0o777 == 0o750
+    assert [call["launch"] for call in calls()] == [True]
+    assert "--rw" in calls()[0]["args"]
+
+
+def test_deferred_keys_read_and_write_in_one_launch(editor, guest):
+    root, calls = guest
+    (root / "root" / ".ssh").mkdir(parents=True)
+    (root / "root" / ".ssh" / "authorized_keys").write_text(f"{IMAGE_KEY}\n")
+    authorized_keys = AuthorizedKeys()
+    authorized_keys.add("root", [KEY])
+    manifest = GuestManifest()
+    manifest.add_file("/etc/hostname", "web\n")
+    manifest.add_deferred(authorized_keys)
+    editor.apply(manifest)
+
+    lines = (root / "root" / ".ssh" / "authorized_keys").read_text().splitlines()
+    assert lines == [IMAGE_KEY, KEY.text]
+    assert (root / "etc" / "hostname").read_text() == "web\n"
+    launches = [call for call in calls() if call["launch"]]
+    assert len(launches) == 1
+    assert "--listen" in launches[0]["args"] and "--rw" in launches[0]["args"]
+    assert calls()[-1]["args"][-1] == "exit"
+
+
+def test_deferred_keys_for_unknown_user_close_the_session(editor, guest):
+    root, calls = guest
+    authorized_keys = AuthorizedKeys()
+    authorized_keys.add("alice", [KEY])
+    manifest = GuestManifest()
+    manifest.add_deferred(authorized_keys)
+    with pytest.raises(ApplicationError, match="Users not found in the guest: alice"):
+        editor.apply(manifest)
+    assert calls()[-1]["args"][-1] == "exit"
+
+
+def make_guestfish_editor(root, work_dir, monkeypatch):
+    return GuestfishEditor(root.parent / "root.qcow2", work_dir)
+
+
+def make_nbd_editor(root, work_dir, monkeypatch):
+    monkeypatch.setattr(os, "geteuid", lambda: 0)
+    editor = NbdEditor(root.parent / "root.qcow2", work_dir)
+    editor.mount_point = root  # As mounted by apply()
+    return editor
+
+
+def make_directory_editor(root, work_dir, monkeypatch):
+    return DirectoryEditor(root, work_dir)
+
+
+# Every editor that reads the guest, which excludes NoCloudEditor: its
+# guest cannot be read before it boots
+READING_EDITORS = {
+    GuestfishEditor.name: make_guestfish_editor,
+    NbdEditor.name: make_nbd_editor,
+    DirectoryEditor.name: make_directory_editor,
+}
+
+
+def test_all_reading_editors_are_tested():
+    editors = set(GUEST_EDITORS) | {DirectoryEditor.name}
+    assert set(READING_EDITORS) == editors - {NoCloudEditor.name}
+
+
+@pytest.mark.parametrize("editor_name", sorted(READING_EDITORS))
+def test_authorized_keys_render_through_editor(
+    editor_name, tmp_dir, guest, fake_bin, monkeypatch
+):
+    root, calls = guest
+    fake_bin("qemu-nbd", "")
+    (root / "root" / ".ssh").mkdir(parents=True)
+    (root / "root" / ".ssh" / "authorized_keys").write_text(f"{IMAGE_KEY}\n")
+    work_dir = tmp_dir / "work"
+    work_dir.mkdir()
+    editor = READING_EDITORS[editor_name](root, work_dir, monkeypatch)
+    authorized_keys = AuthorizedKeys()
+    authorized_keys.add("root", [KEY])
+
+    entries = {entry.path: entry for entry in authorized_keys(editor)}
+    assert entries["/root/.ssh/authorized_keys"].content == f"{IMAGE_KEY}\n{KEY.text}\n"
+    assert entries["/root/.ssh"].owner == (0, 0)
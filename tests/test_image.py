@@ -0,0 +1,195 @@
+import json
+import lzma
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+from vmlight import image
+from vmlight.image import ImageManager
+
+FAKE_QEMU_IMG = """
+case $1 in
+info) echo '{"format": "qcow2", "virtual-size": 1048576, "actual-size": 4096}';;
+esac
+"""
+
+
+class ImageServer(ThreadingHTTPServer):
+    """
+    Serves files from a dict of path to bytes, with an ETag per file and
+    support for Range and If-Range requests. Request headers are kept in
+    requests.
+    """
+
+    def __init__(self, files):
+        super().__init__(("127.0.0.1", 0), ImageRequestHandler)
+        self.files = files
+        self.requests = []
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class ImageRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        data = self.server.files.get(self.path.partition("?")[0])
+        if data is None:
+            self.send_error(404)
+            return
+        etag = f'"{len(data)}-{hash(data) & 0xFFFF:x}"'
+        start = 0
+        byte_range = self.headers.get("Range")
+        if byte_range and self.headers.get("If-Range") in (None, etag):
+            start = int(byte_range[len("bytes=") :].rstrip("-"))
+        self.send_response(206 if start else 200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def image_server():
+    server = ImageServer({})
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def image_dir(config, fake_bin, monkeypatch):
+    qemu_img = fake_bin("qemu-img", FAKE_QEMU_IMG)
+    monkeypatch.setenv("PATH", f"{qemu_img.parent}:{os.environ['PATH']}")
+    image_dir = Path(config["general"]["image_dir"])
+    image_dir.mkdir(parents=True)
+    return image_dir
+
+
+def test_add_stores_duplicates_once(config, image_dir, tmp_dir):
+    source = tmp_dir / "debian.qcow2"
+    source.write_bytes(b"disk" * 1000)
+    manager = ImageManager(config)
+    manager.add(str(source))
+    manager.add(str(source), "debian-copy")
+    assert manager.get_digest("debian") == manager.get_digest("debian-copy")
+    blobs = list((image_dir / "blobs" / "sha256").iterdir())
+    assert len(blobs) == 1
+    assert manager.get_path_by_name("debian-copy").resolve() == blobs[0]
+    assert manager.verify("debian")
+
+
+def test_add_duplicate_copies_nothing(config, image_dir, tmp_dir, monkeypatch):
+    source = tmp_dir / "debian.qcow2"
+    source.write_bytes(b"disk" * 1000)
+    manager = ImageManager(config)
+    manager.add(str(source))
+    copies = []
+    hash_file = image.hash_file
+
+    def record_copies(path, copy_to=None):
+        copies.append(copy_to)
+        return hash_file(path, copy_to)
+
+    monkeypatch.setattr(image, "hash_file", record_copies)
+    manager.add(str(source), "debian-copy")
+    assert copies == [None]  # Hashed once in place
+    assert not list(image_dir.glob("blobs/sha256/.*"))
+
+
+def test_digest_cache_only_has_stored_blobs(config, image_dir, tmp_dir):
+    manager = ImageManager(config)
+    for name in ["a", "b"]:
+        source = tmp_dir / f"{name}.qcow2"
+        source.write_bytes(name.encode() * 1000)
+        manager.add(str(source))
+    cache = json.loads((image_dir / "digests.json").read_text())
+    assert sorted(cache) == sorted(p.name for p in manager.blob_dir.iterdir())
+    manager.remove("a")
+    cache = json.loads((image_dir / "digests.json").read_text())
+    assert sorted(cache) == [f"{manager.get_digest('b')}.qcow2"]
+
+
+def test_changed_blob_is_stored_again(config, image_dir, tmp_dir):
+    source = tmp_dir / "debian.qcow2"
+    source.write_bytes(b"disk" * 1000)
+    manager = ImageManager(config)
+    manager.add(str(source))
+    blob = manager.get_path_by_name("debian").resolve()
+    blob.write_bytes(b"corrupted")
+    assert not manager.verify("debian")
+    manager.add(str(source), "debian-copy")
+    assert manager.verify("debian")
+
+
+def test_legacy_images_are_migrated_explicitly(config, image_dir):
+    legacy = image_dir / "old.qcow2"
+    legacy.write_bytes(b"old" * 1000)
+    manager = ImageManager(config)
+    assert [entry["name"] for entry in manager.get_catalog()] == ["old"]
+    assert manager.get_digest("old") is None
+    assert not (image_dir / "index.json").exists()
+    assert legacy.is_file() and not legacy.is_symlink()
+
+    manager.migrate()
+    assert legacy.is_symlink()
+    assert ImageManager(config).verify("old")
+
+
+def test_add_compressed_url_with_query(config, image_dir, image_server):
+    data = b"qcow2 image" * 10000
+    image_server.files["/debian.qcow2.xz"] = lzma.compress(data)
+    manager = ImageManager(config)
+    manager.add(f"{image_server.url}/debian.qcow2.xz?token=secret")
+    assert manager.get_path_by_name("debian").read_bytes() == data
+    assert not list((image_dir / ".staging").iterdir())
+
+
+def test_add_url_moves_the_download(config, image_dir, image_server, monkeypatch):
+    data = b"qcow2 image" * 10000
+    image_server.files["/debian.qcow2"] = data
+    moved = []
+    download = image.download
+
+    def record_download(url, part_file):
+        download(url, part_file)
+        moved.append(part_file.stat().st_ino)
+
+    monkeypatch.setattr(image, "download", record_download)
+    monkeypatch.setattr(image, "unpack", None)  # Not needed, so not called
+    manager = ImageManager(config)
+    manager.add(f"{image_server.url}/debian.qcow2")
+    blob = manager.get_path_by_name("debian").resolve()
+    assert blob.read_bytes() == data
+    assert blob.stat().st_ino == moved[0]
+    assert not list((image_dir / ".staging").iterdir())
+
+
+@pytest.mark.parametrize("changed", [False, True])
+def test_add_url_resumes_download(config, image_dir, image_server, changed):
+    data = b"qcow2 image" * 10000
+    image_server.files["/debian.qcow2"] = data
+    url = f"{image_server.url}/debian.qcow2"
+    etag = f'"{len(data)}-{hash(data) & 0xFFFF:x}"'
+    staging_dir = image_dir / ".staging"
+    staging_dir.mkdir()
+    part_file = staging_dir / "debian.qcow2.part"
+    # An interrupted download of the same or an older version of the image
+    part_file.write_bytes((b"old image!!" * 10000 if changed else data)[:50000])
+    part_file.with_name(f"{part_file.name}.json").write_text(
+        json.dumps({"url": url, "validator": '"old"' if changed else etag})
+    )
+    manager = ImageManager(config)
+    manager.add(url)
+    assert manager.get_path_by_name("debian").read_bytes() == data
+    assert image_server.requests[-1]["Range"] == "bytes=50000-"
+    assert not part_file.exists()
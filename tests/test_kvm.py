@@ -0,0 +1,53 @@
+import pytest
+
+from stub_qemu import StubQemu
+from vmlight.kvm import KvmVmHelper
+from vmlight.utils import ApplicationError
+from vmlight.vm import Vm, VmType
+
+
+@pytest.fixture
+def helper(config, monkeypatch):
+    monkeypatch.setattr(KvmVmHelper, "qmp_timeout", 0.5)
+    helper = KvmVmHelper(Vm("7", "web", VmType.KVM), config)
+    helper.instance_dir.mkdir(parents=True)
+    return helper
+
+
+@pytest.mark.parametrize("status, running", [("running", True), ("paused", False)])
+def test_is_running_reads_query_status(helper, status, running):
+    with StubQemu(helper.qmp_socket, status=status) as qemu:
+        assert helper.is_running() is running
+    assert qemu.commands == ["qmp_capabilities", "query-status"]
+
+
+def test_is_running_without_qemu(helper):
+    assert helper.is_running() is False
+
+
+def test_is_running_with_stale_socket(helper):
+    StubQemu(helper.qmp_socket).server.close()  # Bound, nobody listening
+    assert helper.qmp_socket.exists()
+    assert helper.is_running() is False
+
+
+@pytest.mark.parametrize("greeting", ["silent", "garbage"])
+def test_is_running_with_broken_qemu(helper, greeting):
+    with StubQemu(helper.qmp_socket, greeting=greeting):
+        assert helper.is_running() is False
+
+
+@pytest.mark.parametrize(
+    "operation, command",
+    [("stop", "system_powerdown"), ("restart", "system_reset"), ("destroy", "quit")],
+)
+def test_operations_send_qmp_commands(helper, operation, command):
+    with StubQemu(helper.qmp_socket) as qemu:
+        assert getattr(helper, operation)() is True
+    assert qemu.commands == ["qmp_capabilities", command]
+
+
+def test_stop_with_hung_qemu(helper):
+    with StubQemu(helper.qmp_socket, greeting="silent"):
+        with pytest.raises(ApplicationError, match="Error stopping KVM VM"):
+            helper.stop()
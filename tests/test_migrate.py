@@ -0,0 +1,259 @@
+import json
+from copy import deepcopy
+from pathlib import Path
+
+import pytest
+
+from vmlight import xen
+from vmlight.migrate import XenMigration, check_receive, commit_receive, receive
+from vmlight.utils import ApplicationError
+from vmlight.vm import VmManager
+
+HOST = "dest.example.org"
+XEN_CONFIG = """\
+name = "7-web"
+memory = 512
+vcpus = 1
+vif = [ 'mac=00:16:3e:00:00:07,bridge=xenbr0,ip=10.10.10.7' ]
+disk = [ '{instance_dir}/root.qcow2,qcow2,xvda,rw' ]
+"""
+
+# Each stand-in logs its arguments as one line of {tmp_dir}/calls
+FAKE_XL = """
+echo "xl $*" >> {tmp_dir}/calls
+case "$1" in
+    list)
+        echo "Name                ID   Mem VCPUs      State   Time(s)"
+        if [ -e {tmp_dir}/running ]; then
+            echo "7-web               12   512     1     -b----      12.3"
+        fi ;;
+    info)
+        echo "free_memory            : 1024" ;;
+    migrate)
+        if [ -e {tmp_dir}/xl_migrate_fails ]; then
+            echo "migration receiver stream contained unexpected data" >&2
+            exit 1
+        fi ;;
+esac
+"""
+FAKE_SSH = """
+host="$1"
+shift
+echo "ssh $host $*" >> {tmp_dir}/calls
+case "$*" in
+    *--receive-check*) cat {tmp_dir}/check_reply ;;
+    *--receive-commit*) cat {tmp_dir}/commit_reply ;;
+esac
+"""
+FAKE_RSYNC = """
+echo "rsync $*" >> {tmp_dir}/calls
+"""
+
+
+def write_instance(instances_dir: Path):
+    instance_dir = instances_dir / "7-web"
+    instance_dir.mkdir(parents=True)
+    (instance_dir / "xen_vm.cfg").write_text(
+        XEN_CONFIG.format(instance_dir=instance_dir)
+    )
+    (instance_dir / "root.qcow2").write_bytes(b"disk")
+    return instance_dir
+
+
+@pytest.fixture
+def remote(config, fake_bin, tmp_dir):
+    """
+    Stand-ins for ssh, rsync and xl, and a function returning the commands
+    they were run with. The destination host replies from the check_reply
+    and commit_reply files.
+    """
+    calls_file = tmp_dir / "calls"
+    calls_file.touch()
+    for name in ["check_reply", "commit_reply"]:
+        (tmp_dir / name).write_text('{"errors": []}\n')
+    config["xen"]["xl_path"] = str(fake_bin("xl", FAKE_XL.format(tmp_dir=tmp_dir)))
+    config["migrate"]["ssh_command"] = str(
+        fake_bin("ssh", FAKE_SSH.format(tmp_dir=tmp_dir))
+    )
+    config["migrate"]["rsync_path"] = str(
+        fake_bin("rsync", FAKE_RSYNC.format(tmp_dir=tmp_dir))
+    )
+    Path(config["xen"]["conf_dir"]).mkdir(parents=True)
+    yield lambda: calls_file.read_text().splitlines()
+    xen.invalidate_domain_snapshot(Path(config["xen"]["xl_path"]))
+
+
+@pytest.fixture
+def source(config, remote, tmp_dir):
+    """
+    A VmManager with the instance 7-web, which starts on boot.
+    """
+    instance_dir = write_instance(Path(config["general"]["instances_dir"]))
+    auto_dir = Path(config["xen"]["conf_dir"]) / "auto"
+    auto_dir.mkdir()
+    (auto_dir / "7-web").symlink_to(instance_dir / "xen_vm.cfg")
+    return VmManager(config)
+
+
+@pytest.fixture
+def destination(config, remote, tmp_dir):
+    """
+    A VmManager for another host, with its own instances directory.
+    """
+    config = deepcopy(config)
+    var_dir = tmp_dir / "dest"
+    config["general"].update(
+        instances_dir=str(var_dir / "instances"),
+        inventory_file=str(var_dir / "inventory.db"),
+        allocator_state_file=str(var_dir / "allocator.json"),
+    )
+    config["xen"]["conf_dir"] = str(var_dir / "xen")
+    return VmManager(config)
+
+
+def get_spec(destination, **fields):
+    spec = {
+        "vm_id": "7",
+        "name": "web",
+        "ip": "10.10.10.7",
+        "memory": "512",
+        "instance_dir": str(destination.instances_dir / "7-web"),
+        "image": "debian",
+        "running": False,
+        "autostart": True,
+        "backing_file": None,
+        "image_digest": None,
+    }
+    spec.update(fields)
+    return spec
+
+
+def test_check_receive_accepts_a_free_instance(destination):
+    assert check_receive(destination, get_spec(destination, running=True)) == []
+
+
+def test_check_receive_reports_conflicts(destination, tmp_dir):
+    destination.allocator.reserve("8", "10.10.10.7")
+    spec = get_spec(
+        destination,
+        instance_dir=str(tmp_dir / "elsewhere" / "7-web"),
+        running=True,
+        memory="2048",
+        backing_file=str(tmp_dir / "images" / "debian.qcow2"),
+    )
+    problems = check_receive(destination, spec)
+    assert problems == [
+        f"Instances are kept in {destination.instances_dir}, "
+        f"not {tmp_dir / 'elsewhere'}.",
+        "IP address 10.10.10.7 is already used by VM 8.",
+        "Only 1024MB of memory free, 2048MB needed.",
+        f"Base image {tmp_dir / 'images' / 'debian.qcow2'} does not exist.",
+    ]
+
+
+def test_commit_receive_adds_the_instance(destination):
+    instance_dir = write_instance(destination.instances_dir)
+    vm = commit_receive(destination, get_spec(destination))
+    assert (vm.id, vm.name, vm.ip, vm.image) == ("7", "web", "10.10.10.7", "debian")
+    assert destination.inventory.get("7") is not None
+    assert destination.allocator.check_free("7", "10.10.10.7") == [
+        "VM ID 7 is already used.",
+        "IP address 10.10.10.7 is already used by VM 7.",
+    ]
+    auto_link = Path(destination.config["xen"]["conf_dir"]) / "auto" / "7-web"
+    assert auto_link.resolve() == instance_dir / "xen_vm.cfg"
+
+
+def test_receive_prints_errors_as_json(destination, capsys):
+    write_instance(destination.instances_dir)
+    spec = json.dumps(get_spec(destination))
+    receive(destination, "check", spec)
+    assert json.loads(capsys.readouterr().out) == {
+        "errors": [f"{destination.instances_dir / '7-web'} already exists."]
+    }
+    receive(destination, "commit", spec)
+    receive(destination, "commit", spec)
+    assert [json.loads(line) for line in capsys.readouterr().out.splitlines()] == [
+        {"errors": []},
+        {
+            "errors": [
+                "VM ID 7 is already used. "
+                "IP address 10.10.10.7 is already used by VM 7."
+            ]
+        },
+    ]
+
+
+def migrate(source):
+    return XenMigration(source, source.get_vm_by_id("7"), HOST).run()
+
+
+def test_stopped_instance_is_moved(source, remote, config):
+    assert migrate(source) == "moved (stopped)"
+    instance_dir = source.instances_dir / "7-web"
+    calls = remote()
+    assert calls[0].startswith("xl list")
+    assert calls[1].startswith(f"ssh {HOST} vmlight --no-daemon vm --receive-check")
+    assert calls[2] == (
+        f"rsync --archive --sparse --inplace -e {config['migrate']['ssh_command']} "
+        f"{instance_dir}/ {HOST}:{instance_dir}/"
+    )
+    assert calls[3].startswith(f"ssh {HOST} vmlight --no-daemon vm --receive-commit")
+    assert len(calls) == 4
+    assert not instance_dir.exists()
+    assert source.inventory.get("7") is None
+    assert not (Path(config["xen"]["conf_dir"]) / "auto" / "7-web").is_symlink()
+
+
+def test_running_instance_is_paused_and_migrated(source, remote, tmp_dir, config):
+    (tmp_dir / "running").touch()
+    assert migrate(source) == "migrated"
+    steps = [call.split()[0:2] for call in remote() if not call.startswith("xl list")]
+    assert steps == [
+        ["ssh", HOST],  # --receive-check
+        ["rsync", "--archive"],
+        ["xl", "pause"],
+        ["rsync", "--archive"],
+        ["xl", "migrate"],
+        ["ssh", HOST],  # --receive-commit
+    ]
+    assert f"xl migrate -s {config['migrate']['ssh_command']} 12 {HOST}" in remote()
+    assert source.inventory.get("7") is None
+
+
+def test_failed_xl_migrate_unpauses_and_removes_the_copy(source, remote, tmp_dir):
+    (tmp_dir / "running").touch()
+    (tmp_dir / "xl_migrate_fails").touch()
+    with pytest.raises(ApplicationError, match="unexpected data"):
+        migrate(source)
+    instance_dir = source.instances_dir / "7-web"
+    calls = [call for call in remote() if not call.startswith("xl list")]
+    assert calls[-2:] == ["xl unpause 12", f"ssh {HOST} rm -rf -- {instance_dir}"]
+    assert not any("--receive-commit" in call for call in calls)
+    assert (instance_dir / "xen_vm.cfg").exists()
+    assert source.inventory.get("7") is not None
+
+
+@pytest.mark.parametrize(
+    "reply, error",
+    [
+        ('{"errors": ["VM ID 7 is in the inventory."]}', f"{HOST}: VM ID 7 is in"),
+        ("vmlight: command not found", f"Unexpected reply from {HOST}"),
+        ("", f"Unexpected reply from {HOST}"),
+        ('{"status": "ok"}', f"Unexpected reply from {HOST}"),
+    ],
+)
+def test_rejected_check_copies_nothing(source, remote, tmp_dir, reply, error):
+    (tmp_dir / "check_reply").write_text(reply)
+    with pytest.raises(ApplicationError, match=error):
+        migrate(source)
+    assert not any(call.startswith(("rsync", "xl pause")) for call in remote())
+    assert source.inventory.get("7") is not None
+
+
+def test_failed_commit_keeps_the_local_copy(source, remote, tmp_dir):
+    (tmp_dir / "commit_reply").write_text('{"errors": ["VM ID 7 is already used."]}')
+    with pytest.raises(ApplicationError, match="inventory --rebuild"):
+        migrate(source)
+    assert (source.instances_dir / "7-web" / "xen_vm.cfg").exists()
+    assert not any(" rm -rf " in call for call in remote())
@@ -0,0 +1,83 @@
+import threading
+
+from vmlight.helpers import VmBackendHelper
+from vmlight.operations import VmOperations
+from vmlight.state import _notify_listeners
+from vmlight.vm import Vm, VmType
+
+
+class FakeHelper(VmBackendHelper):
+    """
+    A backend whose reboot takes a while: the VM keeps running with its
+    old domain ID at first, then stops, then runs with a new domain ID.
+    """
+
+    def __init__(self, vm, config):
+        super().__init__(vm, config)
+        self.domain_id = "12"
+        self.running = True
+        self.events = []
+
+    def is_running(self):
+        return self.running
+
+    def get_boot_id(self):
+        return self.domain_id if self.running else None
+
+    def restart(self):
+        def shutting_down():
+            _notify_listeners()  # Still running with the old domain ID
+
+        def stop():
+            self.running = False
+            _notify_listeners()
+
+        def start():
+            self.domain_id = "13"
+            self.running = True
+            self.events.append("booted")
+            _notify_listeners()
+
+        for delay, change in [(0.1, shutting_down), (0.3, stop), (0.5, start)]:
+            timer = threading.Timer(delay, change)
+            timer.daemon = True
+            timer.start()
+
+
+class FakeVmManager:
+    def __init__(self, helper):
+        self.helper = helper
+
+    def _get_vm_backend_helper(self, vm_id):
+        return self.helper
+
+
+def restart(helper):
+    operations = VmOperations(FakeVmManager(helper), wait=True, timeout=10)
+    operations.run("restart", [helper.vm])
+
+
+def test_restart_waits_for_the_next_boot(capsys):
+    helper = FakeHelper(Vm("7", "web", VmType.XEN), {})
+    restart(helper)
+    assert helper.events == ["booted"]
+    assert "running" in capsys.readouterr().out
+
+
+class ResetHelper(FakeHelper):
+    """
+    A backend that resets the VM in place, and cannot tell boots apart.
+    """
+
+    def get_boot_id(self):
+        return None
+
+    def restart(self):
+        self.events.append("reset")
+        _notify_listeners()
+
+
+def test_restart_without_boot_ids_waits_for_running():
+    helper = ResetHelper(Vm("7", "web", VmType.KVM), {})
+    restart(helper)
+    assert helper.events == ["reset"]
@@ -0,0 +1,43 @@
+from pathlib import Path
+
+import pytest
+
+from vmlight.ssh import SshKeyManager
+
+KEY_1 = (
+    "ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIMi7FQ1APW4QpxdFu2Mnu2r1eCH0JBg2YQDoXaGmDp1F"
+)
+KEY_2 = (
+    "ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIMchf+EScGT6s5iF7BDwEl66eRv5bl1FhM55orHOupAu"
+)
+
+
+@pytest.fixture
+def key_store(config):
+    key_store = Path(config["deploy"]["ssh_key_list_file"])
+    key_store.write_text(
+        f"# Keys\n"
+        f"{KEY_1} alice\n"
+        f"ssh-rsa legacy-key-without-a-name\n"
+        f"ssh-ed25519 AAAAnotbase64!! bob\n"
+        f"@group admins alice\n"
+    )
+    return key_store
+
+
+def test_invalid_lines_are_skipped(config, key_store, capsys):
+    manager = SshKeyManager(config)
+    assert [key.name for key in manager.keys] == ["alice"]
+    assert manager.resolve(["admins"])[0].name == "alice"
+    warnings = capsys.readouterr().err
+    assert f"invalid line 3 in {key_store}" in warnings
+    assert f"invalid line 4 in {key_store}" in warnings
+
+
+def test_invalid_lines_are_kept_on_write(config, key_store):
+    manager = SshKeyManager(config)
+    manager.add_key(f"{KEY_2} carol")
+    text = key_store.read_text()
+    assert "ssh-rsa legacy-key-without-a-name\n" in text
+    assert "ssh-ed25519 AAAAnotbase64!! bob\n" in text
+    assert [key.name for key in SshKeyManager(config).keys] == ["alice", "carol"]
@@ -0,0 +1,128 @@
+import threading
+import time
+
+import pytest
+
+from vmlight import xen
+from vmlight.state import (
+    DomainEvent,
+    DomainStateTracker,
+    QueueEventSource,
+    add_state_listener,
+    remove_state_listener,
+)
+from vmlight.vm import Vm, VmType
+from vmlight.xen import XenDomain, XenVmHelper
+
+FAKE_XL = """
+echo list >> {calls_file}
+echo "Name                ID   Mem VCPUs      State   Time(s)"
+echo "7-web               12   512     1     -b----      12.3"
+"""
+
+
+def domain(state="-b----", vm_id=7):
+    return XenDomain(f"{vm_id}-web", str(vm_id + 5), 512, 1, state, 1.0)
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out waiting for the tracker")
+        time.sleep(0.01)
+
+
+class FakeLoad:
+    """
+    The full state read of a tracker, counting how often it is read.
+    """
+
+    def __init__(self, domains=None):
+        self.domains = domains or {}
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return dict(self.domains)
+
+
+@pytest.fixture
+def xl(config, fake_bin, tmp_dir):
+    calls_file = tmp_dir / "xl_calls"
+    calls_file.touch()
+    xl_path = fake_bin("xl", FAKE_XL.format(calls_file=calls_file))
+    config["xen"]["xl_path"] = str(xl_path)
+    yield calls_file
+    xen.invalidate_domain_snapshot(xl_path)
+    xen._domain_trackers.pop(str(xl_path), None)
+
+
+@pytest.fixture
+def tracked(config, xl):
+    """
+    A XenVmHelper for VM 7 whose domain state comes from a tracker fed by
+    a QueueEventSource.
+    """
+    load = FakeLoad()
+    source = QueueEventSource()
+    tracker = DomainStateTracker(load, source, resync_interval=3600)
+    tracker.start()
+    xen._domain_trackers[config["xen"]["xl_path"]] = tracker
+    helper = XenVmHelper(Vm("7", "web", VmType.XEN), config)
+    yield helper, tracker, source, load
+    tracker.stop()
+
+
+def test_events_update_state(tracked, xl):
+    helper, tracker, source, load = tracked
+    changes = threading.Semaphore(0)
+    add_state_listener(changes.release)
+    try:
+        assert not helper.is_running()
+        source.put(DomainEvent("7", domain()))
+        assert changes.acquire(timeout=5)
+        assert helper.is_running()
+        assert helper._get_xen_domain_id() == "12"
+        assert helper.get_boot_id() == "12"
+
+        source.put(DomainEvent("7", domain("--p---")))  # Paused
+        assert changes.acquire(timeout=5)
+        assert not helper.is_running()
+
+        source.put(DomainEvent("7", None))  # Destroyed
+        assert changes.acquire(timeout=5)
+        assert tracker.get("7") is None
+    finally:
+        remove_state_listener(changes.release)
+    assert load.calls == 1  # Only the initial load
+    assert xl.read_text() == ""  # No 'xl list' while the tracker is live
+
+
+def test_event_without_vm_id_resyncs(tracked):
+    helper, tracker, source, load = tracked
+    load.domains = {"7": domain()}
+    source.put(DomainEvent())
+    wait_for(lambda: load.calls == 2)
+    wait_for(helper.is_running)
+
+
+def test_periodic_resync_catches_silent_changes():
+    load = FakeLoad({"7": domain()})
+    tracker = DomainStateTracker(load, QueueEventSource(), resync_interval=0.05)
+    tracker.start()
+    try:
+        assert tracker.get("7").is_running()
+        load.domains = {"7": domain("--p---")}  # Paused, which raises no event
+        wait_for(lambda: not tracker.get("7").is_running())
+    finally:
+        tracker.stop()
+
+
+def test_falls_back_to_xl_when_events_stop(tracked, xl):
+    helper, tracker, source, load = tracked
+    assert not helper.is_running()
+    source.close()  # The event feed ends, e.g. xenstore-watch died
+    wait_for(lambda: not tracker.live)
+    assert helper.is_running()  # From the fake 'xl list'
+    assert xl.read_text() == "list\n"